@@ -3,6 +3,8 @@
 import tensorflow as tf
 from dh_segment.loader import LoadedModel
 from dh_segment.post_processing import boxes_detection, binarization, PAGE
+from dh_segment.streaming import predict_stream
+from functools import partial
 from tqdm import tqdm
 from glob import glob
 import numpy as np
@@ -39,6 +41,54 @@ def format_quad_to_string(quad):
     return s[:-1]
 
 
+def page_post_processing(filename: str, prediction_outputs: dict, output_dir: str, output_pagexml_dir: str) -> str:
+    """
+    Finds the page in the predictions of an image, exports it as an image with the box drawn and as PAGE XML.
+    :param filename: filename of the image
+    :param prediction_outputs: outputs of the model for this image
+    :param output_dir: directory where to save the image with the drawn box
+    :param output_pagexml_dir: directory where to save the PAGE XML file
+    :return: line with the coordinates of the page for the .txt file, empty if no page is found
+    """
+    probs = prediction_outputs['probs'][0]
+    original_shape = prediction_outputs['original_shape']
+    probs = probs[:, :, 1]  # Take only class '1' (class 0 is the background, class 1 is the page)
+    probs = probs / np.max(probs)  # Normalize to be in [0, 1]
+
+    # Binarize the predictions
+    page_bin = page_make_binary_mask(probs)
+
+    # Upscale to have full resolution image (cv2 uses (w,h) and not (h,w) for giving shapes)
+    bin_upscaled = cv2.resize(page_bin.astype(np.uint8, copy=False),
+                              tuple(original_shape[::-1]), interpolation=cv2.INTER_NEAREST)
+
+    # Find quadrilateral enclosing the page
+    pred_page_coords = boxes_detection.find_boxes(bin_upscaled.astype(np.uint8, copy=False),
+                                                  mode='min_rectangle', n_max_boxes=1)
+
+    # Draw page box on original image and export it. Add also box coordinates to the txt file
+    original_img = imread(filename, pilmode='RGB')
+    basename = os.path.basename(filename).split('.')[0]
+    if pred_page_coords is None:
+        # Only this image is skipped, the other ones of the stream are still processed
+        print('No box found in {}'.format(filename))
+        imsave(os.path.join(output_dir, '{}_boxes.jpg'.format(basename)), original_img)
+        return ''
+    cv2.polylines(original_img, [pred_page_coords[:, None, :]], True, (0, 0, 255), thickness=5)
+    # Write corners points into a .txt file
+    txt_coordinates = '{},{}\n'.format(filename, format_quad_to_string(pred_page_coords))
+    imsave(os.path.join(output_dir, '{}_boxes.jpg'.format(basename)), original_img)
+
+    # Create page region and XML file
+    page_border = PAGE.Border(coords=PAGE.Point.cv2_to_point_list(pred_page_coords[:, None, :]))
+    page_xml = PAGE.Page(filename, image_width=original_shape[1], image_height=original_shape[0],
+                         page_border=page_border)
+    xml_filename = os.path.join(output_pagexml_dir, '{}.xml'.format(basename))
+    page_xml.write_to_file(xml_filename, creator_name='PageExtractor')
+
+    return txt_coordinates
+
+
 if __name__ == '__main__':
 
     # If the model has been trained load the model, otherwise use the given model
@@ -59,44 +109,14 @@ if __name__ == '__main__':
 
     with tf.Session():  # Start a tensorflow session
         # Load the model
-        m = LoadedModel(model_dir, predict_mode='filename')
-
-        for filename in tqdm(input_files, desc='Processed files'):
-            # For each image, predict each pixel's label
-            prediction_outputs = m.predict(filename)
-            probs = prediction_outputs['probs'][0]
-            original_shape = prediction_outputs['original_shape']
-            probs = probs[:, :, 1]  # Take only class '1' (class 0 is the background, class 1 is the page)
-            probs = probs / np.max(probs)  # Normalize to be in [0, 1]
-
-            # Binarize the predictions
-            page_bin = page_make_binary_mask(probs)
-
-            # Upscale to have full resolution image (cv2 uses (w,h) and not (h,w) for giving shapes)
-            bin_upscaled = cv2.resize(page_bin.astype(np.uint8, copy=False),
-                                      tuple(original_shape[::-1]), interpolation=cv2.INTER_NEAREST)
-
-            # Find quadrilateral enclosing the page
-            pred_page_coords = boxes_detection.find_boxes(bin_upscaled.astype(np.uint8, copy=False),
-                                                          mode='min_rectangle', n_max_boxes=1)
-
-            # Draw page box on original image and export it. Add also box coordinates to the txt file
-            original_img = imread(filename, pilmode='RGB')
-            if pred_page_coords is not None:
-                cv2.polylines(original_img, [pred_page_coords[:, None, :]], True, (0, 0, 255), thickness=5)
-                # Write corners points into a .txt file
-                txt_coordinates += '{},{}\n'.format(filename, format_quad_to_string(pred_page_coords))
-            else:
-                print('No box found in {}'.format(filename))
-            basename = os.path.basename(filename).split('.')[0]
-            imsave(os.path.join(output_dir, '{}_boxes.jpg'.format(basename)), original_img)
-
-            # Create page region and XML file
-            page_border = PAGE.Border(coords=PAGE.Point.cv2_to_point_list(pred_page_coords[:, None, :]))
-            page_xml = PAGE.Page(filename, image_width=original_shape[1], image_height=original_shape[0],
-                                 page_border=page_border)
-            xml_filename = os.path.join(output_pagexml_dir, '{}.xml'.format(basename))
-            page_xml.write_to_file(xml_filename, creator_name='PageExtractor')
+        m = LoadedModel(model_dir, predict_mode='image')
+
+        # Images are decoded, predicted and post-processed concurrently
+        post_processing_fn = partial(page_post_processing, output_dir=output_dir,
+                                     output_pagexml_dir=output_pagexml_dir)
+        for filename, txt_line in tqdm(predict_stream(m, input_files, post_processing_fn),
+                                       total=len(input_files), desc='Processed files'):
+            txt_coordinates += txt_line
 
     # Save txt file
     with open(os.path.join(output_dir, 'pages.txt'), 'w') as f:
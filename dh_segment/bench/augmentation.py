@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Benchmark of the data augmentation (samples/s) : per-sample path (rotation of the full image, patches,
+flips and colors per patch) against the batched path (patches, then one affine transform per patch on the batch).
+
+python -m dh_segment.bench.augmentation -s 1200 600 -p 300 300 -b 16 --output results.json
+"""
+import argparse
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from ..input_utils import data_augmentation_fn, batch_augmentation_fn, rotate_crop, grid_patches_positions, \
+    crop_patch
+
+
+def _synthetic_dataset(image_shape: list, n_classes: int=3) -> tf.data.Dataset:
+    image = tf.constant(np.random.randint(0, 256, size=list(image_shape) + [3]).astype(np.float32))
+    labels = tf.constant(np.random.randint(0, n_classes, size=image_shape).astype(np.int64))
+    return tf.data.Dataset.from_tensors((image, labels)).repeat()
+
+
+def _patches(image: tf.Tensor, labels: tf.Tensor, patch_shape: list) -> tf.data.Dataset:
+    positions = grid_patches_positions(tf.shape(image)[:2], patch_shape, (0., 0.))
+    return tf.data.Dataset.from_tensor_slices(positions).map(
+        lambda p: (crop_patch(image, p, patch_shape), crop_patch(labels[:, :, None], p, patch_shape)[:, :, 0]))
+
+
+def per_sample_pipeline(image_shape: list, patch_shape: list, batch_size: int, max_rotation: float,
+                        num_threads: int) -> tf.data.Dataset:
+    def _rotate(image, labels):
+        angle = tf.random_uniform([], -max_rotation, max_rotation)
+        minimum_shape = [(i * 3) // 2 for i in patch_shape]
+        return rotate_crop(image, angle, minimum_shape=minimum_shape, interpolation='BILINEAR'), \
+            rotate_crop(labels[:, :, None], angle, minimum_shape=minimum_shape, interpolation='NEAREST')[:, :, 0]
+
+    dataset = _synthetic_dataset(image_shape).map(_rotate, num_threads)
+    dataset = dataset.flat_map(lambda image, labels: _patches(image, labels, patch_shape))
+    dataset = dataset.map(lambda image, labels: data_augmentation_fn(image, labels[:, :, None], True, True, True),
+                          num_threads)
+    return dataset.batch(batch_size)
+
+
+def batched_pipeline(image_shape: list, patch_shape: list, batch_size: int, max_rotation: float,
+                     num_threads: int) -> tf.data.Dataset:
+    dataset = _synthetic_dataset(image_shape).flat_map(lambda image, labels: _patches(image, labels, patch_shape))
+    dataset = dataset.batch(batch_size)
+    return dataset.map(lambda images, labels: batch_augmentation_fn({'images': images, 'labels': labels},
+                                                                    max_rotation, True, True, True),
+                       num_threads)
+
+
+def benchmark_pipeline(pipeline_fn, image_shape: list, patch_shape: list, batch_size: int=16,
+                       max_rotation: float=0.2, num_threads: int=4, n_batches: int=50, n_warmup: int=5) -> dict:
+    """
+    Measures the throughput of an augmentation pipeline
+
+    :param pipeline_fn: `per_sample_pipeline` or `batched_pipeline`
+    :param image_shape: [H, W] of the synthetic images
+    :param patch_shape: [h, w] of the patches
+    :param batch_size: number of patches per batch
+    :param max_rotation: maximum rotation angle (in radians)
+    :param num_threads: parallel calls of the map stages
+    :param n_batches: number of timed batches
+    :param n_warmup: number of batches before timing
+    :return: dict with the measured throughput
+    """
+    with tf.Graph().as_default(), tf.Session() as sess:
+        next_batch = pipeline_fn(image_shape, patch_shape, batch_size, max_rotation, num_threads) \
+            .prefetch(2).make_one_shot_iterator().get_next()
+        for _ in range(n_warmup):
+            sess.run(next_batch)
+        start = time.time()
+        for _ in range(n_batches):
+            sess.run(next_batch)
+        duration = time.time() - start
+
+    return {'pipeline': pipeline_fn.__name__,
+            'n_samples': n_batches * batch_size,
+            'duration': duration,
+            'samples_per_second': n_batches * batch_size / duration}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--image_shape', type=int, nargs=2, default=[1200, 600],
+                        help='Shape (h, w) of the synthetic images')
+    parser.add_argument('-p', '--patch_shape', type=int, nargs=2, default=[300, 300], help='Shape (h, w) of the patches')
+    parser.add_argument('-b', '--batch_size', type=int, default=16)
+    parser.add_argument('-r', '--max_rotation', type=float, default=0.2, help='Maximum rotation (radians)')
+    parser.add_argument('-t', '--num_threads', type=int, default=4)
+    parser.add_argument('-n', '--n_batches', type=int, default=50, help='Number of timed batches')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file to save the results')
+    args = vars(parser.parse_args())
+
+    results = list()
+    print('{:>22} {:>12}'.format('pipeline', 'samples/s'))
+    for pipeline_fn in [per_sample_pipeline, batched_pipeline]:
+        result = benchmark_pipeline(pipeline_fn, args.get('image_shape'), args.get('patch_shape'),
+                                    args.get('batch_size'), args.get('max_rotation'), args.get('num_threads'),
+                                    args.get('n_batches'))
+        print('{pipeline:>22} {samples_per_second:>12.2f}'.format(**result))
+        results.append(result)
+
+    if args.get('output'):
+        with open(args.get('output'), 'w') as f:
+            json.dump({'args': args, 'results': results}, f, indent=4)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Cost of the model for several configurations of the decoder : floating point operations and number of parameters
+of the encoder and of each level of the decoder, for an input of fixed size.
+
+python -m dh_segment.bench.decoder -m resnet50 -s 1000 700 --output results.json
+python -m dh_segment.bench.decoder -c full.json separable.json
+"""
+import argparse
+import json
+import os
+import re
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import ops
+from .. import utils
+from ..model import inference_vgg16, inference_resnet_v1_50, inference_mobilenet_v1, inference_u_net
+
+_INFERENCE_FNS = {
+    'vgg16': inference_vgg16,
+    'resnet50': inference_resnet_v1_50,
+    'mobilenet_v1': inference_mobilenet_v1,
+    'unet': inference_u_net
+}
+
+
+def _part(name: str) -> str:
+    # Part of the model an op or a variable belongs to : 'encoder', 'deconv_<n>' or 'decoder' (the rest of the decoder)
+    if not name.startswith('upsampling/'):
+        return 'encoder'
+    level = re.match('upsampling/(deconv_[0-9]+)/', name)
+    return level.group(1) if level else 'decoder'
+
+
+def model_cost(model_params: dict, image_shape: tuple=(1000, 700), n_classes: int=3) -> OrderedDict:
+    """
+    Counts the floating point operations (of the ops with registered statistics : convolutions, products, additions...)
+    and the parameters of each part of the model
+
+    :param model_params: parameters of the model (see `utils.ModelParams`)
+    :param image_shape: (h, w) of the input image
+    :param n_classes: number of classes of the output
+    :return: dict part : {'gflops', 'parameters'}, with a 'total'
+    """
+    model_params = utils.ModelParams(**dict(model_params, n_classes=n_classes))
+    cost = OrderedDict()
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(tf.float32, [1] + list(image_shape) + [3])
+        _INFERENCE_FNS[model_params.pretrained_model_name](images, model_params, n_classes,
+                                                           use_batch_norm=model_params.batch_norm)
+        for op in graph.get_operations():
+            try:
+                flops = ops.get_stats_for_node_def(graph, op.node_def, 'flops').value
+            except ValueError:  # Incomplete shapes
+                flops = None
+            part = cost.setdefault(_part(op.name), {'gflops': 0., 'parameters': 0})
+            part['gflops'] += (flops or 0) / 1e9
+        for v in tf.trainable_variables():
+            part = cost.setdefault(_part(v.op.name), {'gflops': 0., 'parameters': 0})
+            part['parameters'] += int(np.prod(v.get_shape().as_list()))
+
+    cost['total'] = {'gflops': sum(c['gflops'] for c in cost.values()),
+                     'parameters': sum(c['parameters'] for c in cost.values())}
+    return cost
+
+
+def default_configurations(pretrained_model_name: str) -> OrderedDict:
+    """
+    :param pretrained_model_name: name of the encoder
+    :return: dict name : model_params, the default decoder and its separable variants with full and halved widths
+    """
+    upscale_params = utils.ModelParams(pretrained_model_name=pretrained_model_name).upscale_params
+    return OrderedDict([
+        ('full', {'pretrained_model_name': pretrained_model_name}),
+        ('separable', {'pretrained_model_name': pretrained_model_name, 'separable_decoder': True}),
+        ('separable_0.5', {'pretrained_model_name': pretrained_model_name, 'separable_decoder': True,
+                           'upscale_params': [(f, b, 0.5) for f, b in upscale_params]})
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--pretrained_model_name', type=str, default='resnet50',
+                        help='Encoder of the default configurations (resnet50 or mobilenet_v1)')
+    parser.add_argument('-c', '--configs', type=str, nargs='+', default=None,
+                        help='JSON files of model_params to compare instead of the default configurations')
+    parser.add_argument('-s', '--image_shape', type=int, nargs=2, default=[1000, 700],
+                        help='Shape (h, w) of the input image')
+    parser.add_argument('-n', '--n_classes', type=int, default=3)
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file to save the results')
+    args = vars(parser.parse_args())
+
+    if args.get('configs'):
+        configurations = OrderedDict((os.path.splitext(os.path.basename(f))[0], utils.parse_json(f))
+                                     for f in args.get('configs'))
+    else:
+        configurations = default_configurations(args.get('pretrained_model_name'))
+
+    results = OrderedDict()
+    for name, model_params in configurations.items():
+        results[name] = model_cost(model_params, tuple(args.get('image_shape')), args.get('n_classes'))
+        print(name)
+        print('{:>12} {:>10} {:>12}'.format('part', 'GFLOPs', 'parameters'))
+        for part, c in results[name].items():
+            print('{:>12} {:>10.2f} {:>12d}'.format(part, c['gflops'], c['parameters']))
+
+    if args.get('output'):
+        with open(args.get('output'), 'w') as f:
+            json.dump({'args': args, 'configurations': configurations, 'results': results}, f, indent=4)
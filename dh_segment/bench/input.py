@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Benchmark of the input pipeline alone (no model), on CPU, against a synthetic dataset of documents.
+Reports the throughput of `input_fn` (samples/s), the latency of each stage of the preparation of a sample
+and the peak memory of the process. A chrome trace (chrome://tracing) of the pipeline can also be saved.
+
+python -m dh_segment.bench.input -n 32 --patches --augmentation --output results.json
+python -m dh_segment.bench.input -d <dir with images/, labels/ and classes.txt> --trace trace.json
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+from imageio import imsave
+from tensorflow.python.client import timeline
+from .. import utils
+from ..input import input_fn
+from ..input_utils import resize_image, rotate_crop, data_augmentation_fn, \
+    grid_patches_positions, crop_patch, local_entropy
+
+# Background, text lines, illustrations
+_CLASSES_COLORS = np.array([[0, 0, 0], [255, 0, 0], [0, 0, 255]])
+
+
+def generate_documents(output_dir: str, n_images: int=32, shape: tuple=(1600, 1100), seed: int=0) -> str:
+    """
+    Generates pages with text lines and illustrations, and their labels, in `output_dir`/images and `output_dir`/labels
+    (the structure expected by train.py) with the classes file `output_dir`/classes.txt
+
+    :return: the classes file
+    """
+    random_state = np.random.RandomState(seed)
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'labels'), exist_ok=True)
+    h, w = shape
+    for i in range(n_images):
+        image = np.full([h, w, 3], [235, 225, 200], np.float32) + random_state.normal(0, 8, [h, w, 3])
+        labels = np.zeros([h, w], np.uint8)
+        margin = w // 10
+        y = margin
+        while y < h - margin:
+            if random_state.rand() < 0.1:
+                # Illustration
+                block_h = random_state.randint(h // 10, h // 4)
+                image[y:y + block_h, margin:w - margin] *= random_state.uniform(0.3, 0.7)
+                labels[y:y + block_h, margin:w - margin] = 2
+                y += block_h + h // 50
+            else:
+                # Text line
+                line_h, line_w = h // 60, random_state.randint(w // 2, w - 2 * margin)
+                image[y:y + line_h, margin:margin + line_w] *= 0.2
+                labels[y:y + line_h, margin:margin + line_w] = 1
+                y += int(line_h * random_state.uniform(1.8, 2.5))
+        imsave(os.path.join(output_dir, 'images', '{:04d}.jpg'.format(i)), np.uint8(np.clip(image, 0, 255)))
+        imsave(os.path.join(output_dir, 'labels', '{:04d}.png'.format(i)), np.uint8(_CLASSES_COLORS[labels]))
+
+    classes_file = os.path.join(output_dir, 'classes.txt')
+    np.savetxt(classes_file, _CLASSES_COLORS, fmt='%d')
+    return classes_file
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_input_fn(images_dir: str, labels_dir: str, params: dict, batch_size: int=5, make_patches: bool=False,
+                       data_augmentation: bool=False, num_threads: int=4, n_batches: int=50, n_warmup: int=5,
+                       cache_dir: str=None, trace_file: str=None) -> dict:
+    """
+    Iterates `input_fn` without model and measures its throughput
+
+    :param images_dir: directory of the images
+    :param labels_dir: directory of the labels
+    :param params: params of the experiment (see train.py)
+    :param trace_file: if set, a chrome trace of a batch is saved to this file
+    :return: dict with the measured throughput and the peak memory
+    """
+    with tf.Graph().as_default(), tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+        batch, _ = input_fn(images_dir, params, input_label_dir=labels_dir, data_augmentation=data_augmentation,
+                            batch_size=batch_size, make_patches=make_patches, num_threads=num_threads,
+                            cache_dir=cache_dir)()
+        for _ in range(n_warmup):
+            sess.run(batch)
+        n_samples = 0
+        start = time.time()
+        for _ in range(n_batches):
+            n_samples += sess.run(batch['images']).shape[0]
+        duration = time.time() - start
+
+        if trace_file is not None:
+            run_metadata = tf.RunMetadata()
+            sess.run(batch, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+            with open(trace_file, 'w') as f:
+                f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
+    return {'n_batches': n_batches,
+            'n_samples': n_samples,
+            'duration': duration,
+            'samples_per_second': n_samples / duration,
+            'peak_rss_mb': _peak_rss_mb()}
+
+
+def benchmark_stages(image_filenames: list, label_filenames: list, params: dict) -> dict:
+    """
+    Runs each stage of the preparation of a sample separately, on the output of the previous one
+
+    :param image_filenames: filenames of the images
+    :param label_filenames: filenames of the labels
+    :param params: params of the experiment (see train.py)
+    :return: dict stage : mean latency per sample (ms)
+    """
+    training_params = utils.TrainingParams.from_dict(params['training_params'])
+    classes_file = params['classes_file']
+    latencies = OrderedDict()
+
+    with tf.Graph().as_default(), tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+        def _time_stage(name, outputs, feeds: list):
+            # feeds : list of feed_dicts, one per sample
+            results = list()
+            start = time.time()
+            for feed_dict in feeds:
+                results.append(sess.run(outputs, feed_dict=feed_dict))
+            latencies[name] = 1000 * (time.time() - start) / len(feeds)
+            return results
+
+        filename = tf.placeholder(tf.string, [])
+        encoded = _time_stage('read', tf.read_file(filename),
+                              [{filename: f} for f in image_filenames + label_filenames])
+
+        encoded_image = tf.placeholder(tf.string, [])
+        decoded = _time_stage('decode', tf.image.decode_jpeg(encoded_image, channels=3),
+                              [{encoded_image: e} for e in encoded])
+
+        n = len(image_filenames)
+        image = tf.placeholder(tf.float32, [None, None, 3])
+        label_image = tf.placeholder(tf.float32, [None, None, 3])
+        resized_images = _time_stage('resize', resize_image(image, training_params.input_resized_size),
+                                     [{image: d} for d in decoded[:n]])
+        resized_labels = _time_stage('resize_labels', resize_image(label_image, training_params.input_resized_size,
+                                                                   interpolation='NEAREST'),
+                                     [{label_image: d} for d in decoded[n:]])
+
+        rotation = tf.random_uniform([], -training_params.data_augmentation_max_rotation,
+                                     training_params.data_augmentation_max_rotation)
+        augmented = data_augmentation_fn(rotate_crop(image, rotation, interpolation='BILINEAR'),
+                                         rotate_crop(label_image, rotation, interpolation='NEAREST'))
+        _time_stage('augmentation', augmented, [{image: i, label_image: l}
+                                                for i, l in zip(resized_images, resized_labels)])
+
+        positions = grid_patches_positions(tf.shape(image)[:2], training_params.patch_shape, (0., 0.))
+        patches = tf.map_fn(lambda p: crop_patch(image, p, training_params.patch_shape), positions,
+                            dtype=tf.float32)
+        _time_stage('patching', patches, [{image: i} for i in resized_images])
+
+        classes = utils.label_image_to_class(label_image, classes_file)
+        class_labels = _time_stage('colour_mapping', classes, [{label_image: l} for l in resized_labels])
+
+        class_label = tf.placeholder(tf.int64, [None, None])
+        _time_stage('entropy', local_entropy(tf.equal(class_label, 1), sigma=training_params.local_entropy_sigma),
+                    [{class_label: c} for c in class_labels])
+
+    # Reading and decoding are timed on both images and labels
+    latencies['read'] *= 2
+    latencies['decode'] *= 2
+    latencies['resize'] += latencies.pop('resize_labels')
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dataset_dir', type=str, default=None,
+                        help='Directory with images/, labels/ and classes.txt, '
+                             'a synthetic dataset is generated if not given')
+    parser.add_argument('-n', '--n_images', type=int, default=32, help='Number of synthetic images')
+    parser.add_argument('-s', '--image_shape', type=int, nargs=2, default=[1600, 1100],
+                        help='Shape (h, w) of the synthetic images')
+    parser.add_argument('-p', '--training_params', type=str, default=None,
+                        help='JSON file with the training parameters to use')
+    parser.add_argument('-b', '--batch_size', type=int, default=5)
+    parser.add_argument('--patches', action='store_true', help='Make patches')
+    parser.add_argument('--augmentation', action='store_true', help='Use data augmentation')
+    parser.add_argument('-t', '--num_threads', type=int, default=4)
+    parser.add_argument('--n_batches', type=int, default=50, help='Number of timed batches')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Use the dataset cache in this directory')
+    parser.add_argument('--trace', type=str, default=None, help='File to save a chrome trace of a batch')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file to save the results')
+    args = vars(parser.parse_args())
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    dataset_dir = args.get('dataset_dir')
+    if dataset_dir is None:
+        dataset_dir = tempfile.mkdtemp(prefix='dhsegment_bench_')
+        generate_documents(dataset_dir, args.get('n_images'), tuple(args.get('image_shape')))
+    images_dir, labels_dir = os.path.join(dataset_dir, 'images'), os.path.join(dataset_dir, 'labels')
+
+    training_params = utils.TrainingParams()
+    if args.get('training_params'):
+        training_params = utils.TrainingParams.from_dict(utils.parse_json(args.get('training_params')))
+    params = {'training_params': training_params.to_dict(),
+              'prediction_type': utils.PredictionType.CLASSIFICATION,
+              'classes_file': os.path.join(dataset_dir, 'classes.txt')}
+
+    image_filenames = sorted(os.path.join(images_dir, f) for f in os.listdir(images_dir))
+    labels_by_name = {os.path.splitext(f)[0]: os.path.join(labels_dir, f) for f in os.listdir(labels_dir)}
+    label_filenames = [labels_by_name[os.path.splitext(os.path.basename(f))[0]] for f in image_filenames]
+    stages = benchmark_stages(image_filenames, label_filenames, params)
+    print('{:>16} {:>10}'.format('stage', 'ms/sample'))
+    for stage, latency in stages.items():
+        print('{:>16} {:>10.2f}'.format(stage, latency))
+
+    result = benchmark_input_fn(images_dir, labels_dir, params, args.get('batch_size'), args.get('patches'),
+                                args.get('augmentation'), args.get('num_threads'), args.get('n_batches'),
+                                cache_dir=args.get('cache_dir'), trace_file=args.get('trace'))
+    print('input_fn : {samples_per_second:.2f} samples/s, peak RSS {peak_rss_mb:.0f} MB'.format(**result))
+
+    if args.get('output'):
+        with open(args.get('output'), 'w') as f:
+            json.dump({'args': args, 'stages_ms': stages, 'input_fn': result}, f, indent=4)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Benchmark of the prediction throughput (images/s) as a function of the thread layout :
+number of concurrent runs x intra-op threads x inter-op threads of the session.
+
+python -m dh_segment.bench.prediction -m <export_dir> -l 1:0:0 2:4:2 4:2:1 --output results.json
+"""
+import argparse
+import json
+import time
+import os
+from glob import glob
+import numpy as np
+from scipy.misc import imread
+from ..loader import ModelRegistry, make_session_config
+from ..streaming import ParallelPredictor
+
+
+def parse_layout(layout: str) -> (int, int, int):
+    """
+    :param layout: 'n_threads:intra_op_threads:inter_op_threads'
+    :return: (n_threads, intra_op_threads, inter_op_threads)
+    """
+    values = [int(v) for v in layout.split(':')]
+    assert len(values) == 3, 'Layout should be formatted as n_threads:intra_op_threads:inter_op_threads'
+    return tuple(values)
+
+
+def benchmark_layout(model_dir: str, images: list, n_threads: int, intra_op_threads: int, inter_op_threads: int,
+                     n_warmup: int=2) -> dict:
+    """
+    Measures the throughput of the model for a thread layout
+
+    :param model_dir: directory of the exported model
+    :param images: list of decoded images [H,W,3]
+    :param n_threads: number of concurrent runs
+    :param intra_op_threads: intra-op threads of the session (0 for TF default)
+    :param inter_op_threads: inter-op threads of the session (0 for TF default)
+    :param n_warmup: number of runs before timing
+    :return: dict with the layout and the measured throughput
+    """
+    config = make_session_config(intra_op_threads, inter_op_threads)
+    with ModelRegistry(session_config=config) as registry:
+        model = registry.get(model_dir, predict_mode='image', num_parallel_predictions=n_threads)
+        with ParallelPredictor(model, prediction_key='probs') as predictor:
+            for _ in predictor.map(images[:n_warmup]):
+                pass
+            start = time.time()
+            for _ in predictor.map(images):
+                pass
+            duration = time.time() - start
+        registry.release(model)
+
+    return {'n_threads': n_threads,
+            'intra_op_threads': intra_op_threads,
+            'inter_op_threads': inter_op_threads,
+            'n_images': len(images),
+            'duration': duration,
+            'images_per_second': len(images) / duration}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_dir', type=str, required=True,
+                        help='Directory of the exported model (or of its exports)')
+    parser.add_argument('-l', '--layouts', type=str, nargs='+', default=['1:0:0', '2:0:0', '4:0:0'],
+                        help='Thread layouts to compare, as n_threads:intra_op_threads:inter_op_threads '
+                             '(0 for TF default)')
+    parser.add_argument('-i', '--input_dir', type=str, default=None,
+                        help='Folder of images to predict, random images are used if not given')
+    parser.add_argument('-n', '--n_images', type=int, default=32, help='Number of images to predict per layout')
+    parser.add_argument('-s', '--image_shape', type=int, nargs=2, default=[1200, 800],
+                        help='Shape (h, w) of the random images')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file to save the results')
+    args = vars(parser.parse_args())
+
+    if args.get('input_dir'):
+        filenames = sorted(glob(os.path.join(args.get('input_dir'), '*.jpg')) +
+                           glob(os.path.join(args.get('input_dir'), '*.png')))[:args.get('n_images')]
+        images = [imread(f, mode='RGB') for f in filenames]
+    else:
+        h, w = args.get('image_shape')
+        images = [np.random.randint(0, 256, size=[h, w, 3]).astype(np.uint8) for _ in range(args.get('n_images'))]
+
+    results = list()
+    print('{:>10} {:>10} {:>10} {:>12}'.format('threads', 'intra_op', 'inter_op', 'images/s'))
+    for layout in args.get('layouts'):
+        result = benchmark_layout(args.get('model_dir'), images, *parse_layout(layout))
+        print('{n_threads:>10} {intra_op_threads:>10} {inter_op_threads:>10} {images_per_second:>12.2f}'.format(
+            **result))
+        results.append(result)
+
+    if args.get('output'):
+        with open(args.get('output'), 'w') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'results': results}, f, indent=4)
@@ -2,7 +2,7 @@ import tensorflow as tf
 from .utils import PredictionType, class_to_label_image, ModelParams, TrainingParams
 from . import utils
 import numpy as np
-from .model import inference_resnet_v1_50, inference_vgg16, inference_u_net
+from .model import inference_resnet_v1_50, inference_vgg16, inference_u_net, inference_mobilenet_v1
 
 
 def model_fn(mode, features, labels, params):
@@ -11,44 +11,40 @@ def model_fn(mode, features, labels, params):
     prediction_type = params['prediction_type']
     classes_file = params['classes_file']
 
-    input_images = features['images']
-
-    if mode == tf.estimator.ModeKeys.PREDICT:
-        margin = training_params.training_margin
-        input_images = tf.pad(input_images, [[0, 0], [margin, margin], [margin, margin], [0, 0]],
-                              mode='SYMMETRIC', name='mirror_padding')
-
     if model_params.pretrained_model_name == 'vgg16':
-        network_output = inference_vgg16(input_images,
-                                         model_params,
-                                         model_params.n_classes,
-                                         use_batch_norm=model_params.batch_norm,
-                                         weight_decay=model_params.weight_decay,
-                                         is_training=(mode == tf.estimator.ModeKeys.TRAIN)
-                                         )
-        key_restore_model = 'vgg_16'
-
+        inference_fn, key_restore_model = inference_vgg16, 'vgg_16'
     elif model_params.pretrained_model_name == 'resnet50':
-        network_output = inference_resnet_v1_50(input_images,
-                                                model_params,
-                                                model_params.n_classes,
-                                                use_batch_norm=model_params.batch_norm,
-                                                weight_decay=model_params.weight_decay,
-                                                is_training=(mode == tf.estimator.ModeKeys.TRAIN)
-                                                )
-        key_restore_model = 'resnet_v1_50'
+        inference_fn, key_restore_model = inference_resnet_v1_50, 'resnet_v1_50'
+    elif model_params.pretrained_model_name == 'mobilenet_v1':
+        inference_fn, key_restore_model = inference_mobilenet_v1, 'MobilenetV1'
     elif model_params.pretrained_model_name == 'unet':
-        network_output = inference_u_net(input_images,
-                                         model_params,
-                                         model_params.n_classes,
-                                         use_batch_norm=model_params.batch_norm,
-                                         weight_decay=model_params.weight_decay,
-                                         is_training=(mode == tf.estimator.ModeKeys.TRAIN)
-                                         )
-        key_restore_model = None
+        inference_fn, key_restore_model = inference_u_net, None
     else:
         raise NotImplementedError
 
+    def _network_output(input_images):
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            margin = training_params.training_margin
+            input_images = tf.pad(input_images, [[0, 0], [margin, margin], [margin, margin], [0, 0]],
+                                  mode='SYMMETRIC', name='mirror_padding')
+
+        network_output = inference_fn(input_images,
+                                      model_params,
+                                      model_params.n_classes,
+                                      use_batch_norm=model_params.batch_norm,
+                                      weight_decay=model_params.weight_decay,
+                                      is_training=(mode == tf.estimator.ModeKeys.TRAIN)
+                                      )
+
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            margin = training_params.training_margin
+            # Crop padding
+            if margin > 0:
+                network_output = network_output[:, margin:-margin, margin:-margin, :]
+        return network_output
+
+    network_output = _network_output(features['images'])
+
     if mode == tf.estimator.ModeKeys.TRAIN:
         if key_restore_model is not None:
             # Pretrained weights as initialization
@@ -62,28 +58,27 @@ def model_fn(mode, features, labels, params):
     else:
         init_fn = None
 
-    if mode == tf.estimator.ModeKeys.PREDICT:
-        margin = training_params.training_margin
-        # Crop padding
-        if margin > 0:
-            network_output = network_output[:, margin:-margin, margin:-margin, :]
-
     # Prediction
     # ----------
-    if prediction_type == PredictionType.CLASSIFICATION:
-        prediction_probs = tf.nn.softmax(network_output, name='softmax')
-        prediction_labels = tf.argmax(network_output, axis=-1, name='label_preds')
-        predictions = {'probs': prediction_probs, 'labels': prediction_labels}
-    elif prediction_type == PredictionType.REGRESSION:
-        predictions = {'output_values': network_output}
-        prediction_labels = network_output
-    elif prediction_type == PredictionType.MULTILABEL:
-        with tf.name_scope('prediction_ops'):
-            prediction_probs = tf.nn.sigmoid(network_output, name='sigmoid')  # [B,H,W,C]
-            prediction_labels = tf.cast(tf.greater_equal(prediction_probs, 0.5, name='labels'), tf.int32)  # [B,H,W,C]
-            predictions = {'probs': prediction_probs, 'labels': prediction_labels}
-    else:
-        raise NotImplementedError
+    def _predictions(network_output) -> dict:
+        if prediction_type == PredictionType.CLASSIFICATION:
+            prediction_probs = tf.nn.softmax(network_output, name='softmax')
+            prediction_labels = tf.argmax(network_output, axis=-1, name='label_preds')
+            return {'probs': prediction_probs, 'labels': prediction_labels}
+        elif prediction_type == PredictionType.REGRESSION:
+            return {'output_values': network_output}
+        elif prediction_type == PredictionType.MULTILABEL:
+            with tf.name_scope('prediction_ops'):
+                prediction_probs = tf.nn.sigmoid(network_output, name='sigmoid')  # [B,H,W,C]
+                prediction_labels = tf.cast(tf.greater_equal(prediction_probs, 0.5, name='labels'),
+                                            tf.int32)  # [B,H,W,C]
+                return {'probs': prediction_probs, 'labels': prediction_labels}
+        else:
+            raise NotImplementedError
+
+    predictions = _predictions(network_output)
+    prediction_probs = predictions.get('probs')
+    prediction_labels = predictions.get('labels', network_output)
 
     # Loss
     # ----
@@ -240,11 +235,33 @@ def model_fn(mode, features, labels, params):
                     resized_predictions[k] = v2
                 export_outputs['resized_output'] = tf.estimator.export.PredictOutput(resized_predictions)
 
+            with tf.name_scope('CompactOutput'):
+                # Predictions at network resolution, probabilities quantized to uint8,
+                # upscaling is left to post-processing (see post_processing.upscaling)
+                compact_predictions = dict()
+                for k, v in predictions.items():
+                    if k == 'probs':
+                        v = tf.saturate_cast(tf.round(255 * v), tf.uint8)
+                    elif k == 'labels':
+                        v = tf.saturate_cast(v, tf.uint8)
+                    compact_predictions[k] = v
+                compact_predictions['original_shape'] = features['original_shape']
+                compact_predictions['scale'] = tf.divide(tf.to_float(features['original_shape']),
+                                                         tf.to_float(tf.shape(network_output)[1:3]), name='scale')
+                export_outputs['compact_output'] = tf.estimator.export.PredictOutput(compact_predictions)
+
             predictions['original_shape'] = features['original_shape']
 
         export_outputs['output'] = tf.estimator.export.PredictOutput(predictions)
 
         export_outputs[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY] = export_outputs['output']
+
+        # Static-shape towers sharing the variables of the model, one per fixed input shape
+        # (see input.serving_input_filename)
+        for key in sorted(k for k in features.keys() if k.startswith('static_')):
+            assert key_restore_model is not None, 'Static-shape exports need named layers, not available for U-Net'
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True), tf.name_scope(key):
+                export_outputs[key] = tf.estimator.export.PredictOutput(_predictions(_network_output(features[key])))
     else:
         export_outputs = None
 
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""
+Export of a trained model optimised for inference : the variables are frozen into constants, the nodes that are not
+needed by the serving signatures are removed and the batch normalizations are folded into the weights of the preceding
+convolutions.
+The exports can also be quantized (see `quantize_export`).
+The result is a SavedModel with the same signatures, which can be loaded with `LoadedModel`.
+
+python -m dh_segment.inference_export -m <model_dir>/export/<timestamp> -o <output_dir> --report report.json
+python -m dh_segment.inference_export -m <model_dir>/export/<timestamp> -o <output_dir> \\
+    --quantize weights_int8 full_int8 --calibration_dir <dir of pages> --eval_dir <dir of pages> --report report.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from glob import glob
+import numpy as np
+import tensorflow as tf
+from scipy.misc import imread
+from tqdm import tqdm
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+from .loader import LoadedModel, _find_export_dir, _signature_def_to_tensors, make_session_config
+
+# Order matters : identities of the frozen variables are folded into constants before the batch norms can be folded
+_TRANSFORMS = [
+    'remove_attribute(attribute_name=_class)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order'
+]
+
+QUANTIZATION_MODES = ['weights_int8', 'weights_float16', 'full_int8']
+
+
+def _node_name(tensor_name: str) -> str:
+    return tensor_name.lstrip('^').split(':')[0]
+
+
+def _signature_nodes(signature_defs) -> (list, list):
+    inputs, outputs = set(), set()
+    for signature_def in signature_defs.values():
+        inputs.update(_node_name(t.name) for t in signature_def.inputs.values())
+        outputs.update(_node_name(t.name) for t in signature_def.outputs.values())
+    return sorted(inputs), sorted(outputs)
+
+
+def _optimized_graph_def(export_dir: str) -> (tf.GraphDef, dict, list, list):
+    # (frozen and folded GraphDef, signature defs, input nodes, output nodes)
+    export_dir = _find_export_dir(export_dir)
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph, config=make_session_config()) as sess:
+        meta_graph_def = tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+        signature_defs = dict(meta_graph_def.signature_def)
+        input_nodes, output_nodes = _signature_nodes(signature_defs)
+        frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_nodes)
+
+    graph_def = TransformGraph(frozen_graph_def, input_nodes, output_nodes, _TRANSFORMS)
+    return graph_def, signature_defs, input_nodes, output_nodes
+
+
+def _save_graph_def(graph_def: tf.GraphDef, signature_defs: dict, output_dir: str) -> str:
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+        tf.import_graph_def(graph_def, name='')
+        builder = tf.saved_model.builder.SavedModelBuilder(output_dir)
+        builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING],
+                                             signature_def_map=signature_defs, clear_devices=True)
+        builder.save()
+    return output_dir
+
+
+def export_for_inference(export_dir: str, output_dir: str) -> str:
+    """
+    Writes the frozen and folded version of an exported model
+
+    :param export_dir: directory of the SavedModel (as exported by train.py)
+    :param output_dir: directory of the new SavedModel (must not exist)
+    :return: `output_dir`
+    """
+    graph_def, signature_defs, _, _ = _optimized_graph_def(export_dir)
+    return _save_graph_def(graph_def, signature_defs, output_dir)
+
+
+def weights_to_float16(graph_def: tf.GraphDef, minimum_size: int=1024) -> tf.GraphDef:
+    """
+    Stores the float32 constants of at least `minimum_size` elements as float16, each followed by a cast back to
+    float32 under the original name of the constant. This only makes the export smaller : the casts are
+    constant-folded when the graph is loaded, so the model still runs in float32.
+
+    :param graph_def: frozen graph
+    :param minimum_size: smaller constants (biases, shapes...) are kept in float32
+    :return: the modified GraphDef
+    """
+    graph_def_out = tf.GraphDef()
+    for node in graph_def.node:
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+            if value.size >= minimum_size:
+                const_node = graph_def_out.node.add()
+                const_node.name = node.name + '/float16'
+                const_node.op = 'Const'
+                const_node.attr['dtype'].type = tf.float16.as_datatype_enum
+                const_node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value.astype(np.float16)))
+                cast_node = graph_def_out.node.add()
+                cast_node.name = node.name
+                cast_node.op = 'Cast'
+                cast_node.input.append(const_node.name)
+                cast_node.attr['SrcT'].type = tf.float16.as_datatype_enum
+                cast_node.attr['DstT'].type = tf.float32.as_datatype_enum
+                continue
+        graph_def_out.node.add().CopyFrom(node)
+    graph_def_out.library.CopyFrom(graph_def.library)
+    graph_def_out.versions.CopyFrom(graph_def.versions)
+    return graph_def_out
+
+
+def _load_rgb(filename_or_array) -> np.ndarray:
+    return imread(filename_or_array, mode='RGB') if isinstance(filename_or_array, str) else filename_or_array
+
+
+def calibrate_requantization_ranges(graph_def: tf.GraphDef, signature_def, calibration_images: list,
+                                    min_max_log_file: str) -> str:
+    """
+    Runs a graph given by the 'quantize_nodes' transform on calibration images and writes the observed ranges of
+    its RequantizationRange nodes, in the log format read by the 'freeze_requantization_ranges' transform.
+
+    :param graph_def: graph with quantized nodes (ranges computed at run time)
+    :param signature_def: the 'from_image:serving_default' signature, used to feed the images
+    :param calibration_images: filenames or RGB images [H,W,3], a few hundred pages are usually enough
+    :param min_max_log_file: file to write
+    :return: `min_max_log_file`
+    """
+    ranges = OrderedDict()
+    with tf.Graph().as_default() as graph, tf.Session(graph=graph, config=make_session_config()) as sess:
+        tf.import_graph_def(graph_def, name='')
+        input_dict, _ = _signature_def_to_tensors(signature_def, graph)
+        requantization_ranges = [op for op in graph.get_operations() if op.type == 'RequantizationRange']
+        for image in tqdm(calibration_images, desc='Calibration'):
+            image = _load_rgb(image)
+            feed_dict = {input_dict['image']: image}
+            if 'original_shape' in input_dict:
+                feed_dict[input_dict['original_shape']] = image.shape[:2]
+            values = sess.run([[op.outputs[0], op.outputs[1]] for op in requantization_ranges], feed_dict=feed_dict)
+            for op, (min_value, max_value) in zip(requantization_ranges, values):
+                previous_min, previous_max = ranges.get(op.name, (min_value, max_value))
+                ranges[op.name] = (min(previous_min, min_value), max(previous_max, max_value))
+
+    with open(min_max_log_file, 'w') as f:
+        for name, (min_value, max_value) in ranges.items():
+            f.write(';{}__print__;__requant_min_max:[{}][{}]\n'.format(name, min_value, max_value))
+    return min_max_log_file
+
+
+def quantize_export(export_dir: str, output_dir: str, mode: str='weights_int8', calibration_images: list=None) -> str:
+    """
+    Writes a quantized version of an exported model, with the same signatures (it can be loaded with `LoadedModel`).
+    The graph is first frozen and folded as in `export_for_inference`.
+
+    - 'weights_int8' : weights stored as 8 bits and dequantized when the graph is loaded, the export is 4x smaller
+    - 'weights_float16' : weights stored as float16, the export is 2x smaller. The casts back to float32 are
+        constant-folded when the graph is loaded, so the computations stay in float32 and the latency is unchanged
+    - 'full_int8' : convolutions, matrix products, activations and poolings run in 8 bits, with the ranges of the
+        activations calibrated on `calibration_images`. This may reduce the latency, but the Requantize/Dequantize
+        ops between the quantized kernels can also make it slower than float on CPU : check with `quantization_report`
+
+    :param export_dir: directory of the SavedModel (as exported by train.py)
+    :param output_dir: directory of the new SavedModel (must not exist)
+    :param mode: one of `QUANTIZATION_MODES`
+    :param calibration_images: filenames or RGB images [H,W,3], needed for 'full_int8'
+    :return: `output_dir`
+    """
+    assert mode in QUANTIZATION_MODES, "Unknown quantization mode {} (possible values: {})".format(
+        mode, QUANTIZATION_MODES)
+    graph_def, signature_defs, input_nodes, output_nodes = _optimized_graph_def(export_dir)
+
+    if mode == 'weights_int8':
+        graph_def = TransformGraph(graph_def, input_nodes, output_nodes, ['quantize_weights'])
+    elif mode == 'weights_float16':
+        graph_def = weights_to_float16(graph_def)
+    elif mode == 'full_int8':
+        assert calibration_images, "'full_int8' needs calibration images"
+        graph_def = TransformGraph(graph_def, input_nodes, output_nodes, ['quantize_nodes'])
+        min_max_log_file = os.path.join(tempfile.mkdtemp(prefix='dhsegment_calibration_'), 'min_max_log.txt')
+        calibrate_requantization_ranges(graph_def, signature_defs['from_image:serving_default'],
+                                        calibration_images, min_max_log_file)
+        graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                                   ['freeze_requantization_ranges(min_max_log_file="{}")'.format(min_max_log_file),
+                                    'fold_constants(ignore_errors=true)'])
+    return _save_graph_def(graph_def, signature_defs, output_dir)
+
+
+def _export_size(export_dir: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(export_dir) for f in files)
+
+
+def _mean_iou(labels: np.ndarray, reference_labels: np.ndarray) -> float:
+    ious = list()
+    for c in np.union1d(np.unique(labels), np.unique(reference_labels)):
+        intersection = np.sum(np.logical_and(labels == c, reference_labels == c))
+        union = np.sum(np.logical_or(labels == c, reference_labels == c))
+        ious.append(intersection / union)
+    return float(np.mean(ious))
+
+
+def quantization_report(reference_export_dir: str, export_dirs: dict, images: list, num_threads: int=0) -> dict:
+    """
+    Compares exports with a reference (float) export on CPU : latency, size, and agreement of the predictions
+    with the ones of the reference (mean IoU of the labels with the labels of the reference, difference of the
+    probabilities). The agreement is not an accuracy, no ground truth being used
+
+    :param reference_export_dir: directory of the reference export
+    :param export_dirs: dict name : directory of the export to compare
+    :param images: filenames or RGB images [H,W,3]
+    :param num_threads: number of intra-op threads, 0 for TF default
+    :return: dict name : results, the reference included (as 'reference')
+    """
+    images = [_load_rgb(image) for image in images]
+    config = make_session_config(intra_op_threads=num_threads)
+    config.device_count['GPU'] = 0
+
+    report, reference_outputs = OrderedDict(), None
+    for name, model_dir in [('reference', reference_export_dir)] + list(export_dirs.items()):
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph, config=config) as sess:
+            model = LoadedModel(model_dir, predict_mode='image', sess=sess)
+            model.predict(images[0])  # Warmup
+            outputs, start = list(), time.time()
+            for image in images:
+                outputs.append(model.predict(image))
+            latency = 1000 * (time.time() - start) / len(images)
+
+        result = {'latency_ms': latency, 'size_mb': _export_size(_find_export_dir(model_dir)) / 2 ** 20}
+        if reference_outputs is None:
+            reference_outputs = outputs
+        else:
+            result['speedup'] = report['reference']['latency_ms'] / latency
+            if 'probs' in outputs[0]:
+                result['max_abs_probs_difference'] = float(max(np.max(np.abs(o['probs'] - r['probs']))
+                                                               for o, r in zip(outputs, reference_outputs)))
+            if 'labels' in outputs[0]:
+                result['agreement_mean_iou'] = float(np.mean([_mean_iou(o['labels'], r['labels'])
+                                                    for o, r in zip(outputs, reference_outputs)]))
+        report[name] = result
+    return report
+
+
+def compare_latency(export_dir: str, optimized_export_dir: str, image_shape: tuple=(1000, 700),
+                    n_runs: int=10, n_warmup: int=2, num_threads: int=0) -> dict:
+    """
+    Times the prediction of a random image on CPU with both exports, and compares their outputs
+
+    :param export_dir: directory of the original export
+    :param optimized_export_dir: directory of the export given by `export_for_inference`
+    :param image_shape: (h, w) of the random image
+    :param n_runs: number of timed predictions
+    :param n_warmup: number of predictions before timing
+    :param num_threads: number of intra-op threads, 0 for TF default
+    :return: dict with the mean latency (ms) of each export and the maximum difference of the outputs
+    """
+    image = np.random.RandomState(0).randint(0, 256, list(image_shape) + [3]).astype(np.uint8)
+    config = make_session_config(intra_op_threads=num_threads)
+    config.device_count['GPU'] = 0
+
+    report, outputs = dict(), dict()
+    for key, model_dir in [('original', export_dir), ('optimized', optimized_export_dir)]:
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph, config=config) as sess:
+            model = LoadedModel(model_dir, predict_mode='image', sess=sess)
+            outputs[key] = model.predict(image)
+            for _ in range(n_warmup):
+                model.predict(image)
+            start = time.time()
+            for _ in range(n_runs):
+                model.predict(image)
+            report['{}_ms'.format(key)] = 1000 * (time.time() - start) / n_runs
+
+    report['speedup'] = report['original_ms'] / report['optimized_ms']
+    report['max_abs_difference'] = {k: float(np.max(np.abs(np.float64(v) - np.float64(outputs['optimized'][k]))))
+                                    for k, v in outputs['original'].items()}
+    return report
+
+
+def _list_images(directory: str, n_images: int=None) -> list:
+    return sorted(glob(os.path.join(directory, '*.jpg')) + glob(os.path.join(directory, '*.png')))[:n_images]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_dir', type=str, required=True, help='Directory of the exported model')
+    parser.add_argument('-o', '--output_dir', type=str, required=True,
+                        help='Directory of the optimised export (of one export per mode with --quantize)')
+    parser.add_argument('-q', '--quantize', type=str, nargs='+', default=None, choices=QUANTIZATION_MODES,
+                        help='Quantization modes, each export is written to <output_dir>/<mode>')
+    parser.add_argument('--calibration_dir', type=str, default=None, help='Directory of pages to calibrate full_int8')
+    parser.add_argument('--n_calibration', type=int, default=200, help='Maximum number of calibration pages')
+    parser.add_argument('--eval_dir', type=str, default=None,
+                        help='Directory of pages to compare the quantized exports with the original one')
+    parser.add_argument('--n_eval', type=int, default=50, help='Maximum number of evaluation pages')
+    parser.add_argument('-s', '--image_shape', type=int, nargs=2, default=[1000, 700],
+                        help='Shape (h, w) of the image used to compare the latencies')
+    parser.add_argument('-n', '--n_runs', type=int, default=10, help='Number of timed predictions (0 to skip)')
+    parser.add_argument('-t', '--num_threads', type=int, default=0, help='Number of intra-op threads')
+    parser.add_argument('--report', type=str, default=None, help='JSON file to save the comparison')
+    args = vars(parser.parse_args())
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    if args.get('quantize'):
+        calibration_images = _list_images(args.get('calibration_dir'), args.get('n_calibration')) \
+            if args.get('calibration_dir') else None
+        export_dirs = OrderedDict()
+        for mode in args.get('quantize'):
+            export_dirs[mode] = quantize_export(args.get('model_dir'), os.path.join(args.get('output_dir'), mode), mode,
+                                                calibration_images)
+            print('Exported to {}'.format(export_dirs[mode]))
+
+        if args.get('eval_dir'):
+            result = quantization_report(args.get('model_dir'), export_dirs,
+                                         _list_images(args.get('eval_dir'), args.get('n_eval')),
+                                         num_threads=args.get('num_threads'))
+            print('{:>16} {:>12} {:>10} {:>10} {:>26}'.format('export', 'latency (ms)', 'size (MB)', 'speedup',
+                                                              'agreement mIoU vs float'))
+            for name, r in result.items():
+                print('{:>16} {:>12.1f} {:>10.1f} {:>10.2f} {:>26.4f}'.format(name, r['latency_ms'], r['size_mb'],
+                                                                            r.get('speedup', 1.),
+                                                                            r.get('agreement_mean_iou', 1.)))
+            if args.get('report'):
+                with open(args.get('report'), 'w') as f:
+                    json.dump({'args': args, 'quantization': result}, f, indent=4)
+    else:
+        export_for_inference(args.get('model_dir'), args.get('output_dir'))
+        print('Exported to {}'.format(args.get('output_dir')))
+
+        if args.get('n_runs') > 0:
+            result = compare_latency(args.get('model_dir'), args.get('output_dir'), tuple(args.get('image_shape')),
+                                     args.get('n_runs'), num_threads=args.get('num_threads'))
+            print('original : {original_ms:.1f} ms, optimized : {optimized_ms:.1f} ms '
+                  '({speedup:.2f}x)'.format(**result))
+            print('max abs difference : {}'.format(result['max_abs_difference']))
+            if args.get('report'):
+                with open(args.get('report'), 'w') as f:
+                    json.dump({'args': args, 'latency': result}, f, indent=4)
@@ -4,13 +4,22 @@ import tensorflow as tf
 import numpy as np
 from . import utils
 from tqdm import tqdm
-from random import shuffle
-from .input_utils import data_augmentation_fn, extract_patches_fn, load_and_resize_image, \
-    rotate_crop, resize_image, local_entropy
+from threading import Lock
+from .input_utils import data_augmentation_fn, batch_augmentation_fn, load_and_resize_image, grid_patches_positions, \
+    random_patches_positions, crop_patch, rotate_crop, resize_image, local_entropy, decode_and_downscale_image, \
+    decode_and_resize_image
+from .input_cache import compile_dataset_cache, cached_dataset, has_weight_maps, weight_maps_from_cache
 
 
 def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, data_augmentation=False,
-             batch_size=5, make_patches=False, num_epochs=None, num_threads=4, image_summaries=False):
+             batch_size=5, make_patches=False, num_epochs=None, num_threads=4, image_summaries=False,
+             cache_dir=None, data_order=None):
+    """
+    :param cache_dir: if set (and labels are given), the resized images and the class labels are read from a cache
+        in this directory, which is compiled the first time (see `input_cache.compile_dataset_cache`)
+    :param data_order: `DataOrder` giving the (resumable) order of the labelled images, if None they are shuffled
+        randomly at every epoch
+    """
     training_params = utils.TrainingParams.from_dict(params['training_params'])
     prediction_type = params['prediction_type']
     classes_file = params['classes_file']
@@ -19,8 +28,8 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
     if isinstance(input_image_dir_or_filenames, list):
         input_images = input_image_dir_or_filenames
     else:
-        input_images = glob(os.path.join(input_image_dir_or_filenames, '**', '*.jpg'), recursive=True) + \
-                       glob(os.path.join(input_image_dir_or_filenames, '**', '*.png'), recursive=True)
+        input_images = sorted(glob(os.path.join(input_image_dir_or_filenames, '**', '*.jpg'), recursive=True) +
+                              glob(os.path.join(input_image_dir_or_filenames, '**', '*.png'), recursive=True))
     print('Found {} images'.format(len(input_images)))
 
     # Finding the list of labelled images if available
@@ -37,33 +46,92 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
 
             label_images.append(label_image_filename)
 
-    def make_patches_fn(input_image: tf.Tensor, label_image: tf.Tensor, offsets: tuple) -> (tf.Tensor, tf.Tensor):
-        with tf.name_scope('patching'):
-            patches_image = extract_patches_fn(input_image, training_params.patch_shape, offsets)
-            patches_label = extract_patches_fn(label_image, training_params.patch_shape, offsets)
+    use_cache = cache_dir is not None and input_label_dir is not None
+    # Patches have the same shape, they are augmented by batch
+    batch_augmentation = data_augmentation and make_patches and input_label_dir is not None
+    if use_cache:
+        cache_path = compile_dataset_cache(input_images, label_images, params, cache_dir, num_threads=num_threads)
 
-            return patches_image, patches_label
+    def make_patches_fn(input_image: tf.Tensor, label_image: tf.Tensor) -> tf.data.Dataset:
+        # Patches are cropped lazily, one at a time
+        with tf.name_scope('patching'):
+            patch_shape = training_params.patch_shape
+            if training_params.patch_sampling == 'grid':
+                # Offsets for patch extraction
+                offsets = (tf.random_uniform(shape=[], minval=0, maxval=1, dtype=tf.float32),
+                           tf.random_uniform(shape=[], minval=0, maxval=1, dtype=tf.float32))
+                positions = tf.data.Dataset.from_tensor_slices(
+                    grid_patches_positions(tf.shape(input_image)[:2], patch_shape, offsets))
+            elif training_params.patch_sampling in ['random', 'class_balanced']:
+                # No patch if the image is smaller than a patch (as with the grid)
+                n_patches = tf.where(tf.reduce_all(tf.shape(input_image)[:2] >= np.array(patch_shape, np.int32)),
+                                     tf.constant(training_params.n_patches_per_image, tf.int64),
+                                     tf.constant(0, tf.int64))
+                # The cached weight maps are not labels
+                labels_only = label_image[:, :, :-1] if use_cache and has_weight_maps(params) else label_image
+                # All the positions are drawn at once, the labels being grouped only once per image
+                positions = tf.data.Dataset.from_tensor_slices(
+                    random_patches_positions(labels_only, patch_shape, n_patches,
+                                             training_params.patch_sampling == 'class_balanced'))
+            else:
+                raise NotImplementedError('Unknown patch sampling : {}'.format(training_params.patch_sampling))
+
+            return positions.map(lambda position: (crop_patch(input_image, position, patch_shape),
+                                                   crop_patch(label_image, position, patch_shape)))
 
     # Tensorflow input_fn
     def fn():
         if not input_label_dir:
-            encoded_filenames = [f.encode() for f in input_images]
-            dataset = tf.data.Dataset.from_generator(lambda: tqdm(encoded_filenames, desc='Dataset'),
-                                                     tf.string, tf.TensorShape([]))
+            # The order of the images is kept
+            dataset = tf.data.Dataset.from_tensor_slices(input_images)
             dataset = dataset.repeat(count=num_epochs)
+            dataset = _count_progress(dataset, len(input_images) * num_epochs if num_epochs else None)
             dataset = dataset.map(lambda filename: {'images':
                                                         load_and_resize_image(filename, 3,
-                                                                              training_params.input_resized_size)})
-        else:
-            # Filenames
-            encoded_filenames = [(i.encode(), l.encode()) for i, l in zip(input_images, label_images)]
-            shuffle(encoded_filenames)
-            dataset = tf.data.Dataset.from_generator(lambda: tqdm(encoded_filenames, desc='Dataset'),
-                                                     (tf.string, tf.string), (tf.TensorShape([]), tf.TensorShape([])))
-            dataset = dataset.repeat(count=num_epochs)
+                                                                              training_params.input_resized_size)},
+                                  num_threads)
+        elif use_cache:
+            # Images already resized, labels already converted to classes
+            if data_order is not None:
+                assert len(input_images) == data_order.n_images, \
+                    'The number of images changed, the order cannot be resumed'
+                dataset = data_order.epochs_dataset(
+                    lambda seed: cached_dataset(cache_path, num_threads=num_threads, seed=seed), num_epochs)
+            else:
+                dataset = cached_dataset(cache_path, num_threads=num_threads)
+                dataset = dataset.repeat(count=num_epochs)
+
+            def _map_fn_1_cached(input_image, label_image):
+                if training_params.data_augmentation and training_params.input_resized_size > 0:
+                    random_scaling = tf.random_uniform([],
+                                                       np.maximum(1 - training_params.data_augmentation_max_scaling, 0),
+                                                       1 + training_params.data_augmentation_max_scaling)
+                    new_size = tf.to_float(tf.reduce_prod(tf.shape(input_image)[:2])) * random_scaling
+                    input_image = resize_image(input_image, new_size)
+                    label_image = resize_image(label_image, new_size, interpolation='NEAREST')
+                return input_image, tf.to_float(label_image)
 
-            # Load and resize images
-            def _map_fn_1(image_filename, label_filename):
+            dataset = dataset.map(_map_fn_1_cached, num_threads)
+        else:
+            # Filenames, shuffled at every epoch
+            if data_order is not None:
+                dataset = data_order.dataset(input_images, label_images, num_epochs=num_epochs)
+            else:
+                dataset = tf.data.Dataset.from_tensor_slices((input_images, label_images))
+                dataset = dataset.shuffle(len(input_images), reshuffle_each_iteration=True)
+                dataset = dataset.repeat(count=num_epochs)
+            # When resuming, the images already read in the current epoch are skipped
+            n_skipped = data_order.position if data_order is not None else 0
+            dataset = _count_progress(dataset, len(input_images) * num_epochs - n_skipped if num_epochs else None)
+
+            # Read the files in parallel
+            dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+                lambda image_filename, label_filename: tf.data.Dataset.from_tensors((tf.read_file(image_filename),
+                                                                                     tf.read_file(label_filename))),
+                cycle_length=num_threads))
+
+            # Decode and resize images
+            def _map_fn_1(encoded_image, encoded_label):
                 if training_params.data_augmentation and training_params.input_resized_size > 0:
                     random_scaling = tf.random_uniform([],
                                                        np.maximum(1 - training_params.data_augmentation_max_scaling, 0),
@@ -73,19 +141,20 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
                     new_size = training_params.input_resized_size
 
                 if prediction_type in [utils.PredictionType.CLASSIFICATION, utils.PredictionType.MULTILABEL]:
-                    label_image = load_and_resize_image(label_filename, 3, new_size, interpolation='NEAREST')
+                    label_image = decode_and_resize_image(encoded_label, 3, new_size, interpolation='NEAREST')
                 elif prediction_type == utils.PredictionType.REGRESSION:
-                    label_image = load_and_resize_image(label_filename, 1, new_size, interpolation='NEAREST')
+                    label_image = decode_and_resize_image(encoded_label, 1, new_size, interpolation='NEAREST')
                 else:
                     raise NotImplementedError
-                input_image = load_and_resize_image(image_filename, 3, new_size)
+                input_image = decode_and_resize_image(encoded_image, 3, new_size)
                 return input_image, label_image
 
             dataset = dataset.map(_map_fn_1, num_threads)
 
+        if input_label_dir:
             # Data augmentation, patching
             def _map_fn_2(input_image, label_image):
-                if data_augmentation:
+                if data_augmentation and not batch_augmentation:
                     # Rotation of the original image
                     if training_params.data_augmentation_max_rotation > 0:
                         with tf.name_scope('random_rotation'):
@@ -100,20 +169,17 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
                                                       interpolation='BILINEAR')
 
                 if make_patches:
-                    # Offsets for patch extraction
-                    offsets = (tf.random_uniform(shape=[], minval=0, maxval=1, dtype=tf.float32),
-                               tf.random_uniform(shape=[], minval=0, maxval=1, dtype=tf.float32))
-                    # offsets = (0, 0)
-                    batch_image, batch_label = make_patches_fn(input_image, label_image, offsets)
+                    return make_patches_fn(input_image, label_image)
                 else:
                     with tf.name_scope('formatting'):
                         batch_image = tf.expand_dims(input_image, axis=0)
                         batch_label = tf.expand_dims(label_image, axis=0)
-                return tf.data.Dataset.from_tensor_slices((batch_image, batch_label))
+                    return tf.data.Dataset.from_tensor_slices((batch_image, batch_label))
 
-            dataset = dataset.flat_map(_map_fn_2)
+            # Patches of several images are interleaved
+            dataset = dataset.interleave(_map_fn_2, cycle_length=num_threads if make_patches else 1, block_length=1)
 
-            if data_augmentation:
+            if data_augmentation and not batch_augmentation:
                 dataset = dataset.map(lambda input_image, label_image: data_augmentation_fn(input_image,
                                                                                             label_image,
                                                                                             training_params.data_augmentation_flip_lr,
@@ -122,14 +188,26 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
 
             # Assign color to class id
             def _map_fn_3(input_image, label_image):
-                # Convert RGB to class id
+                cached_weight_maps = None
+                if use_cache and has_weight_maps(params):
+                    # Weight maps precomputed on the full labels
+                    label_image, cached_weight_maps = label_image[:, :, :-1], label_image[:, :, -1]
+                # Convert RGB to class id (already done in the cache)
                 if prediction_type == utils.PredictionType.CLASSIFICATION:
-                    label_image = utils.label_image_to_class(label_image, classes_file)
+                    if use_cache:
+                        label_image = tf.to_int64(label_image[:, :, 0])
+                    else:
+                        label_image = utils.label_image_to_class(label_image, classes_file)
                 elif prediction_type == utils.PredictionType.MULTILABEL:
-                    label_image = utils.multilabel_image_to_class(label_image, classes_file)
+                    if use_cache:
+                        label_image = label_image > 0
+                    else:
+                        label_image = utils.multilabel_image_to_class(label_image, classes_file)
                 output = {'images': input_image, 'labels': label_image}
 
-                if training_params.local_entropy_ratio > 0 and prediction_type == utils.PredictionType.CLASSIFICATION:
+                if cached_weight_maps is not None:
+                    output['weight_maps'] = weight_maps_from_cache(cached_weight_maps)
+                elif training_params.local_entropy_ratio > 0 and prediction_type == utils.PredictionType.CLASSIFICATION:
                     output['weight_maps'] = local_entropy(tf.equal(label_image, 1),
                                                           sigma=training_params.local_entropy_sigma)
                 return output
@@ -155,7 +233,22 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
             padded_shapes['labels'] = base_shape_images + list(output_shapes_label[2:])
         if 'weight_maps' in dataset.output_shapes.keys():
             padded_shapes['weight_maps'] = base_shape_images
-        dataset = dataset.padded_batch(batch_size=batch_size, padded_shapes=padded_shapes)
+        if not make_patches and input_label_dir and batch_size > 1:
+            # Whole pages of similar aspect ratio and size are batched together to limit the padding
+            # (the order does not matter as the images are labelled)
+            dataset = dataset.apply(tf.contrib.data.group_by_window(
+                key_func=lambda d: _bucket_key(d['shapes']),
+                reduce_func=lambda _, window: window.padded_batch(batch_size=batch_size, padded_shapes=padded_shapes),
+                window_size=batch_size))
+        else:
+            dataset = dataset.padded_batch(batch_size=batch_size, padded_shapes=padded_shapes)
+        if batch_augmentation:
+            dataset = dataset.map(lambda batch: batch_augmentation_fn(batch,
+                                                                      training_params.data_augmentation_max_rotation,
+                                                                      training_params.data_augmentation_flip_lr,
+                                                                      training_params.data_augmentation_flip_ud,
+                                                                      training_params.data_augmentation_color),
+                                  num_threads)
         dataset = dataset.prefetch(4)
         iterator = dataset.make_one_shot_iterator()
         prepared_batch = iterator.get_next()
@@ -186,38 +279,214 @@ def input_fn(input_image_dir_or_filenames, params: dict, input_label_dir=None, d
     return fn
 
 
-def serving_input_filename(resized_size):
+class DataOrder:
+    """
+    Deterministic order of the training images : they are shuffled at every epoch with a seed derived from `seed` and
+    the epoch number. The position in the order is updated as the images are read, and can be saved with the
+    checkpoints (see `DataOrderSaverListener`) so that a training resumes where it stopped instead of replaying
+    an arbitrary order.
+
+    As the images are counted when they are read, the ones prefetched but not yet trained on when the state is saved
+    are skipped when resuming.
+    """
+    def __init__(self, n_images: int, seed: int=0, epoch: int=0, position: int=0):
+        """
+        :param n_images: number of images per epoch
+        :param seed: seed of the shuffling
+        :param epoch: current epoch
+        :param position: number of images already read in the current epoch
+        """
+        self.n_images = n_images
+        self.seed = seed
+        self.epoch = epoch
+        self.position = position
+        self._lock = Lock()
+
+    def dataset(self, *filenames, num_epochs: int=None) -> tf.data.Dataset:
+        """
+        :param filenames: lists of filenames (e.g. images and labels) of length `n_images`
+        :param num_epochs: number of epochs from the current position (None for infinite)
+        :return: dataset of the filenames in the order starting from the current position
+        """
+        assert all(len(f) == self.n_images for f in filenames), \
+            'The number of images changed, the order cannot be resumed'
+        files = tf.data.Dataset.from_tensor_slices(tuple(filenames))
+        return self.epochs_dataset(lambda seed: files.shuffle(self.n_images, seed=seed), num_epochs)
+
+    def epochs_dataset(self, epoch_dataset_fn, num_epochs: int=None) -> tf.data.Dataset:
+        """
+        :param epoch_dataset_fn: function seed -> dataset of the `n_images` elements of one epoch, whose order
+            only depends on the seed (e.g. `input_cache.cached_dataset`)
+        :param num_epochs: number of epochs from the current position (None for infinite)
+        :return: dataset of the elements in the order starting from the current position
+        """
+        last_epoch = self.epoch + num_epochs if num_epochs is not None else np.iinfo(np.int64).max
+        dataset = tf.data.Dataset.range(self.epoch, last_epoch).flat_map(
+            lambda epoch: epoch_dataset_fn(self.seed * 100003 + epoch))
+        dataset = dataset.skip(self.position)
+
+        def _count_fn(*element):
+            with tf.control_dependencies([tf.py_func(self._image_read, [], tf.int64, stateful=True)]):
+                return tuple(tf.identity(t) for t in element)
+
+        return dataset.map(_count_fn)
+
+    def _image_read(self):
+        with self._lock:
+            self.position += 1
+            if self.position >= self.n_images:
+                self.epoch, self.position = self.epoch + 1, 0
+            return np.int64(self.position)
+
+    def state(self) -> dict:
+        with self._lock:
+            return {'n_images': self.n_images, 'seed': self.seed, 'epoch': self.epoch, 'position': self.position}
+
+    def save(self, filename: str):
+        utils.dump_json(filename, self.state())
+
+    @classmethod
+    def load(cls, filename: str) -> 'DataOrder':
+        state = utils.parse_json(filename)
+        return cls(state['n_images'], state['seed'], state['epoch'], state['position'])
+
+
+class DataOrderSaverListener(tf.train.CheckpointSaverListener):
+    """
+    Saves the state of a `DataOrder` every time the estimator saves a checkpoint
+    """
+    def __init__(self, data_order: DataOrder, filename: str):
+        self.data_order = data_order
+        self.filename = filename
+
+    def after_save(self, session, global_step_value):
+        state = self.data_order.state()
+        state['global_step'] = int(global_step_value)
+        utils.dump_json(self.filename, state)
+
+
+def _bucket_key(shape: tf.Tensor) -> tf.Tensor:
+    """
+    Bucket of an image from its aspect ratio (steps of 2^(1/4)) and its number of pixels (steps of 2^(1/2))
+
+    :param shape: [H, W]
+    :return: int64 key
+    """
+    h, w = tf.to_float(shape[0]), tf.to_float(shape[1])
+    log2 = np.log(2)
+    aspect_ratio_bucket = tf.to_int64(tf.round(4 * tf.log(w / h) / log2))
+    area_bucket = tf.to_int64(tf.round(2 * tf.log(h * w) / log2))
+    return (aspect_ratio_bucket + 64) * 128 + area_bucket
+
+
+def _count_progress(dataset: tf.data.Dataset, total: int=None, desc: str='Dataset',
+                    update_every: int=100) -> tf.data.Dataset:
+    """
+    Displays the number of elements consumed from the dataset. The elements are counted in the pipeline (`scan`),
+    the progress bar being only updated through python every `update_every` elements, so that the GIL is not taken
+    for each element. The bar is closed once the `total` elements have been read.
+    """
+    progress_bar = tqdm(total=total, desc=desc)
+
+    def _update(count):
+        progress_bar.update(count - progress_bar.n)
+        if total is not None and count >= total:
+            progress_bar.close()
+        return count
+
+    def _count_fn(count, element):
+        count += 1
+        needs_update = tf.equal(count % update_every, 0)
+        if total is not None:
+            needs_update = tf.logical_or(needs_update, tf.greater_equal(count, total))
+        updated_count = tf.cond(needs_update,
+                                lambda: tf.py_func(_update, [count], tf.int64, stateful=True),
+                                lambda: count)
+        with tf.control_dependencies([updated_count]):
+            if isinstance(element, tuple):
+                return count, tuple(tf.identity(t) for t in element)
+            return count, tf.identity(element)
+
+    return dataset.apply(tf.contrib.data.scan(tf.constant(0, tf.int64), _count_fn))
+
+
+def serving_input_filename(resized_size, static_shapes: list=None):
+    """
+    :param resized_size: number of pixels of the images once resized, as in training (None or negative for no resizing)
+    :param static_shapes: list of [h, w], for each shape the model is also exported with a fixed input shape
+        [1, h, w, 3] (signatures 'static_<h>x<w>' and 'static_<h>x<w>:static_<h>x<w>'), so that the shapes of the whole
+        graph are known. By default the image is resized to this shape, `static_input_shape` gives the shape
+        corresponding to `resized_size` for an aspect ratio
+    :return: the serving input function
+    """
     def serving_input_fn():
         # define placeholder for filename
         filename = tf.placeholder(dtype=tf.string)
 
-        # TODO : make it batch-compatible (with Dataset or string input producer)
-        decoded_image = tf.to_float(tf.image.decode_jpeg(tf.read_file(filename), channels=3,
-                                                         try_recover_truncated=True))
-        original_shape = tf.shape(decoded_image)[:2]
-
+        # Each input below defaults to the previous one, so that the graph can be fed at any of these levels
+        # Content of an image file (JPEG, PNG, BMP)
+        encoded_image = tf.placeholder_with_default(tf.read_file(filename), [], name='encoded_image')
+        # JPEG images are already downscaled while decoding
+        decoded_image, decoded_original_shape = decode_and_downscale_image(encoded_image, resized_size)
+        # When an image is fed directly, its original shape has to be fed as well
+        original_shape = tf.placeholder_with_default(decoded_original_shape, [2], name='original_shape')
+        float_image = tf.placeholder_with_default(tf.to_float(decoded_image), [None, None, 3], name='image')
+        uint8_image = tf.placeholder_with_default(tf.saturate_cast(float_image, tf.uint8), [None, None, 3],
+                                                  name='uint8_image')
+
+        # Batch of images sharing the same shape (padded by the client), defaults to the decoded image
+        image_batch = tf.placeholder_with_default(uint8_image[None], [None, None, None, 3], name='image_batch')
+
+        # Images are resized before being cast to float
         if resized_size is not None and resized_size > 0:
-            image = resize_image(decoded_image, resized_size)
+            image_batch_resized = resize_image(image_batch, resized_size)
         else:
-            image = decoded_image
+            image_batch_resized = tf.to_float(image_batch)
 
-        image_batch = image[None]
-        features = {'images': image_batch, 'original_shape': original_shape}
+        features = {'images': image_batch_resized, 'original_shape': original_shape}
 
         receiver_inputs = {'filename': filename}
 
-        input_from_resized_images = {'resized_images': image_batch}
-        input_from_original_image = {'image': decoded_image}
+        input_from_static_images = dict()
+        for h, w in static_shapes or []:
+            key = 'static_{}x{}'.format(h, w)
+            resized_to_static = tf.image.resize_images(tf.to_float(image_batch[:1]), [h, w])
+            features[key] = tf.placeholder_with_default(resized_to_static, [1, h, w, 3], name=key)
+            input_from_static_images[key] = {'static_image': features[key]}
+
+        input_from_resized_images = {'resized_images': image_batch_resized}
+        input_from_original_image = {'image': float_image, 'original_shape': original_shape}
+        input_from_image_batch = {'image_batch': image_batch}
+        input_from_encoded_image = {'encoded_image': encoded_image}
+        input_from_uint8_image = {'uint8_image': uint8_image, 'original_shape': original_shape}
 
         return tf.estimator.export.ServingInputReceiver(features, receiver_inputs,
                                                         receiver_tensors_alternatives={'from_image':
                                                                                            input_from_original_image,
                                                                                        'from_resized_images':
-                                                                                           input_from_resized_images})
+                                                                                           input_from_resized_images,
+                                                                                       'from_image_batch':
+                                                                                           input_from_image_batch,
+                                                                                       'from_encoded_image':
+                                                                                           input_from_encoded_image,
+                                                                                       'from_uint8_image':
+                                                                                           input_from_uint8_image,
+                                                                                       **input_from_static_images})
 
     return serving_input_fn
 
 
+def static_input_shape(resized_size: int, ratio: float) -> (int, int):
+    """
+    :param resized_size: number of pixels of the images once resized
+    :param ratio: aspect ratio (width / height) of the images
+    :return: (h, w) of the images of this aspect ratio once resized (same computation as `resize_image`)
+    """
+    assert resized_size is not None and resized_size > 0, 'Static shapes need the images to be resized'
+    new_h = np.sqrt(resized_size / ratio)
+    return int(new_h), int(resized_size / new_h)
+
+
 def serving_input_image():
     dic_input_serving = {'images': tf.placeholder(tf.float32, [None, None, None, 3])}
     return tf.estimator.export.build_raw_serving_input_receiver_fn(dic_input_serving)
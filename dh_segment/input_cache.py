@@ -0,0 +1,188 @@
+"""
+Cache of the training data : images resized to `input_resized_size` and labels already converted to classes are
+written once to sharded TFRecord files, so that the training does not decode the images nor map the colors
+of the labels at every epoch.
+
+A cache lives in `<cache_dir>/<key>/`, the key being the hash of the parameters the cached data depend on
+(see `cache_key`). The manifest file is written last and marks a complete cache.
+
+For CLASSIFICATION with `local_entropy_ratio > 0`, the local entropy weight maps are computed once on the full
+labels and stored as uint8 (see `has_weight_maps`).
+"""
+import os
+import tensorflow as tf
+import numpy as np
+from tqdm import tqdm
+from . import utils
+from .input_utils import load_and_resize_image, local_entropy_np, LOCAL_ENTROPY_MAX
+
+_MANIFEST_FILENAME = 'manifest.json'
+
+
+def cache_key(image_filenames: list, label_filenames: list, params: dict) -> str:
+    """
+    :param image_filenames: filenames of the images
+    :param label_filenames: filenames of the labels, in the order of `image_filenames`
+    :param params: params of the experiment (with 'training_params', 'prediction_type' and 'classes_file')
+    :return: hash of the files and of the parameters the cached data depend on
+    """
+    training_params = utils.TrainingParams.from_dict(params['training_params'])
+    prediction_type = params['prediction_type']
+    classes_file = params['classes_file']
+    if prediction_type == utils.PredictionType.REGRESSION:
+        classes = None
+    else:
+        classes = np.loadtxt(classes_file).tolist()
+    return utils.hash_dict({'input_resized_size': training_params.input_resized_size,
+                            'prediction_type': prediction_type,
+                            'classes': classes,
+                            'local_entropy_sigma': training_params.local_entropy_sigma
+                            if has_weight_maps(params) else None,
+                            'files': [[os.path.abspath(i), os.path.abspath(l), os.path.getmtime(i), os.path.getmtime(l)]
+                                      for i, l in zip(image_filenames, label_filenames)]})
+
+
+def has_weight_maps(params: dict) -> bool:
+    """
+    :param params: params of the experiment
+    :return: True if the cache of these params stores the weight maps, as the last channel of the labels
+    """
+    training_params = utils.TrainingParams.from_dict(params['training_params'])
+    return training_params.local_entropy_ratio > 0 and params['prediction_type'] == utils.PredictionType.CLASSIFICATION
+
+
+def weight_maps_from_cache(weight_maps: tf.Tensor) -> tf.Tensor:
+    """
+    :param weight_maps: weight maps read from the cache (uint8 values, possibly cast to float)
+    :return: local entropy weight maps, float32
+    """
+    return tf.to_float(weight_maps) * (LOCAL_ENTROPY_MAX / 255)
+
+
+def _n_label_channels(prediction_type: str, classes_file: str) -> int:
+    if prediction_type == utils.PredictionType.MULTILABEL:
+        return utils.get_n_classes_from_file_multilabel(classes_file)
+    return 1
+
+
+def compile_dataset_cache(image_filenames: list, label_filenames: list, params: dict, cache_dir: str,
+                          images_per_shard: int=256, compression_type: str='', num_threads: int=4) -> str:
+    """
+    Writes the resized images and the class labels to TFRecord shards, unless a cache of the same data already exists.
+    Labels are stored as uint8 [H,W,1] class ids (CLASSIFICATION), [H,W,C] binary labels (MULTILABEL)
+    or [H,W,1] values (REGRESSION), with the weight map as an additional channel if `has_weight_maps(params)`.
+
+    :param image_filenames: filenames of the images
+    :param label_filenames: filenames of the labels, in the order of `image_filenames`
+    :param params: params of the experiment (with 'training_params', 'prediction_type' and 'classes_file')
+    :param cache_dir: directory containing the caches
+    :param images_per_shard: number of images per TFRecord file
+    :param compression_type: '', 'ZLIB' or 'GZIP'
+    :param num_threads: number of images processed in parallel
+    :return: directory of the cache
+    """
+    key = cache_key(image_filenames, label_filenames, params)
+    output_dir = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(output_dir, _MANIFEST_FILENAME)):
+        return output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    training_params = utils.TrainingParams.from_dict(params['training_params'])
+    prediction_type = params['prediction_type']
+    classes_file = params['classes_file']
+    with_weight_maps = has_weight_maps(params)
+
+    def _map_fn(image_filename, label_filename):
+        input_image = load_and_resize_image(image_filename, 3, training_params.input_resized_size)
+        if prediction_type == utils.PredictionType.CLASSIFICATION:
+            label_image = load_and_resize_image(label_filename, 3, training_params.input_resized_size,
+                                                interpolation='NEAREST')
+            label_image = utils.label_image_to_class(label_image, classes_file)[:, :, None]
+        elif prediction_type == utils.PredictionType.MULTILABEL:
+            label_image = load_and_resize_image(label_filename, 3, training_params.input_resized_size,
+                                                interpolation='NEAREST')
+            label_image = tf.cast(utils.multilabel_image_to_class(label_image, classes_file), tf.uint8)
+        elif prediction_type == utils.PredictionType.REGRESSION:
+            label_image = load_and_resize_image(label_filename, 1, training_params.input_resized_size,
+                                                interpolation='NEAREST')
+        else:
+            raise NotImplementedError
+        return tf.saturate_cast(tf.round(input_image), tf.uint8), tf.saturate_cast(label_image, tf.uint8)
+
+    shards = list()
+    options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType,
+                                                   compression_type or 'NONE'))
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dataset = tf.data.Dataset.from_tensor_slices((image_filenames, label_filenames))
+        dataset = dataset.map(_map_fn, num_threads).prefetch(num_threads)
+        next_element = dataset.make_one_shot_iterator().get_next()
+
+        writer = None
+        for i in tqdm(range(len(image_filenames)), desc='Caching dataset'):
+            if i % images_per_shard == 0:
+                if writer is not None:
+                    writer.close()
+                shards.append('shard_{:05d}.tfrecord'.format(len(shards)))
+                writer = tf.python_io.TFRecordWriter(os.path.join(output_dir, shards[-1]), options)
+            input_image, label_image = sess.run(next_element)
+            if with_weight_maps:
+                weight_map = local_entropy_np(label_image[:, :, 0] == 1, sigma=training_params.local_entropy_sigma)
+                weight_map = np.uint8(np.round(np.clip(weight_map / LOCAL_ENTROPY_MAX, 0, 1) * 255))
+                label_image = np.concatenate([label_image, weight_map[:, :, None]], axis=-1)
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[input_image.tobytes()])),
+                'label': tf.train.Feature(bytes_list=tf.train.BytesList(value=[label_image.tobytes()])),
+                'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=input_image.shape[:2]))
+            }))
+            writer.write(example.SerializeToString())
+        if writer is not None:
+            writer.close()
+
+    utils.dump_json(os.path.join(output_dir, _MANIFEST_FILENAME),
+                    {'key': key,
+                     'n_images': len(image_filenames),
+                     'shards': shards,
+                     'compression_type': compression_type,
+                     'prediction_type': prediction_type,
+                     'label_channels': _n_label_channels(prediction_type, classes_file) + int(with_weight_maps),
+                     'weight_maps': with_weight_maps,
+                     'input_resized_size': training_params.input_resized_size})
+    return output_dir
+
+
+def cached_dataset(cache_path: str, shuffle: bool=True, num_threads: int=4, seed=None) -> tf.data.Dataset:
+    """
+    Reads a cache written by `compile_dataset_cache`
+
+    :param cache_path: directory of the cache (returned by `compile_dataset_cache`)
+    :param shuffle: shuffle the order of the shards and of the images
+    :param num_threads: number of shards read in parallel
+    :param seed: seed of the shuffling (int or int64 tensor), the order only depends on it if set
+    :return: dataset of (input_image, label_image), float32 [H,W,3] and uint8 [H,W,label_channels]
+    """
+    manifest = utils.parse_json(os.path.join(cache_path, _MANIFEST_FILENAME))
+    shards = [os.path.join(cache_path, s) for s in manifest['shards']]
+    label_channels = manifest['label_channels']
+
+    def _parse_fn(serialized_example):
+        features = tf.parse_single_example(serialized_example, {
+            'image': tf.FixedLenFeature([], tf.string),
+            'label': tf.FixedLenFeature([], tf.string),
+            'shape': tf.FixedLenFeature([2], tf.int64)
+        })
+        shape = tf.to_int32(features['shape'])
+        input_image = tf.reshape(tf.decode_raw(features['image'], tf.uint8), tf.concat([shape, [3]], axis=0))
+        label_image = tf.reshape(tf.decode_raw(features['label'], tf.uint8),
+                                 tf.concat([shape, [label_channels]], axis=0))
+        input_image.set_shape([None, None, 3])
+        label_image.set_shape([None, None, label_channels])
+        return tf.to_float(input_image), label_image
+
+    dataset = tf.data.Dataset.from_tensor_slices(shards)
+    if shuffle:
+        dataset = dataset.shuffle(len(shards), seed=seed)
+    dataset = dataset.interleave(lambda f: tf.data.TFRecordDataset(f, manifest['compression_type']),
+                                 cycle_length=min(num_threads, len(shards)), block_length=1)
+    if shuffle:
+        dataset = dataset.shuffle(min(manifest['n_images'], 64), seed=seed)
+    return dataset.map(_parse_fn, num_threads)
@@ -1,8 +1,12 @@
+import inspect
 import tensorflow as tf
 from tensorflow.contrib.image import rotate as tf_rotate
 from scipy import ndimage
 import numpy as np
 
+# The output shape of the projective transform can only be set from tensorflow 1.8 on (not in environment.yml)
+_TRANSFORM_HAS_OUTPUT_SHAPE = 'output_shape' in inspect.signature(tf.contrib.image.transform).parameters
+
 
 def data_augmentation_fn(input_image: tf.Tensor, label_image: tf.Tensor,
                          flip_lr: bool=True, flip_ud: bool=True, color: bool=True) -> (tf.Tensor, tf.Tensor):
@@ -27,34 +31,151 @@ def data_augmentation_fn(input_image: tf.Tensor, label_image: tf.Tensor,
         return input_image, label_image
 
 
+def _affine_transforms(batch_size: tf.Tensor, shape: tf.Tensor, max_rotation: float=0.,
+                       flip_lr: bool=True, flip_ud: bool=True) -> tf.Tensor:
+    """
+    Draws one transform per sample composing a random flip, a random rotation and the minimal zoom
+    for the rotated sample to have no empty corner
+
+    :param batch_size: number of transforms
+    :param shape: [h, w] of the samples
+    :return: transforms [B, 8] mapping output to input coordinates (see `tf.contrib.image.transform`)
+    """
+    h, w = tf.to_float(shape[0]), tf.to_float(shape[1])
+
+    def _random_flip(enabled):
+        if not enabled:
+            return tf.ones([batch_size])
+        return tf.where(tf.random_uniform([batch_size]) > 0.5, -tf.ones([batch_size]), tf.ones([batch_size]))
+
+    flip_x, flip_y = _random_flip(flip_lr), _random_flip(flip_ud)
+    angles = tf.random_uniform([batch_size], -max_rotation, max_rotation)
+    cos, sin = tf.cos(angles), tf.sin(angles)
+    # The output window rotated back must fit in the sample
+    zoom = tf.maximum(cos + tf.abs(sin) * (h - 1) / (w - 1), cos + tf.abs(sin) * (w - 1) / (h - 1))
+
+    a0, a1 = cos * flip_x / zoom, -sin * flip_y / zoom
+    b0, b1 = sin * flip_x / zoom, cos * flip_y / zoom
+    # Transforms around the center of the samples
+    cx, cy = (w - 1) / 2, (h - 1) / 2
+    a2 = cx - a0 * cx - a1 * cy
+    b2 = cy - b0 * cx - b1 * cy
+    zeros = tf.zeros([batch_size])
+    return tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+
+
+def _random_color_batch(images: tf.Tensor) -> tf.Tensor:
+    # Per-sample contrast, hue and saturation, as data_augmentation_fn (images in [0, 255])
+    batch_size = tf.shape(images)[0]
+    contrast = tf.random_uniform([batch_size, 1, 1, 1], 0.8, 1.0)
+    means = tf.reduce_mean(images, axis=[1, 2], keep_dims=True)
+    images = (images - means) * contrast + means
+    if images.get_shape()[-1].value == 3:
+        hsv = tf.image.rgb_to_hsv(tf.clip_by_value(images / 255, 0, 1))
+        hue = tf.mod(hsv[:, :, :, 0] + tf.random_uniform([batch_size, 1, 1], -0.1, 0.1), 1.0)
+        saturation = tf.clip_by_value(hsv[:, :, :, 1] * tf.random_uniform([batch_size, 1, 1], 0.8, 1.2), 0, 1)
+        images = 255 * tf.image.hsv_to_rgb(tf.stack([hue, saturation, hsv[:, :, :, 2]], axis=-1))
+    return images
+
+
+def batch_augmentation_fn(batch: dict, max_rotation: float=0., flip_lr: bool=True, flip_ud: bool=True,
+                          color: bool=True) -> dict:
+    """
+    Data augmentation of a batch of samples of the same shape (patches). Flip, rotation and zoom are composed into
+    a single affine transform per sample, applied at once to the images (bilinear) and to the labels and
+    weight maps (nearest neighbour and bilinear).
+
+    :param batch: dict with 'images' [B,h,w,3], and possibly 'labels' [B,h,w] or [B,h,w,C] and 'weight_maps' [B,h,w]
+    :param max_rotation: maximum rotation angle (in radians)
+    :param flip_lr: random left/right flips
+    :param flip_ud: random up/down flips
+    :param color: random contrast, hue and saturation
+    :return: augmented batch
+    """
+    with tf.name_scope('BatchDataAugmentation'):
+        batch = dict(batch)
+        images = batch['images']
+        if max_rotation > 0 or flip_lr or flip_ud:
+            transforms = _affine_transforms(tf.shape(images)[0], tf.shape(images)[1:3], max_rotation,
+                                            flip_lr, flip_ud)
+
+            def _transform(tensor: tf.Tensor, interpolation: str) -> tf.Tensor:
+                # The transform works on [B,h,w,c] tensors of numeric types
+                rank, dtype = len(tensor.get_shape()), tensor.dtype
+                tensor = tensor if rank == 4 else tensor[:, :, :, None]
+                tensor = tensor if dtype != tf.bool else tf.cast(tensor, tf.uint8)
+                tensor = tf.contrib.image.transform(tensor, transforms, interpolation)
+                tensor = tensor if dtype != tf.bool else tf.cast(tensor, tf.bool)
+                return tensor if rank == 4 else tensor[:, :, :, 0]
+
+            batch['images'] = _transform(images, 'BILINEAR')
+            if 'labels' in batch:
+                batch['labels'] = _transform(batch['labels'], 'NEAREST')
+            if 'weight_maps' in batch:
+                batch['weight_maps'] = _transform(batch['weight_maps'], 'BILINEAR')
+        if color:
+            batch['images'] = _random_color_batch(batch['images'])
+        return batch
+
+
 def rotate_crop(img, rotation, crop=True, minimum_shape=[0, 0], interpolation='NEAREST'):
+    """
+    Rotates an image and crops it to the largest rectangle without empty corners. The size of the rectangle is
+    computed first, so that only its pixels are warped by a single projective transform with the output shape set.
+    This needs tensorflow >= 1.8 : with the tensorflow 1.7 of environment.yml, the whole image is rotated then
+    cropped as before, so there is no speed-up. If the rectangle is smaller than `minimum_shape`, the image is
+    returned as is, without warping.
+    Labels should be rotated with the same `rotation` and 'NEAREST' interpolation to get the identical transform.
+
+    :param img: image [H, W, C]
+    :param rotation: angle in radians (counterclockwise)
+    :param crop: crop the rotated image, otherwise the rotated image keeps the shape of the original
+    :param minimum_shape: minimum [h, w] of the crop
+    :param interpolation: 'NEAREST' or 'BILINEAR'
+    :return: rotated (and cropped) image
+    """
     with tf.name_scope('RotateCrop'):
-        rotated_image = tf_rotate(img, rotation, interpolation)
-        if crop:
-            rotation = tf.abs(rotation)
-            original_shape = tf.shape(rotated_image)[:2]
-            h, w = original_shape[0], original_shape[1]
-            # see https://stackoverflow.com/questions/16702966/rotate-image-and-crop-out-black-borders for formulae
-            old_l, old_s = tf.cond(h > w, lambda: [h, w], lambda: [w, h])
-            old_l, old_s = tf.cast(old_l, tf.float32), tf.cast(old_s, tf.float32)
-            new_l = (old_l * tf.cos(rotation) - old_s * tf.sin(rotation)) / tf.cos(2 * rotation)
-            new_s = (old_s - tf.sin(rotation) * new_l) / tf.cos(rotation)
-            new_h, new_w = tf.cond(h > w, lambda: [new_l, new_s], lambda: [new_s, new_l])
-            new_h, new_w = tf.cast(new_h, tf.int32), tf.cast(new_w, tf.int32)
-            bb_begin = tf.cast(tf.ceil((h - new_h) / 2), tf.int32), tf.cast(tf.ceil((w - new_w) / 2), tf.int32)
-            rotated_image_crop = rotated_image[bb_begin[0]:h - bb_begin[0], bb_begin[1]:w - bb_begin[1], :]
-
-            # If crop removes the entire image, keep the original image
-            rotated_image = tf.cond(tf.less_equal(tf.reduce_min(tf.shape(rotated_image_crop)[:2]),
-                                                  tf.reduce_max(minimum_shape)),
-                                    true_fn=lambda: img,
-                                    false_fn=lambda: rotated_image_crop)
-        return rotated_image
+        if not crop:
+            return tf_rotate(img, rotation, interpolation)
+
+        original_shape = tf.shape(img)[:2]
+        h, w = original_shape[0], original_shape[1]
+        abs_rotation = tf.abs(rotation)
+        # see https://stackoverflow.com/questions/16702966/rotate-image-and-crop-out-black-borders for formulae
+        old_l, old_s = tf.cond(h > w, lambda: [h, w], lambda: [w, h])
+        old_l, old_s = tf.cast(old_l, tf.float32), tf.cast(old_s, tf.float32)
+        new_l = (old_l * tf.cos(abs_rotation) - old_s * tf.sin(abs_rotation)) / tf.cos(2 * abs_rotation)
+        new_s = (old_s - tf.sin(abs_rotation) * new_l) / tf.cos(abs_rotation)
+        new_h, new_w = tf.cond(h > w, lambda: [new_l, new_s], lambda: [new_s, new_l])
+        new_h, new_w = tf.cast(new_h, tf.int32), tf.cast(new_w, tf.int32)
+
+        def _rotate_crop():
+            if _TRANSFORM_HAS_OUTPUT_SHAPE:
+                # Maps the pixels of the centered rectangle to the original image
+                cos, sin = tf.cos(rotation), tf.sin(rotation)
+                cx, cy = tf.to_float(w - 1) / 2, tf.to_float(h - 1) / 2
+                new_cx, new_cy = tf.to_float(new_w - 1) / 2, tf.to_float(new_h - 1) / 2
+                transform = tf.stack([cos, -sin, cx - cos * new_cx + sin * new_cy,
+                                      sin, cos, cy - sin * new_cx - cos * new_cy, 0., 0.])
+                return tf.contrib.image.transform(img, transform, interpolation, output_shape=tf.stack([new_h, new_w]))
+            else:
+                rotated_image = tf_rotate(img, rotation, interpolation)
+                bb_begin = tf.cast(tf.ceil((h - new_h) / 2), tf.int32), tf.cast(tf.ceil((w - new_w) / 2), tf.int32)
+                return rotated_image[bb_begin[0]:h - bb_begin[0], bb_begin[1]:w - bb_begin[1], :]
+
+        # If crop removes the entire image, keep the original image
+        return tf.cond(tf.less_equal(tf.minimum(new_h, new_w), tf.reduce_max(minimum_shape)),
+                       true_fn=lambda: img,
+                       false_fn=_rotate_crop)
 
 
 def resize_image(image: tf.Tensor, size: int, interpolation='BILINEAR'):
+    """
+    Resizes an image [H,W,C] or a batch of images [B,H,W,C] so that it has approximately `size` pixels,
+    keeping the aspect ratio
+    """
     with tf.name_scope('ImageRescaling'):
-        input_shape = tf.cast(tf.shape(image)[:2], tf.float32)
+        input_shape = tf.cast(tf.shape(image)[-3:-1], tf.float32)
         size = tf.cast(size, tf.float32)
         # Compute new shape
         # We want X/Y = x/y and we have size = x*y so :
@@ -76,20 +197,66 @@ def load_and_resize_image(filename, channels, size=None, interpolation='BILINEAR
     :param channels: nb of channels for the decoded image
     :param size: number of desired pixels in the resized image, tf.Tensor or int (None for no resizing)
     :param interpolation:
-    :param return_original_shape: returns the original shape of the image before resizing if this flag is True
-    :return: decoded and resized float32 tensor [h, w, channels],
-            tuple (decoded-image, original-shape) if return_original_shape==True
+    :return: decoded and resized float32 tensor [h, w, channels]
+    """
+    return decode_and_resize_image(tf.read_file(filename), channels, size, interpolation)
+
+
+def decode_and_resize_image(encoded_image, channels, size=None, interpolation='BILINEAR'):
+    """
+    Same as `load_and_resize_image` for an image already read
+
+    :param encoded_image: string tensor, content of the image file
+    :param channels: nb of channels for the decoded image
+    :param size: number of desired pixels in the resized image, tf.Tensor or int (None for no resizing)
+    :param interpolation:
+    :return: decoded and resized float32 tensor [h, w, channels]
     """
     with tf.name_scope('load_img'):
-        decoded_image = tf.to_float(tf.image.decode_jpeg(tf.read_file(filename), channels=channels,
-                                                         try_recover_truncated=True))
+        decoded_image = tf.image.decode_jpeg(encoded_image, channels=channels, try_recover_truncated=True)
         # TODO : if one side is smaller than size of patches (and make patches == true), force the image to have at least patch size
         if size is not None and not(isinstance(size, int) and size <= 0):
+            # Resizing the uint8 image avoids a full resolution float copy
             result_image = resize_image(decoded_image, size, interpolation)
         else:
             result_image = decoded_image
 
-        return result_image
+        return tf.to_float(result_image)
+
+
+def decode_and_downscale_image(encoded_image: tf.Tensor, size: int=None) -> (tf.Tensor, tf.Tensor):
+    """
+    Decodes an encoded image (JPEG, PNG or BMP) to uint8. JPEG images are downscaled while being decoded
+    (in the DCT domain) by the largest factor among 2, 4 and 8 keeping at least `size` pixels, the final resizing
+    is left to `resize_image`.
+
+    :param encoded_image: string tensor, content of the image file
+    :param size: number of pixels of the image once resized (None for no resizing)
+    :return: (decoded uint8 image [h, w, 3], original shape of the image [2])
+    """
+    with tf.name_scope('decode_img'):
+        def _decode_jpeg():
+            original_shape = tf.image.extract_jpeg_shape(encoded_image)[:2]
+
+            def _decode(ratio):
+                return lambda: tf.image.decode_jpeg(encoded_image, channels=3, ratio=ratio,
+                                                    try_recover_truncated=True)
+
+            if size is None or size <= 0:
+                return _decode(1)(), original_shape
+            n_pixels = tf.cast(tf.reduce_prod(original_shape), tf.float32)
+            # Each dimension is divided by ratio, so the number of pixels by ratio**2
+            image = tf.case([(n_pixels >= size * r ** 2, _decode(r)) for r in [8, 4, 2]],
+                            default=_decode(1), exclusive=False)
+            image.set_shape([None, None, 3])
+            return image, original_shape
+
+        def _decode_other():
+            image = tf.image.decode_image(encoded_image, channels=3)
+            image.set_shape([None, None, 3])
+            return image, tf.shape(image)[:2]
+
+        return tf.cond(tf.image.is_jpeg(encoded_image), _decode_jpeg, _decode_other)
 
 
 def extract_patches_fn(image: tf.Tensor, patch_shape: list, offsets) -> tf.Tensor:
@@ -114,33 +281,147 @@ def extract_patches_fn(image: tf.Tensor, patch_shape: list, offsets) -> tf.Tenso
         return tf.reshape(patches, [tf.reduce_prod(patches_shape[:3]), h, w, int(c)])  # returns [batch_patches, h, w, c]
 
 
-def local_entropy(tf_binary_img: tf.Tensor, sigma=3):
-    tf_binary_img.get_shape().assert_has_rank(2)
+def grid_patches_positions(image_shape: tf.Tensor, patch_shape: list, offsets) -> tf.Tensor:
+    """
+    Positions of the patches of a grid with strides of half a patch (same patches as `extract_patches_fn`),
+    to crop them lazily with `crop_patch`
+
+    :param image_shape: [H, W]
+    :param patch_shape: [h, w]
+    :param offsets: tuple between 0 and 1
+    :return: positions of the top-left corners [n_patches, 2]
+    """
+    with tf.name_scope('grid_patches'):
+        h, w = patch_shape
+        offset_h = tf.cast(tf.round(offsets[0] * h // 2), dtype=tf.int32)
+        offset_w = tf.cast(tf.round(offsets[1] * w // 2), dtype=tf.int32)
+        grid_y, grid_x = tf.meshgrid(tf.range(offset_h, image_shape[0] - h + 1, h // 2),
+                                     tf.range(offset_w, image_shape[1] - w + 1, w // 2), indexing='ij')
+        return tf.stack([tf.reshape(grid_y, [-1]), tf.reshape(grid_x, [-1])], axis=1)
+
+
+def _label_keys(label_image: tf.Tensor) -> tf.Tensor:
+    # One integer per pixel identifying its label : packed colors, class ids or binary labels
+    n_channels = label_image.get_shape()[-1].value
+    base = 256 if n_channels <= 3 else 2
+    weights = tf.constant(base ** np.arange(n_channels)[::-1], tf.int32)
+    return tf.reduce_sum(tf.to_int32(tf.round(label_image)) * weights, axis=-1)
+
+
+def random_patches_positions(label_image: tf.Tensor, patch_shape: list, n_patches: tf.Tensor,
+                             class_balanced: bool=False) -> tf.Tensor:
+    """
+    Draws the positions of random patches. With `class_balanced`, a label present in the image is drawn uniformly
+    for each patch and the patch is centered (as much as possible) on a random pixel of this label,
+    so that rare classes are seen as often as the background. The pixels are grouped by label once per image,
+    the cost of drawing the positions does not depend on `n_patches`.
+
+    :param label_image: label image [H, W, C] (colors, or classes if they come from the dataset cache)
+    :param patch_shape: [h, w]
+    :param n_patches: number of patches to draw
+    :param class_balanced: draw each patch around a pixel of a random label
+    :return: positions of the top-left corners [n_patches, 2]
+    """
+    with tf.name_scope('random_patches'):
+        n_patches = tf.to_int32(n_patches)
+        max_position = tf.maximum(tf.shape(label_image)[:2] - np.array(patch_shape, np.int32), 0)
+        if not class_balanced:
+            return tf.cast(tf.floor(tf.random_uniform(tf.stack([n_patches, 2])) * tf.to_float(max_position + 1)),
+                           tf.int32)
+
+        unique_keys, label_indexes = tf.unique(tf.reshape(_label_keys(label_image), [-1]))
+        n_labels = tf.size(unique_keys)
+        # Indexes of the pixels sorted by label, with the first position and the number of pixels of each label
+        pixels_by_label = tf.nn.top_k(-label_indexes, k=tf.size(label_indexes), sorted=True).indices
+        counts = tf.unsorted_segment_sum(tf.ones_like(label_indexes), label_indexes, n_labels)
+        starts = tf.cumsum(counts, exclusive=True)
 
-    def get_gaussian_filter_1d(sigma):
-        sigma_r = int(np.round(sigma))
-        x = np.zeros(6 * sigma_r + 1, dtype=np.float32)
-        x[3 * sigma_r] = 1
-        return ndimage.filters.gaussian_filter(x, sigma=sigma)
+        drawn_labels = tf.random_uniform([n_patches], 0, n_labels, dtype=tf.int32)
+        drawn_counts = tf.gather(counts, drawn_labels)
+        ranks = tf.minimum(tf.to_int32(tf.floor(tf.random_uniform([n_patches]) * tf.to_float(drawn_counts))),
+                           drawn_counts - 1)
+        pixels = tf.gather(pixels_by_label, tf.gather(starts, drawn_labels) + ranks)
+        width = tf.shape(label_image)[1]
+        centers = tf.stack([pixels // width, pixels % width], axis=1)
+        return tf.minimum(tf.maximum(centers - np.array(patch_shape, np.int32) // 2, 0), max_position)
 
-    def _fn(img):
-        labelled, nb_components = ndimage.measurements.label(img)
-        lut = np.concatenate(
-            [np.array([0], np.int32), np.random.randint(20, size=nb_components + 1, dtype=np.int32) + 1])
-        output = lut[labelled]
-        return output
 
-    label_components = tf.py_func(_fn, [tf_binary_img], tf.int32)
+def crop_patch(image: tf.Tensor, position: tf.Tensor, patch_shape: list) -> tf.Tensor:
+    """
+    :param image: [H, W, C], at least as large as `patch_shape`
+    :param position: top-left corner [2]
+    :param patch_shape: [h, w]
+    :return: patch [h, w, C]
+    """
+    h, w = patch_shape
+    patch = image[position[0]:position[0] + h, position[1]:position[1] + w]
+    patch.set_shape([h, w, image.get_shape()[-1]])
+    return patch
+
+
+# Connected components get a random value in [1, _N_COMPONENT_VALUES - 1], 0 being the background
+_N_COMPONENT_VALUES = 21
+# Maximum value of the local entropy, used to store the weight maps as uint8
+LOCAL_ENTROPY_MAX = float(np.log(_N_COMPONENT_VALUES))
+
+
+def _random_components_values(binary_img: np.ndarray) -> np.ndarray:
+    labelled, nb_components = ndimage.measurements.label(binary_img)
+    lut = np.concatenate(
+        [np.array([0], np.int32), np.random.randint(_N_COMPONENT_VALUES - 1, size=nb_components + 1,
+                                                    dtype=np.int32) + 1])
+    return lut[labelled]
+
+
+def _get_gaussian_filter_1d(sigma):
+    sigma_r = int(np.round(sigma))
+    x = np.zeros(6 * sigma_r + 1, dtype=np.float32)
+    x[3 * sigma_r] = 1
+    return ndimage.filters.gaussian_filter(x, sigma=sigma)
+
+
+def local_entropy(tf_binary_img: tf.Tensor, sigma=3):
+    tf_binary_img.get_shape().assert_has_rank(2)
+
+    label_components = tf.py_func(_random_components_values, [tf_binary_img], tf.int32)
     label_components.set_shape([None, None])
-    one_hot_components = tf.one_hot(label_components, tf.reduce_max(label_components))
+    # Bounded number of channels
+    one_hot_components = tf.one_hot(label_components, _N_COMPONENT_VALUES)
     one_hot_components = tf.transpose(one_hot_components, [2, 0, 1])
 
     local_components_avg = tf.nn.conv2d(one_hot_components[:, :, :, None],
-                                        get_gaussian_filter_1d(sigma)[None, :, None, None], (1, 1, 1, 1),
+                                        _get_gaussian_filter_1d(sigma)[None, :, None, None], (1, 1, 1, 1),
                                         padding='SAME')
-    local_components_avg = tf.nn.conv2d(local_components_avg, get_gaussian_filter_1d(sigma)[:, None, None, None],
+    local_components_avg = tf.nn.conv2d(local_components_avg, _get_gaussian_filter_1d(sigma)[:, None, None, None],
                                         (1, 1, 1, 1), padding='SAME')
     local_components_avg = tf.transpose(local_components_avg[:, :, :, 0], [1, 2, 0])
     local_components_avg = tf.pow(local_components_avg, 1 / 1.4)
     local_components_avg = local_components_avg / (tf.reduce_sum(local_components_avg, axis=2, keep_dims=True) + 1e-6)
     return -tf.reduce_sum(local_components_avg * tf.log(local_components_avg + 1e-6), axis=2)
+
+
+def local_entropy_np(binary_img: np.ndarray, sigma=3) -> np.ndarray:
+    """
+    Same as `local_entropy` computed with numpy/scipy, to precompute the weight maps (see `input_cache`).
+    Components take at most `_N_COMPONENT_VALUES` values, so the memory used is bounded by this number of maps.
+
+    :param binary_img: binary mask [H, W]
+    :param sigma: standard deviation of the gaussian window
+    :return: weight map [H, W] float32, in [0, LOCAL_ENTROPY_MAX]
+    """
+    components = _random_components_values(binary_img)
+    gaussian_filter = _get_gaussian_filter_1d(sigma)
+
+    local_avgs = list()
+    for value in range(_N_COMPONENT_VALUES):
+        local_avg = ndimage.convolve1d((components == value).astype(np.float32), gaussian_filter, axis=1,
+                                       mode='constant')
+        local_avg = ndimage.convolve1d(local_avg, gaussian_filter, axis=0, mode='constant')
+        local_avgs.append(np.power(np.maximum(local_avg, 0), 1 / 1.4))
+    normalization = np.sum(local_avgs, axis=0) + 1e-6
+
+    entropy = np.zeros(binary_img.shape, np.float32)
+    for local_avg in local_avgs:
+        p = local_avg / normalization
+        entropy -= p * np.log(p + 1e-6)
+    return entropy
@@ -1,146 +1,557 @@
 import tensorflow as tf
 import os
-from threading import Semaphore
+import re
+from threading import Semaphore, Lock
+from collections import OrderedDict
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import tempfile
-from scipy.misc import imsave, imread
+import cv2
+from scipy.misc import imread
 
 _original_shape_key = 'original_shape'
 
+# predict_mode : (input key, signature key)
+_PREDICT_MODES = {
+    'filename': ('filename', 'serving_default'),
+    'filename_original_shape': ('filename', 'resized_output'),
+    'image': ('image', 'from_image:serving_default'),
+    'image_original_shape': ('image', 'from_image:resized_output'),
+    'resized_images': ('resized_images', 'from_resized_images:serving_default'),
+    'image_batch': ('image_batch', 'from_image_batch:serving_default'),
+    'encoded_image': ('encoded_image', 'from_encoded_image:serving_default'),
+    'encoded_image_original_shape': ('encoded_image', 'from_encoded_image:resized_output'),
+    'uint8_image': ('uint8_image', 'from_uint8_image:serving_default'),
+    'uint8_image_original_shape': ('uint8_image', 'from_uint8_image:resized_output'),
+    # uint8 probabilities at network resolution with the scale factors to the original image
+    'filename_compact': ('filename', 'compact_output'),
+    'encoded_image_compact': ('encoded_image', 'from_encoded_image:compact_output'),
+    'uint8_image_compact': ('uint8_image', 'from_uint8_image:compact_output'),
+    # Image resized to the nearest static shape of the export (see `nearest_static_shape`)
+    'static_image': ('static_image', 'static_{h}x{w}:static_{h}x{w}'),
+}
 
-class LoadedModel:
-    def __init__(self, model_base_dir, model_name, predict_mode='filename', num_parallel_predictions=2):
-        
-        mdir = os.path.join(model_base_dir, model_name)
 
-        if os.path.exists(os.path.join(mdir, 'saved_model.pbtxt')) or \
-                os.path.exists(os.path.join(mdir, 'saved_model.pb')):
-            model_dir = mdir
-        else:
-            possible_dirs = os.listdir(mdir)
-            model_dir = os.path.join(mdir, max(possible_dirs))  # Take latest export
+class LoadedModel:
+    def __init__(self, model_base_dir, model_name='', predict_mode='filename', num_parallel_predictions=2,
+                 sess: tf.Session=None):
+        """
+        :param model_base_dir: directory of the exported model, or of several exports (the latest is taken)
+        :param model_name: subdirectory of `model_base_dir` containing the export(s)
+        :param predict_mode: one of the keys of `_PREDICT_MODES`, defines the input and outputs of `predict`
+        :param num_parallel_predictions: maximum number of concurrent runs
+        :param sess: session in whose graph the model is loaded, defaults to `tf.get_default_session()`.
+            Use `ModelRegistry` to give each model its own graph and session
+        """
+        model_dir = _find_export_dir(model_base_dir, model_name)
         # print("Loading {}".format(model_dir))
 
-        if predict_mode == 'filename':
-            input_dict_key = 'filename'
-            signature_def_key = 'serving_default'
-        elif predict_mode == 'filename_original_shape':
-            input_dict_key = 'filename'
-            signature_def_key = 'resized_output'
-        elif predict_mode == 'image':
-            input_dict_key = 'image'
-            signature_def_key = 'from_image:serving_default'
-        elif predict_mode == 'image_original_shape':
-            input_dict_key = 'image'
-            signature_def_key = 'from_image:resized_output'
-        elif predict_mode == 'resized_images':
-            input_dict_key = 'resized_images'
-            signature_def_key = 'from_resized_images:serving_default'
-        else:
+        if predict_mode not in _PREDICT_MODES:
             raise NotImplementedError
         self.predict_mode = predict_mode
         self.name = model_name
+        self.export_dir = model_dir
 
-        self.sess = tf.get_default_session()
-        loaded_model = tf.saved_model.loader.load(self.sess, ['serve'], model_dir)
+        self.sess = sess if sess is not None else tf.get_default_session()
+        with self.sess.graph.as_default():
+            loaded_model = tf.saved_model.loader.load(self.sess, ['serve'], model_dir)
         assert 'serving_default' in list(loaded_model.signature_def)
 
-        input_dict, output_dict = _signature_def_to_tensors(loaded_model.signature_def[signature_def_key])
-        assert input_dict_key in input_dict.keys(), "{} not present in input_keys, " \
-                                                    "possible values: {}".format(input_dict_key, input_dict.keys())
-        self._input_tensor = input_dict[input_dict_key]
-        self._output_dict = output_dict
-        if predict_mode == 'resized_images':
-            # This node is not defined in this specific run-mode as there is no original image
-            del self._output_dict['original_shape']
+        self._signature_defs = loaded_model.signature_def
+        self._signatures = dict()
+        self._original_shape_inputs = dict()
+        self._select_signature(predict_mode)
+        self.num_parallel_predictions = num_parallel_predictions
         self.sema = Semaphore(num_parallel_predictions)
 
+    def with_predict_mode(self, predict_mode: str) -> 'LoadedModel':
+        """
+        Gives a view of the model with another predict_mode, sharing the same graph and session
+
+        :param predict_mode: one of the keys of `_PREDICT_MODES`
+        :return: LoadedModel
+        """
+        if predict_mode == self.predict_mode:
+            return self
+        if predict_mode not in _PREDICT_MODES:
+            raise NotImplementedError
+        model = copy(self)
+        model.predict_mode = predict_mode
+        model._select_signature(predict_mode)
+        return model
+
+    def _select_signature(self, predict_mode: str):
+        # Sets the input and the outputs used by `predict`
+        if predict_mode == 'static_image':
+            # Chosen at each prediction, according to the shape of the image
+            assert self.static_shapes(), "No static-shape signature in the exported model, " \
+                                         "the model has to be exported with static shapes"
+            self._input_tensor, self._output_dict, self._original_shape_input = None, None, None
+        else:
+            self._input_tensor, self._output_dict = self._get_signature(predict_mode)
+            self._original_shape_input = self._original_shape_inputs[predict_mode]
+
+    def static_shapes(self) -> list:
+        """
+        :return: list of the (h, w) input shapes of the static-shape signatures of the export
+        """
+        shapes = [re.match(r'^static_([0-9]+)x([0-9]+)$', k) for k in self._signature_defs]
+        return sorted((int(m.group(1)), int(m.group(2))) for m in shapes if m is not None)
+
+    def nearest_static_shape(self, h: int, w: int) -> (int, int):
+        """
+        :param h: height of the image
+        :param w: width of the image
+        :return: the static shape with the closest aspect ratio (and then the closest area) to the image
+        """
+        return min(self.static_shapes(), key=lambda s: (abs(np.log((s[1] / s[0]) / (w / h))), abs(s[0] * s[1] - h * w)))
+
+    def _get_signature(self, predict_mode: str, static_shape: tuple=None) -> (tf.Tensor, dict):
+        """
+        Gets (and caches) the input tensor and the output tensors corresponding to a prediction mode
+
+        :param predict_mode: one of the keys of `_PREDICT_MODES`
+        :param static_shape: (h, w) of the signature, for the 'static_image' predict_mode
+        :return: (input_tensor, output_dict)
+        """
+        signature_key = predict_mode if static_shape is None else 'static_{}x{}'.format(*static_shape)
+        if signature_key not in self._signatures:
+            input_dict_key, signature_def_key = _PREDICT_MODES[predict_mode]
+            if static_shape is not None:
+                signature_def_key = signature_def_key.format(h=static_shape[0], w=static_shape[1])
+            assert signature_def_key in self._signature_defs, \
+                "Signature {} not present in the exported model (possible values: {}), " \
+                "the model may need to be exported again".format(signature_def_key, list(self._signature_defs))
+            input_dict, output_dict = _signature_def_to_tensors(self._signature_defs[signature_def_key],
+                                                                self.sess.graph)
+            assert input_dict_key in input_dict.keys(), "{} not present in input_keys, " \
+                                                        "possible values: {}".format(input_dict_key, input_dict.keys())
+            if predict_mode in ['resized_images', 'image_batch']:
+                # This node is not defined in these run-modes as there is no original image
+                del output_dict[_original_shape_key]
+            self._signatures[signature_key] = input_dict[input_dict_key], output_dict
+            # Signatures taking a decoded image also need its original shape
+            # (older exports compute it from the image and do not have this input)
+            self._original_shape_inputs[signature_key] = input_dict.get(_original_shape_key)
+        return self._signatures[signature_key]
+
     def predict(self, input_tensor, prediction_key=None):
+        if self.predict_mode == 'static_image':
+            # The image is resized to the nearest static shape, outputs are at the resolution of this shape
+            h, w = self.nearest_static_shape(*np.shape(input_tensor)[:2])
+            input_placeholder, output_dict = self._get_signature('static_image', (h, w))
+            input_tensor = cv2.resize(np.asarray(input_tensor), (w, h), interpolation=cv2.INTER_LINEAR)[None]
+        else:
+            input_placeholder, output_dict = self._input_tensor, self._output_dict
         with self.sema:
             if prediction_key:
-                desired_output = self._output_dict[prediction_key]
+                desired_output = output_dict[prediction_key]
             else:
-                desired_output = self._output_dict
-            return self.sess.run(desired_output, feed_dict={self._input_tensor: input_tensor})
+                desired_output = output_dict
+            feed_dict = {input_placeholder: input_tensor}
+            if self._original_shape_input is not None:
+                feed_dict[self._original_shape_input] = np.shape(input_tensor)[:2]
+            return self.sess.run(desired_output, feed_dict=feed_dict)
 
-    def predict_with_tiles(self, filename: str, resized_size: int=None, tile_size: int=500,
-                           min_overlap: float=0.2, linear_interpolation: bool=True):
+    def predict_batch(self, filenames_or_arrays: list, batch_size: int=8, prediction_key: str=None,
+                      bucket_step: int=64) -> list:
+        """
+        Predicts several images with as few runs as possible. Images are grouped into buckets of similar sizes,
+        each batch is (mirror) padded to the size of its largest image and every output is cropped back
+        to the region of its own image. Needs a model exported with the 'from_image_batch' signature.
 
-        # TODO this part should only happen if self.predict_mode == 'resized_images'
+        :param filenames_or_arrays: list of filenames or of RGB images [H,W,3]. All the images are loaded at once,
+            so very large sets should be given by chunks
+        :param batch_size: maximum number of images per run
+        :param prediction_key: if set, returns only this output for each image
+        :param bucket_step: images whose height and width round up to the same multiples of `bucket_step` pixels
+            are batched together
+        :return: list of the predictions (dict, or array if `prediction_key` is set) in the order of the inputs.
+            Each output has a batch dimension of 1 like in `predict`
+        """
+        input_tensor, output_dict = self._get_signature('image_batch')
+        if prediction_key:
+            output_dict = {prediction_key: output_dict[prediction_key]}
 
-        if resized_size is None or resized_size < 0:
-            image_np = imread(filename)
-            h, w = image_np.shape[:2]
-            batch_size = 1
-        else:
-            raise NotImplementedError
-        assert h > tile_size, w > tile_size
-        # Get x and y coordinates of beginning of tiles and compute prediction for each tile
-        y_step = np.ceil((h - tile_size) / (tile_size * (1 - min_overlap)))
-        x_step = np.ceil((w - tile_size) / (tile_size * (1 - min_overlap)))
-        y_pos = np.round(np.arange(y_step + 1) / y_step * (h - tile_size)).astype(np.int32)
-        x_pos = np.round(np.arange(x_step + 1) / x_step * (w - tile_size)).astype(np.int32)
-
-        all_outputs = list()
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            for i, y in enumerate(y_pos):
-                inside_list = list()
-                for j, x in enumerate(x_pos):
-                    filename_tile = os.path.join(tmpdirname, 'tile{}{}.png'.format(i, j))
-                    imsave(filename_tile, image_np[y:y + tile_size, x:x + tile_size])
-                    inside_list.append(self.predict(filename_tile))#, prediction_key='probs'))
-                all_outputs.append(inside_list)
-
-        def _merge_x(full_output, assigned_up_to, new_input, begin_position):
-            assert full_output.shape[1] == new_input.shape[1], \
-                "Shape full output is {}, but shape new_input is {}".format(full_output.shape[1], new_input.shape[1])
-            overlap_size = assigned_up_to - begin_position
-            normal_part_size = new_input.shape[2] - overlap_size
-            assert normal_part_size > 0
-            full_output[:, :, assigned_up_to:assigned_up_to + normal_part_size] = new_input[:, :, overlap_size:]
-            if overlap_size > 0:
-                weights = np.arange(0, overlap_size) / overlap_size
-                full_output[:, :, begin_position:assigned_up_to] = (1 - weights)[:, None] * full_output[:, :,
-                                                                                            begin_position:assigned_up_to] + \
-                                                                   weights[:, None] * new_input[:, :, :overlap_size]
-
-        def _merge_y(full_output, assigned_up_to, new_input, begin_position):
-            assert full_output.shape[2] == new_input.shape[2]
-            overlap_size = assigned_up_to - begin_position
-            normal_part_size = new_input.shape[1] - overlap_size
-            assert normal_part_size > 0
-            full_output[:, assigned_up_to:assigned_up_to + normal_part_size] = new_input[:, overlap_size:]
-            if overlap_size > 0:
-                weights = np.arange(0, overlap_size) / overlap_size
-                full_output[:, begin_position:assigned_up_to] = (1 - weights)[:, None, None] * full_output[:,
-                                                                                               begin_position:assigned_up_to] + \
-                                                                weights[:, None, None] * new_input[:, :overlap_size]
-
-        result = {k: np.empty([batch_size, h, w] + list(v.shape[3:]), v.dtype) for k, v in all_outputs[0][0].items()
-                  if k != _original_shape_key}  # do not try to merge 'original_shape' content...
-        if linear_interpolation:
-            for k in result.keys():
-                assigned_up_to_y = 0
-                for y, y_outputs in zip(y_pos, all_outputs):
-                    s = list(result[k].shape)
-                    tmp = np.zeros([batch_size, tile_size] + s[2:], result[k].dtype)
-                    assigned_up_to_x = 0
-                    for x, output in zip(x_pos, y_outputs):
-                        _merge_x(tmp, assigned_up_to_x, output[k], x)
-                        assigned_up_to_x = x + tile_size
-                    _merge_y(result[k], assigned_up_to_y, tmp, y)
-                    assigned_up_to_y = y + tile_size
+        images = [imread(f, mode='RGB') if isinstance(f, str) else f for f in filenames_or_arrays]
+
+        buckets = dict()
+        for i, image in enumerate(images):
+            h, w = image.shape[:2]
+            buckets.setdefault((int(np.ceil(h / bucket_step)), int(np.ceil(w / bucket_step))), []).append(i)
+
+        results = [None] * len(images)
+        for indexes in buckets.values():
+            for b in range(0, len(indexes), batch_size):
+                batch_indexes = indexes[b:b + batch_size]
+                shapes = np.array([images[i].shape[:2] for i in batch_indexes])
+                max_h, max_w = np.max(shapes, axis=0)
+                batch = np.stack([np.pad(images[i], [[0, max_h - h], [0, max_w - w], [0, 0]], mode='symmetric')
+                                  for i, (h, w) in zip(batch_indexes, shapes)])
+                with self.sema:
+                    batch_outputs = self.sess.run(output_dict, feed_dict={input_tensor: batch})
+
+                for j, (i, (h, w)) in enumerate(zip(batch_indexes, shapes)):
+                    output = dict()
+                    for k, v in batch_outputs.items():
+                        # Outputs are at network resolution, crop the same proportion of the padded batch
+                        crop_h = int(np.round(h * v.shape[1] / max_h))
+                        crop_w = int(np.round(w * v.shape[2] / max_w))
+                        output[k] = v[j:j + 1, :crop_h, :crop_w]
+                    if prediction_key:
+                        results[i] = output[prediction_key]
+                    else:
+                        output[_original_shape_key] = np.array([h, w], np.uint)
+                        results[i] = output
+        return results
+
+    def predict_with_tiles(self, filename_or_array, resized_size: int=None, tile_size: int=500,
+                           min_overlap: float=0.2, linear_interpolation: bool=True, batch_size: int=8,
+                           window: str='linear'):
+        """
+        Predicts an image by overlapping tiles. The tiles are sliced from the (resized) image in memory and
+        predicted by batches through the 'resized_images' signature. Each tile is weighted by a separable window
+        and accumulated in a single float32 buffer along with the sum of the weights, which is divided once at the end.
+        Non-float outputs (e.g. labels) are taken from the tile with the highest window weight.
+
+        :param filename_or_array: filename or RGB image [H,W,3]
+        :param resized_size: number of pixels of the image once resized, as in training (None or negative for
+            no resizing)
+        :param tile_size: size of the (square) tiles
+        :param min_overlap: minimum overlap between two neighbouring tiles, ratio of `tile_size`
+        :param linear_interpolation: whether to blend the overlapping parts of the tiles with `window`,
+            otherwise overlapping parts are averaged (they used to be overwritten by the last tile)
+        :param batch_size: number of tiles predicted in one run
+        :param window: shape of the blending ramps in the overlaps, 'linear' or 'cosine'
+        :return: dict of the predictions at the resolution of the resized image, with the original shape of the image
+        """
+        if isinstance(filename_or_array, str):
+            image_np = imread(filename_or_array, mode='RGB')
         else:
-            for k in result.keys():
-                for y, y_outputs in zip(y_pos, all_outputs):
-                    for x, output in zip(x_pos, y_outputs):
-                        result[k][:, y:y + tile_size, x:x + tile_size] = output[k]
+            image_np = filename_or_array
+        original_shape = image_np.shape[:2]
+
+        if resized_size is not None and resized_size > 0:
+            image_np = _resize_image_np(image_np, resized_size)
+        h, w = image_np.shape[:2]
+        assert h > tile_size and w > tile_size, \
+            "Image of shape {} is smaller than the tiles ({})".format((h, w), tile_size)
+        # Get x and y coordinates of beginning of tiles
+        y_pos = _tile_positions_1d(h, tile_size, min_overlap)
+        x_pos = _tile_positions_1d(w, tile_size, min_overlap)
+        window_2d = _tile_window_2d(y_pos, x_pos, tile_size, linear_interpolation, window)
+
+        input_tensor, output_dict = self._get_signature('resized_images')
+        tiles_positions = [(y, x) for y in y_pos for x in x_pos]
+
+        result = dict()
+        weights = np.zeros([h, w], np.float32)  # Sum of the windows, to normalise the blended outputs
+        best_weights = np.zeros([h, w], np.float32)  # Highest window, to select non-float outputs
+        for b in range(0, len(tiles_positions), batch_size):
+            batch_positions = tiles_positions[b:b + batch_size]
+            batch_tiles = np.stack([image_np[y:y + tile_size, x:x + tile_size]
+                                    for y, x in batch_positions]).astype(np.float32)
+            with self.sema:
+                batch_outputs = self.sess.run(output_dict, feed_dict={input_tensor: batch_tiles})
+
+            for k, v in batch_outputs.items():
+                if k not in result:
+                    dtype = np.float32 if np.issubdtype(v.dtype, np.floating) else v.dtype
+                    result[k] = np.zeros([h, w] + list(v.shape[3:]), dtype)
+
+            for n, (y, x) in enumerate(batch_positions):
+                region = (slice(y, y + tile_size), slice(x, x + tile_size))
+                is_best = window_2d > best_weights[region]
+                for k, v in batch_outputs.items():
+                    extra_dims = (1,) * (v.ndim - 3)
+                    if np.issubdtype(v.dtype, np.floating):
+                        result[k][region] += v[n] * window_2d.reshape(window_2d.shape + extra_dims)
+                    else:
+                        result[k][region] = np.where(is_best.reshape(is_best.shape + extra_dims),
+                                                     v[n], result[k][region])
+                weights[region] += window_2d
+                np.maximum(best_weights[region], window_2d, out=best_weights[region])
+
+        for k, v in result.items():
+            if np.issubdtype(v.dtype, np.floating):
+                v /= weights.reshape(weights.shape + (1,) * (v.ndim - 2))
+            # Same [1,H,W,...] format as the outputs of predict
+            result[k] = v[None]
 
-        result[_original_shape_key] = np.array([h, w], np.uint)
+        result[_original_shape_key] = np.array(original_shape, np.uint)
         return result
 
 
-def _signature_def_to_tensors(signature_def):
-    g = tf.get_default_graph()
+def _tile_positions_1d(size: int, tile_size: int, min_overlap: float) -> np.ndarray:
+    # Beginnings of the tiles along an axis, evenly spread with at least `min_overlap` between neighbours
+    step = np.ceil((size - tile_size) / (tile_size * (1 - min_overlap)))
+    return np.round(np.arange(step + 1) / step * (size - tile_size)).astype(np.int32)
+
+
+def _tile_window_2d(y_pos: np.ndarray, x_pos: np.ndarray, tile_size: int, linear_interpolation: bool=True,
+                    window: str='linear') -> np.ndarray:
+    # Separable blending window, ramps span the smallest overlap along each axis
+    if not linear_interpolation:
+        return np.ones([tile_size, tile_size], np.float32)
+    overlap_y = tile_size - np.min(np.diff(y_pos)) if len(y_pos) > 1 else 0
+    overlap_x = tile_size - np.min(np.diff(x_pos)) if len(x_pos) > 1 else 0
+    return _tile_window_1d(tile_size, overlap_y, window)[:, None] * \
+        _tile_window_1d(tile_size, overlap_x, window)[None, :]
+
+
+def _tile_window_1d(size: int, ramp_size: int, window: str='linear') -> np.ndarray:
+    """
+    1D blending window of length `size`, rising from (almost) 0 to 1 over `ramp_size` elements at both ends.
+    Its values are strictly positive so that borders of the image covered by a single tile are kept.
+
+    :param size: length of the window
+    :param ramp_size: length of the ramps (overlap between tiles)
+    :param window: 'linear' or 'cosine'
+    :return: float32 array of length `size`
+    """
+    if ramp_size <= 0:
+        return np.ones([size], np.float32)
+    positions = np.arange(size, dtype=np.float32)
+    ramp = np.clip((np.minimum(positions, size - 1 - positions) + 0.5) / ramp_size, 0, 1)
+    if window == 'linear':
+        return ramp.astype(np.float32)
+    elif window == 'cosine':
+        return (0.5 - 0.5 * np.cos(np.pi * ramp)).astype(np.float32)
+    else:
+        raise NotImplementedError('Unknown window : {}'.format(window))
+
+
+def predict_with_models(models: dict, filename_or_array, resized_size: int=None, prediction_key: str=None,
+                        n_threads: int=None) -> dict:
+    """
+    Predicts an image with several models, decoding (and resizing) it only once. The models are run concurrently,
+    which is efficient when each of them has its own session (see `ModelRegistry`).
+
+    :param models: dict of name : LoadedModel
+    :param filename_or_array: filename or RGB image [H,W,3]
+    :param resized_size: if set, the image is resized once to this number of pixels and given to the
+        'resized_images' signature of every model, otherwise the decoded image is given to their 'image' signature
+        (each model resizing it as in its training)
+    :param prediction_key: if set, only this output is computed
+    :param n_threads: number of models run concurrently (default: all of them)
+    :return: OrderedDict of name : predictions of the model (in the order of `models`), with the 'original_shape'
+        of the image
+    """
+    if isinstance(filename_or_array, str):
+        image_np = imread(filename_or_array, mode='RGB')
+    else:
+        image_np = filename_or_array
+    original_shape = np.array(image_np.shape[:2], np.uint)
+
+    if resized_size is not None and resized_size > 0:
+        predict_mode = 'resized_images'
+        input_np = _resize_image_np(image_np, resized_size)[None].astype(np.float32)
+    else:
+        predict_mode = 'image'
+        input_np = image_np
+
+    def _predict(model: LoadedModel) -> dict:
+        model = model.with_predict_mode(predict_mode)
+        if prediction_key:
+            output = {prediction_key: model.predict(input_np, prediction_key)}
+        else:
+            output = model.predict(input_np)
+        output[_original_shape_key] = original_shape
+        return output
+
+    with ThreadPoolExecutor(n_threads or len(models)) as executor:
+        outputs = executor.map(_predict, models.values())
+        return OrderedDict(zip(models.keys(), outputs))
+
+
+def fuse_probs(predictions: dict, class_index: int=1, mode: str='stack') -> np.ndarray:
+    """
+    Fuses the probabilities of a class given by several models (e.g. output of `predict_with_models`)
+
+    :param predictions: dict of name : predictions, the probabilities must have the same shape
+    :param class_index: class whose probabilities are fused
+    :param mode: 'stack' to stack the probabilities along the last axis (in the order of `predictions`),
+        'mean' or 'max' to combine them
+    :return: array [H,W,N] for 'stack', [H,W] otherwise
+    """
+    probs = np.stack([p['probs'][0][:, :, class_index] for p in predictions.values()], axis=-1)
+    if mode == 'stack':
+        return probs
+    elif mode == 'mean':
+        return np.mean(probs, axis=-1)
+    elif mode == 'max':
+        return np.max(probs, axis=-1)
+    else:
+        raise NotImplementedError('Unknown fusion mode : {}'.format(mode))
+
+
+class ModelRegistry:
+    """
+    Cache of loaded models where each export is loaded only once, in its own graph and session.
+    Models are keyed by their export directory and timestamp. The least recently used models are evicted when more than
+    `max_models` models are loaded, or when the estimated memory of the loaded models exceeds `max_memory_bytes`.
+    Each `get` takes a reference on the model which is given back with `release` : the session of an evicted model
+    is closed only once all its references are released, so that a model in use is never closed under its users.
+    Until then, it still counts in the memory of the registry and is given back by `get` instead of being reloaded.
+    All the sessions are closed by `close`, after which the models given by `get` can no longer be used.
+
+    Usage :
+        with ModelRegistry(max_models=3) as registry:
+            m = registry.get(model_base_dir, model_name, predict_mode='filename')
+            m.predict(filename)
+            registry.release(m)
+    """
+    def __init__(self, max_models: int=None, max_memory_bytes: int=None, session_config: tf.ConfigProto=None):
+        """
+        :param max_models: maximum number of models kept loaded (None for no limit)
+        :param max_memory_bytes: memory budget of the loaded models (None for no limit), the memory of a model
+            is estimated from the size of its export on disk
+        :param session_config: configuration of the sessions of the models
+        """
+        self.max_models = max_models
+        self.max_memory_bytes = max_memory_bytes
+        self.session_config = session_config
+        self._models = OrderedDict()  # (export base dir, timestamp) : (LoadedModel, memory estimate)
+        self._ref_counts = dict()  # session of a model : number of references given by `get` and not released
+        self._evicted = dict()  # evicted models which are still referenced, same format as `_models`
+        self._lock = Lock()
+
+    def get(self, model_base_dir, model_name='', predict_mode='filename',
+            num_parallel_predictions=2) -> LoadedModel:
+        """
+        Gets the model, loading it if it is not already in the registry. Same arguments as `LoadedModel`.
+        The model should be given back with `release` once it is no longer used
+        """
+        export_dir, key = self._resolve(model_base_dir, model_name)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                model, _ = self._models[key]
+            elif key in self._evicted:
+                # Still in use, it is put back rather than loaded a second time
+                self._models[key] = self._evicted.pop(key)
+                model, _ = self._models[key]
+            else:
+                sess = tf.Session(graph=tf.Graph(), config=self.session_config)
+                model = LoadedModel(export_dir, predict_mode=predict_mode,
+                                    num_parallel_predictions=num_parallel_predictions, sess=sess)
+                model.name = model_name
+                self._models[key] = (model, _estimate_export_memory(export_dir))
+            self._ref_counts[model.sess] = self._ref_counts.get(model.sess, 0) + 1
+            self._evict()
+        return model.with_predict_mode(predict_mode)
+
+    def release(self, model: LoadedModel):
+        """
+        Gives back a model obtained with `get`. If the model has been evicted and this was its last reference,
+        its session is closed
+
+        :param model: model given by `get`
+        """
+        with self._lock:
+            sess = model.sess
+            assert self._ref_counts.get(sess, 0) > 0, "Model {} released more times than it was got".format(model.name)
+            self._ref_counts[sess] -= 1
+            if self._ref_counts[sess] == 0:
+                del self._ref_counts[sess]
+                for key, (evicted_model, _) in list(self._evicted.items()):
+                    if evicted_model.sess is sess:
+                        del self._evicted[key]
+                        sess.close()
+
+    def memory_usage(self) -> int:
+        """
+        :return: estimated memory of the loaded models, in bytes, the evicted models still referenced included
+        """
+        return sum(size for _, size in list(self._models.values()) + list(self._evicted.values()))
+
+    def _evict(self):
+        # Remove the least recently used models, always keeping the last one. The sessions of the models
+        # still referenced are closed by their last `release`
+        while len(self._models) > 1 and \
+                ((self.max_models is not None and len(self._models) > self.max_models) or
+                 (self.max_memory_bytes is not None and self.memory_usage() > self.max_memory_bytes)):
+            key, (model, size) = self._models.popitem(last=False)
+            if model.sess in self._ref_counts:
+                self._evicted[key] = (model, size)
+            else:
+                model.sess.close()
+
+    def _resolve(self, model_base_dir, model_name='') -> (str, tuple):
+        # (export directory, key in the registry), the export directory being found as in `LoadedModel`
+        export_dir = _find_export_dir(model_base_dir, model_name)
+        return export_dir, _export_key(export_dir)
+
+    def close(self):
+        with self._lock:
+            for model, _ in list(self._models.values()) + list(self._evicted.values()):
+                model.sess.close()
+            self._models.clear()
+            self._ref_counts.clear()
+            self._evicted.clear()
+
+    def __contains__(self, model_base_dir):
+        try:
+            _, key = self._resolve(model_base_dir)
+        except FileNotFoundError:
+            return False
+        return key in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def make_session_config(intra_op_threads: int=0, inter_op_threads: int=0) -> tf.ConfigProto:
+    """
+    Session configuration with the given thread layout, to be used with `ModelRegistry`
+
+    :param intra_op_threads: number of threads used inside a single op (e.g. a convolution), 0 for TF default
+    :param inter_op_threads: number of ops run in parallel, 0 for TF default
+    :return: tf.ConfigProto
+    """
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
+
+
+def _resize_image_np(image: np.ndarray, resized_size: int) -> np.ndarray:
+    # Same computation of the new shape as in input_utils.resize_image
+    ratio = image.shape[1] / image.shape[0]
+    new_h = np.sqrt(resized_size / ratio)
+    new_w = resized_size / new_h
+    return cv2.resize(image, (int(new_w), int(new_h)), interpolation=cv2.INTER_LINEAR)
+
+
+def _find_export_dir(model_base_dir, model_name='') -> str:
+    mdir = os.path.join(model_base_dir, model_name)
+
+    if os.path.exists(os.path.join(mdir, 'saved_model.pbtxt')) or \
+            os.path.exists(os.path.join(mdir, 'saved_model.pb')):
+        return mdir
+    else:
+        possible_dirs = os.listdir(mdir)
+        return os.path.join(mdir, max(possible_dirs))  # Take latest export
+
+
+def _export_key(export_dir: str) -> (str, str):
+    # (directory of the exports, timestamp)
+    return os.path.split(os.path.abspath(os.path.normpath(export_dir)))
+
+
+def _estimate_export_memory(export_dir: str) -> int:
+    # The size of the variables and of the graph on disk gives an estimate of the memory of the loaded model
+    total_size = 0
+    for root, _, files in os.walk(export_dir):
+        total_size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total_size
+
+
+def _signature_def_to_tensors(signature_def, graph: tf.Graph=None):
+    g = graph if graph is not None else tf.get_default_graph()
     return {k: g.get_tensor_by_name(v.name) for k, v in signature_def.inputs.items()}, \
            {k: g.get_tensor_by_name(v.name) for k, v in signature_def.outputs.items()}
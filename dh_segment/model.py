@@ -5,7 +5,7 @@ from .utils import ModelParams, get_image_shape_tensor
 from tensorflow.contrib import layers  # TODO migration to tf.layers ?
 from tensorflow.contrib.slim.nets import resnet_v1
 from tensorflow.contrib.slim import arg_scope
-from .pretrained_models import vgg_16_fn, resnet_v1_50_fn
+from .pretrained_models import vgg_16_fn, resnet_v1_50_fn, mobilenet_v1_fn
 from collections import OrderedDict
 
 
@@ -90,8 +90,7 @@ def inference_vgg16(images: tf.Tensor, params: ModelParams, num_classes: int, us
         return logits  # [B,h,w,Classes]
 
 
-def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, weight_decay=0.0,
-                           is_training=False) -> tf.Tensor:
+def _decoder_batch_norm_fn(params: ModelParams, use_batch_norm: bool, is_training: bool):
     if use_batch_norm:
         if params.batch_renorm:
             renorm_clipping = {'rmax': 100, 'rmin': 0.1, 'dmax': 1}
@@ -99,13 +98,27 @@ def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, we
         else:
             renorm_clipping = None
             renorm_momentum = 0.99
-        batch_norm_fn = lambda x: tf.layers.batch_normalization(x, axis=-1, training=is_training, name='batch_norm',
-                                                                renorm=params.batch_renorm,
-                                                                renorm_clipping=renorm_clipping,
-                                                                renorm_momentum=renorm_momentum)
+        return lambda x: tf.layers.batch_normalization(x, axis=-1, training=is_training, name='batch_norm',
+                                                       renorm=params.batch_renorm,
+                                                       renorm_clipping=renorm_clipping,
+                                                       renorm_momentum=renorm_momentum)
     else:
-        batch_norm_fn = None
-
+        return None
+
+
+def _upsampling_decoder(images: tf.Tensor, intermediate_layers: list, params: ModelParams, num_classes: int,
+                        batch_norm_fn=None, weight_decay=0.0) -> tf.Tensor:
+    """
+    Decoder of the pretrained encoders giving one level per resolution (ResNet, MobileNet) : each level is upscaled
+    and concatenated with the previous (finer) one, up to the resolution of the images
+
+    :param images: input images [B,H,W,3]
+    :param intermediate_layers: levels of the encoder, from the finest to the coarsest
+    :param params: parameters of the model (`upscale_params`, `selected_levels_upscaling`, `max_depth` and
+        `separable_decoder`). Each level of `upscale_params` is (filter size, number of bottlenecks) with an optional
+        width multiplier of the filter size
+    :return: logits [B,H,W,num_classes]
+    """
     def upsample_conv(input_tensor, previous_intermediate_layer, layer_params, number):
         """
         Deconvolution (upscaling) layers
@@ -125,7 +138,10 @@ def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, we
                                                      method=tf.image.ResizeMethod.BILINEAR)
             net = tf.concat([upsampled_layer, previous_intermediate_layer], 3)
 
-            filter_size, nb_bottlenecks = layer_params
+            filter_size, nb_bottlenecks = layer_params[:2]
+            if len(layer_params) > 2:
+                # Width multiplier of the level
+                filter_size = max(int(filter_size * layer_params[2]), 8)
             if nb_bottlenecks > 0:
                 for i in range(nb_bottlenecks):
                     net = resnet_v1.bottleneck(
@@ -134,6 +150,14 @@ def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, we
                         depth_bottleneck=filter_size // 4,
                         stride=1
                     )
+            elif params.separable_decoder:
+                net = layers.separable_conv2d(
+                    inputs=net,
+                    num_outputs=filter_size,
+                    kernel_size=[3, 3],
+                    depth_multiplier=1,
+                    scope="conv{}".format(number)
+                )
             else:
                 net = layers.conv2d(
                     inputs=net,
@@ -144,15 +168,9 @@ def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, we
 
         return net
 
-    # Original ResNet
-    blocks_needed = max([i for i, is_needed in enumerate(params.selected_levels_upscaling) if is_needed])
-    resnet_net, intermediate_layers = resnet_v1_50_fn(images, is_training=False, blocks=blocks_needed,
-                                                      weight_decay=weight_decay, renorm=False,
-                                                      corrected_version=params.correct_resnet_version)
-
     # Upsampling
     with tf.variable_scope('upsampling'):
-        with arg_scope([layers.conv2d],
+        with arg_scope([layers.conv2d, layers.separable_conv2d],
                        normalizer_fn=batch_norm_fn,
                        weights_regularizer=layers.l2_regularizer(weight_decay)):
             selected_upscale_params = [l for i, l in enumerate(params.upscale_params)
@@ -205,6 +223,32 @@ def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, we
     return logits
 
 
+def inference_resnet_v1_50(images, params, num_classes, use_batch_norm=False, weight_decay=0.0,
+                           is_training=False) -> tf.Tensor:
+    batch_norm_fn = _decoder_batch_norm_fn(params, use_batch_norm, is_training)
+
+    # Original ResNet
+    blocks_needed = max([i for i, is_needed in enumerate(params.selected_levels_upscaling) if is_needed])
+    resnet_net, intermediate_layers = resnet_v1_50_fn(images, is_training=False, blocks=blocks_needed,
+                                                      weight_decay=weight_decay, renorm=False,
+                                                      corrected_version=params.correct_resnet_version)
+
+    return _upsampling_decoder(images, intermediate_layers, params, num_classes, batch_norm_fn, weight_decay)
+
+
+def inference_mobilenet_v1(images, params, num_classes, use_batch_norm=False, weight_decay=0.0,
+                           is_training=False) -> tf.Tensor:
+    batch_norm_fn = _decoder_batch_norm_fn(params, use_batch_norm, is_training)
+
+    # Original MobileNet, with its batch norms frozen like ResNet's
+    blocks_needed = max([i for i, is_needed in enumerate(params.selected_levels_upscaling) if is_needed])
+    mobilenet_net, intermediate_layers = mobilenet_v1_fn(images, is_training=False, blocks=blocks_needed,
+                                                         depth_multiplier=params.depth_multiplier,
+                                                         weight_decay=weight_decay)
+
+    return _upsampling_decoder(images, intermediate_layers, params, num_classes, batch_norm_fn, weight_decay)
+
+
 def conv_bn_layer(input_tensor, kernel_size, output_channels, stride=1, bn=False,
                   is_training=True, relu=True):
     # with tf.variable_scope(name) as scope:
@@ -0,0 +1,50 @@
+import numpy as np
+import cv2
+
+
+def dequantize_probs(probs: np.ndarray) -> np.ndarray:
+    """
+    Converts the uint8 probabilities of the 'compact_output' signature back to floats in range [0, 1]
+
+    :param probs: uint8 array
+    :return: float32 array
+    """
+    return probs.astype(np.float32) / 255
+
+
+def upscale_prediction(prediction: np.ndarray, scale, region: tuple=None,
+                       interpolation: int=cv2.INTER_LINEAR) -> np.ndarray:
+    """
+    Upscales a prediction of the 'compact_output' signature to the resolution of the original image.
+    A region can be given so that only this part of the image is upscaled.
+
+    :param prediction: prediction at network resolution [h, w] or [h, w, C] (without batch dimension)
+    :param scale: scale factors (sy, sx) from the network resolution to the original image ('scale' output)
+    :param region: (x, y, w, h) in the coordinates of the original image, the full image if None
+        (use (0, 0, original_shape[1], original_shape[0]) to get exactly the shape of the original image)
+    :param interpolation: cv2 interpolation, use cv2.INTER_NEAREST for labels and binary masks
+    :return: upscaled prediction, same dtype as `prediction`
+    """
+    sy, sx = float(scale[0]), float(scale[1])
+    if region is None:
+        x, y = 0, 0
+        w, h = int(round(prediction.shape[1] * sx)), int(round(prediction.shape[0] * sy))
+    else:
+        x, y, w, h = region
+
+    # Source window covering the region, with a one pixel margin for the interpolation
+    x0, y0 = max(int(np.floor(x / sx)) - 1, 0), max(int(np.floor(y / sy)) - 1, 0)
+    x1 = min(int(np.ceil((x + w) / sx)) + 1, prediction.shape[1])
+    y1 = min(int(np.ceil((y + h) / sy)) + 1, prediction.shape[0])
+    window = prediction[y0:y1, x0:x1]
+
+    # Affine mapping from destination pixels to window pixels (pixel centers aligned as in cv2.resize)
+    transform = np.array([[1 / sx, 0, (x + 0.5) / sx - 0.5 - x0],
+                          [0, 1 / sy, (y + 0.5) / sy - 0.5 - y0]], np.float32)
+    channels = [window] if window.ndim == 2 else [window[:, :, c] for c in range(window.shape[2])]
+    # cv2.warpAffine is limited in number of channels and types, warp each channel separately
+    upscaled = [cv2.warpAffine(c if c.dtype != bool else c.astype(np.uint8), transform, (w, h),
+                               flags=interpolation | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+                for c in channels]
+    upscaled = upscaled[0] if window.ndim == 2 else np.stack(upscaled, axis=-1)
+    return upscaled.astype(prediction.dtype, copy=False)
@@ -121,3 +121,52 @@ def resnet_v1_50_fn(input_tensor: tf.Tensor, is_training=False, blocks=4, weight
             intermediate_layers.append(endpoints[d])
 
         return net, intermediate_layers
+
+
+# MobileNet v1 layers after the first convolution : (stride, depth) of the depthwise separable convolutions
+_MOBILENET_V1_CONV_DEFS = [(1, 64), (2, 128), (1, 128), (2, 256), (1, 256), (2, 512),
+                           (1, 512), (1, 512), (1, 512), (1, 512), (1, 512), (2, 1024), (1, 1024)]
+
+
+def mobilenet_v1_fn(input_tensor: tf.Tensor, is_training=False, blocks=4, depth_multiplier=1.0, weight_decay=0.00004,
+                    min_depth=8) -> (tf.Tensor, list):  # list of tf.Tensors (layers)
+    """
+    MobileNet v1 encoder, with the variable names of the slim checkpoints (scope 'MobilenetV1')
+
+    :param input_tensor: images [B,H,W,3] with values in [0, 255]
+    :param blocks: number of downscaling levels after the first one (0 < blocks <= 4)
+    :param depth_multiplier: width multiplier of all the layers, must match the checkpoint
+    :return: (last layer, [last layer of each resolution, from 1/2 to 1/2**(blocks+1)])
+    """
+    assert 0 < blocks <= 4
+
+    def _depth(d):
+        return max(int(d * depth_multiplier), min_depth)
+
+    batch_norm_params = {'is_training': is_training, 'center': True, 'scale': True,
+                         'decay': 0.9997, 'epsilon': 0.001}
+    with slim.arg_scope([layers.conv2d, layers.separable_conv2d], padding='SAME', activation_fn=tf.nn.relu6,
+                        normalizer_fn=layers.batch_norm, normalizer_params=batch_norm_params), \
+            slim.arg_scope([layers.conv2d], weights_regularizer=layers.l2_regularizer(weight_decay)), \
+            slim.arg_scope([layers.separable_conv2d], weights_regularizer=None):
+        with tf.variable_scope('MobilenetV1', 'MobilenetV1', [input_tensor]):
+            # Inputs of the pretrained model are in [-1, 1]
+            net = tf.subtract(input_tensor / 127.5, 1., name='Preprocessing')
+            net = layers.conv2d(net, _depth(32), [3, 3], stride=2, scope='Conv2d_0')
+
+            intermediate_levels = []
+            n_levels = 1
+            for i, (stride, depth) in enumerate(_MOBILENET_V1_CONV_DEFS):
+                if stride == 2:
+                    # Last layer of the previous resolution
+                    intermediate_levels.append(net)
+                    if n_levels > blocks:
+                        break
+                    n_levels += 1
+                net = layers.separable_conv2d(net, None, [3, 3], depth_multiplier=1, stride=stride,
+                                              scope='Conv2d_{}_depthwise'.format(i + 1))
+                net = layers.conv2d(net, _depth(depth), [1, 1], stride=1, scope='Conv2d_{}_pointwise'.format(i + 1))
+            else:
+                intermediate_levels.append(net)
+
+            return net, intermediate_levels
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Local HTTP prediction server. The model is loaded once and kept warm, requests arriving within a short latency
+window are predicted together in a single batch.
+
+python -m dh_segment.serve -m <export_dir> --port 8080
+
+Endpoints :
+    POST /predict?output=probs|boxes|page_xml   body : encoded image (JPEG, PNG, ...)
+        - probs : .npy file of the uint8 probabilities [h,w,C] at network resolution
+        - boxes : JSON with the original shape and the boxes found on the probabilities of `class_index`
+          (query parameters : class_index, box_mode, n_max_boxes)
+        - page_xml : PAGE XML file with the largest box as page border
+    GET /stats    JSON with the number of requests and the latency percentiles (ms)
+    GET /health
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import cv2
+import numpy as np
+from .loader import ModelRegistry, LoadedModel
+from .post_processing import binarization, boxes_detection, PAGE
+
+_STATUS_MESSAGES = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_image(image_bytes: bytes) -> np.ndarray:
+    """
+    :param image_bytes: encoded image
+    :return: RGB image [H,W,3]
+    """
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise HTTPError(400, 'Could not decode the image')
+    return image[:, :, ::-1]
+
+
+def find_boxes(prediction: dict, class_index: int=1, mode: str='min_rectangle', n_max_boxes=math.inf) -> list:
+    """
+    Finds the boxes of a class from its probabilities, as in the page demo
+
+    :param prediction: predictions of an image with its 'original_shape'
+    :param class_index: class of the boxes
+    :param mode: 'min_rectangle', 'quadrilateral' or 'rectangle'
+    :param n_max_boxes: maximum number of boxes
+    :return: list of boxes [[x1,y1], ..., [x4,y4]] in the coordinates of the original image, by decreasing area
+    """
+    probs = prediction['probs'][0][:, :, class_index]
+    probs = probs / max(np.max(probs), 1e-6)
+    mask = binarization.cleaning_binary(binarization.thresholding(probs), size=5)
+    original_shape = prediction['original_shape']
+    mask_upscaled = cv2.resize(mask.astype(np.uint8, copy=False), (int(original_shape[1]), int(original_shape[0])),
+                               interpolation=cv2.INTER_NEAREST)
+    boxes = boxes_detection.find_boxes(mask_upscaled, mode=mode, n_max_boxes=n_max_boxes)
+    if boxes is None:
+        return []
+    elif n_max_boxes == 1:
+        return [boxes]
+    return boxes
+
+
+class PredictionServer:
+    """
+    asyncio HTTP server around a `LoadedModel` (predict mode 'image_batch'), batching the requests which arrive
+    within `batch_latency` seconds of each other.
+    """
+    def __init__(self, model: LoadedModel, max_batch_size: int=8, batch_latency: float=0.01,
+                 n_post_processing_threads: int=2, latency_history: int=10000):
+        """
+        :param model: model used for the predictions, it must have been exported with the 'from_image_batch' signature
+        :param max_batch_size: maximum number of images predicted in one run
+        :param batch_latency: time (in seconds) waited for other requests before predicting a batch
+        :param n_post_processing_threads: number of threads decoding images and post-processing predictions
+        :param latency_history: number of latest requests used for the latency statistics
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.batch_latency = batch_latency
+        self._prediction_executor = ThreadPoolExecutor(1)
+        self._executor = ThreadPoolExecutor(n_post_processing_threads)
+        self._latencies = deque(maxlen=latency_history)
+        self._n_requests = 0
+        self._queue = None
+        self._loop = None
+
+    def warm_up(self, shape: tuple=(600, 400)):
+        """
+        Runs a prediction so that the first request does not pay for the initialisation of the session
+        """
+        self.model.predict_batch([np.zeros(list(shape) + [3], np.uint8)])
+
+    async def predict(self, image: np.ndarray) -> dict:
+        future = self._loop.create_future()
+        await self._queue.put((image, future))
+        return await future
+
+    async def _batching_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.batch_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            images, futures = zip(*batch)
+            try:
+                predictions = await self._loop.run_in_executor(
+                    self._prediction_executor,
+                    lambda: self.model.predict_batch(list(images), batch_size=self.max_batch_size))
+                for future, prediction in zip(futures, predictions):
+                    future.set_result(prediction)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+
+    def _format_output(self, prediction: dict, query: dict) -> (bytes, str):
+        output = query.get('output', 'probs')
+        if output == 'probs':
+            buffer = io.BytesIO()
+            np.save(buffer, np.uint8(255 * prediction['probs'][0]))
+            return buffer.getvalue(), 'application/octet-stream'
+
+        class_index = int(query.get('class_index', 1))
+        mode = query.get('box_mode', 'min_rectangle')
+        n_max_boxes = int(query['n_max_boxes']) if 'n_max_boxes' in query else math.inf
+        boxes = find_boxes(prediction, class_index, mode, n_max_boxes)
+        original_shape = [int(s) for s in prediction['original_shape']]
+        if output == 'boxes':
+            body = json.dumps({'original_shape': original_shape, 'boxes': [b.tolist() for b in boxes]})
+            return body.encode(), 'application/json'
+        elif output == 'page_xml':
+            page_border = PAGE.Border(coords=PAGE.Point.cv2_to_point_list(boxes[0][:, None, :])) if boxes else None
+            page_xml = PAGE.Page(query.get('filename', 'image'), image_width=original_shape[1],
+                                 image_height=original_shape[0], page_border=page_border)
+            buffer = io.BytesIO()
+            page_xml.write_to_file(buffer, creator_name='dhSegment')
+            return buffer.getvalue(), 'application/xml'
+        else:
+            raise HTTPError(400, 'Unknown output : {}'.format(output))
+
+    def latency_stats(self) -> dict:
+        """
+        :return: number of requests and percentiles of the latency (in ms) of the latest requests
+        """
+        stats = {'n_requests': self._n_requests}
+        if self._latencies:
+            latencies = 1000 * np.array(self._latencies)
+            stats.update({'mean': float(np.mean(latencies)),
+                          **{'p{}'.format(p): float(np.percentile(latencies, p)) for p in [50, 90, 95, 99]}})
+        return stats
+
+    async def _handle_request(self, method: str, path: str, query: dict, body: bytes) -> (bytes, str):
+        if method == 'GET' and path == '/health':
+            return b'OK', 'text/plain'
+        elif method == 'GET' and path == '/stats':
+            return json.dumps(self.latency_stats()).encode(), 'application/json'
+        elif method == 'POST' and path == '/predict':
+            start = time.time()
+            image = await self._loop.run_in_executor(self._executor, decode_image, body)
+            prediction = await self.predict(image)
+            result = await self._loop.run_in_executor(self._executor, self._format_output, prediction, query)
+            self._latencies.append(time.time() - start)
+            self._n_requests += 1
+            return result
+        else:
+            raise HTTPError(404, 'Unknown endpoint : {} {}'.format(method, path))
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target = request_line.decode('latin-1').split(' ')[:2]
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in [b'\r\n', b'\n', b'']:
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            url = urlsplit(target)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            try:
+                status, (response, content_type) = 200, await self._handle_request(method, url.path, query, body)
+            except HTTPError as e:
+                status, response, content_type = e.status, str(e).encode(), 'text/plain'
+            except Exception as e:
+                status, response, content_type = 500, str(e).encode(), 'text/plain'
+
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                status, _STATUS_MESSAGES[status], content_type, len(response)).encode('latin-1'))
+            writer.write(response)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def run(self, host: str='127.0.0.1', port: int=8080):
+        """
+        Serves until interrupted
+        """
+        self._loop = asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        batching_task = asyncio.ensure_future(self._batching_loop())
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle_connection, host, port))
+        print('Serving on {}'.format(server.sockets[0].getsockname()))
+        try:
+            self._loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            batching_task.cancel()
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_dir', type=str, required=True,
+                        help='Directory of the exported model (or of its exports)')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('-b', '--max_batch_size', type=int, default=8, help='Maximum number of images per batch')
+    parser.add_argument('-l', '--batch_latency_ms', type=float, default=10,
+                        help='Time waited for other requests before predicting a batch (ms)')
+    args = vars(parser.parse_args())
+
+    with ModelRegistry() as registry:
+        model = registry.get(args.get('model_dir'), predict_mode='image_batch')
+        prediction_server = PredictionServer(model, max_batch_size=args.get('max_batch_size'),
+                                             batch_latency=args.get('batch_latency_ms') / 1000)
+        prediction_server.warm_up()
+        prediction_server.run(args.get('host'), args.get('port'))
+        registry.release(model)
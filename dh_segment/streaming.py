@@ -0,0 +1,172 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+import numpy as np
+from scipy.misc import imread
+from .loader import LoadedModel
+
+# Markers passed through the queues instead of a filename
+_END = object()
+_ERROR = object()
+
+
+def read_image(filename: str) -> np.ndarray:
+    """
+    Default reader of `predict_stream`, decodes the image as an RGB array [H,W,3]
+    """
+    return imread(filename, mode='RGB')
+
+
+def save_probs_npy(filename: str, prediction: dict, output_dir: str) -> str:
+    """
+    Post-processing function saving the probabilities as uint8 in a .npy file named after the input image.
+    Use it with `functools.partial(save_probs_npy, output_dir=...)`
+
+    :param filename: filename of the predicted image
+    :param prediction: prediction dict given by `LoadedModel.predict`
+    :param output_dir: directory where to save the file
+    :return: the filename of the saved file
+    """
+    output_filename = os.path.join(output_dir, '{}.npy'.format(os.path.basename(filename).split('.')[0]))
+    np.save(output_filename, np.uint8(255 * prediction['probs'][0]))
+    return output_filename
+
+
+def _completed_future(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def predict_stream(model: LoadedModel, filenames: list, post_process_fn=None, read_fn=read_image,
+                   n_readers: int=4, n_post_processors: int=2, max_queue_size: int=8, prediction_key: str=None,
+                   predict_fn=None):
+    """
+    Predicts a set of images with a pipeline whose stages run concurrently : images are decoded by a pool of
+    threads, predicted by the model in a dedicated thread and post-processed in a pool of processes.
+    Stages are chained with bounded queues, so that the time per image tends to the one of the slowest stage
+    while the memory usage stays bounded.
+
+    :param model: model loaded with a predict_mode taking decoded images (e.g. 'image', 'image_original_shape')
+    :param filenames: filenames of the images to process
+    :param post_process_fn: function (filename, prediction) -> result, called in another process, it must thus be
+        picklable (module-level function or `functools.partial` of one). If None, the predictions are returned
+    :param read_fn: function filename -> input of `model.predict`, called in the reader threads
+    :param n_readers: number of reader threads
+    :param n_post_processors: number of post-processing processes
+    :param max_queue_size: maximum number of images waiting between two stages
+    :param prediction_key: if set, only this output of the model is computed
+    :param predict_fn: function (model, input) -> prediction called in the prediction thread instead of
+        `model.predict`, e.g. `functools.partial(LoadedModel.predict_with_tiles, tile_size=...)`
+    :return: generator of (filename, result) in the order of `filenames`
+    """
+    read_queue = Queue(maxsize=max_queue_size)
+    output_queue = Queue(maxsize=max_queue_size)
+    stop_event = Event()
+    if predict_fn is None:
+        def predict_fn(m, input_data):
+            return m.predict(input_data, prediction_key=prediction_key)
+
+    def _put(queue, item):
+        # Blocking put which gives up if the consumer is gone
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _get(queue):
+        # Blocking get which gives up if the pipeline is stopped
+        while not stop_event.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return _END, None
+
+    def _read_loop(reader_pool):
+        try:
+            for filename in filenames:
+                if stop_event.is_set():
+                    return
+                _put(read_queue, (filename, reader_pool.submit(read_fn, filename)))
+            _put(read_queue, (_END, None))
+        except Exception as e:
+            _put(read_queue, (_ERROR, e))
+
+    def _predict_loop(post_process_pool):
+        try:
+            while not stop_event.is_set():
+                filename, item = _get(read_queue)
+                if filename is _END or filename is _ERROR:
+                    _put(output_queue, (filename, item))
+                    return
+                prediction = predict_fn(model, item.result())
+                if post_process_fn is not None:
+                    result = post_process_pool.submit(post_process_fn, filename, prediction)
+                else:
+                    result = _completed_future(prediction)
+                _put(output_queue, (filename, result))
+        except Exception as e:
+            _put(output_queue, (_ERROR, e))
+
+    with ThreadPoolExecutor(n_readers) as reader_pool, \
+            ProcessPoolExecutor(n_post_processors) as post_process_pool:
+        threads = [Thread(target=_read_loop, args=(reader_pool,), daemon=True),
+                   Thread(target=_predict_loop, args=(post_process_pool,), daemon=True)]
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                filename, item = output_queue.get()
+                if filename is _END:
+                    break
+                elif filename is _ERROR:
+                    raise item
+                yield filename, item.result()
+        finally:
+            stop_event.set()
+            for t in threads:
+                t.join()
+
+
+class ParallelPredictor:
+    """
+    Drives `predict` of a model from a pool of threads, so that several runs of the session are executed concurrently.
+    The number of threads is the `num_parallel_predictions` of the model, the threads used by each run being set
+    by the session configuration (see `loader.make_session_config`).
+
+    Usage :
+        with ParallelPredictor(model) as predictor:
+            for prediction in predictor.map(images):
+                ...
+    """
+    def __init__(self, model: LoadedModel, prediction_key: str=None):
+        """
+        :param model: loaded model, its `num_parallel_predictions` gives the number of threads
+        :param prediction_key: if set, only this output of the model is computed
+        """
+        self.model = model
+        self.prediction_key = prediction_key
+        self._executor = ThreadPoolExecutor(model.num_parallel_predictions)
+
+    def submit(self, input_data) -> Future:
+        return self._executor.submit(self.model.predict, input_data, self.prediction_key)
+
+    def map(self, inputs):
+        """
+        :param inputs: iterable of inputs of `model.predict`
+        :return: iterator of the predictions, in the order of `inputs`
+        """
+        return self._executor.map(lambda x: self.model.predict(x, self.prediction_key), inputs)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
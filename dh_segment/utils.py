@@ -64,13 +64,14 @@ class VGG16ModelParams:
         False
     ]
     CORRECTED_VERSION = None
+    DEPTH_MULTIPLIER = None
 
 
 class ResNetModelParams:
     PRETRAINED_MODEL_FILE = 'pretrained_models/resnet_v1_50.ckpt'
     INTERMEDIATE_CONV = None
     UPSCALE_PARAMS = [
-        # (Filter size (depth bottleneck's output), number of bottleneck)
+        # (Filter size (depth bottleneck's output), number of bottleneck[, width multiplier of the filter size])
         (32, 0),
         (64, 0),
         (128, 0),
@@ -86,6 +87,32 @@ class ResNetModelParams:
         True
     ]
     CORRECT_VERSION = False
+    DEPTH_MULTIPLIER = None
+
+
+class MobileNetModelParams:
+    # Depends on the depth multiplier (see download_mobilenet_pretrained_model.py)
+    PRETRAINED_MODEL_FILE = 'pretrained_models/mobilenet_v1_{depth_multiplier}_224.ckpt'
+    INTERMEDIATE_CONV = None
+    UPSCALE_PARAMS = [
+        # (Filter size (depth bottleneck's output), number of bottleneck[, width multiplier of the filter size])
+        (32, 0),
+        (64, 0),
+        (128, 0),
+        (256, 0),
+        (256, 0)
+    ]
+    SELECTED_LAYERS_UPSCALING = [
+        # Must have the same length as UPSCALE_PARAMS
+        True,
+        True,
+        True,
+        True,
+        True
+    ]
+    CORRECT_VERSION = False
+    # Width multiplier of the encoder, must match the pretrained checkpoint (1.0, 0.75, 0.5 or 0.25)
+    DEPTH_MULTIPLIER = 1.0
 
 
 class UNetModelParams:
@@ -94,6 +121,7 @@ class UNetModelParams:
     UPSCALE_PARAMS = None
     SELECTED_LAYERS_UPSCALING = None
     CORRECT_VERSION = False
+    DEPTH_MULTIPLIER = None
 
 
 class ModelParams(BaseParams):
@@ -104,17 +132,25 @@ class ModelParams(BaseParams):
         self.n_classes = kwargs.get('n_classes', None)  # type: int
         self.pretrained_model_name = kwargs.get('pretrained_model_name', None)  # type: str
         self.max_depth = kwargs.get('max_depth', 512)  # type: int
+        # Depthwise separable 3x3 convolutions in the decoder (levels without bottlenecks)
+        self.separable_decoder = kwargs.get('separable_decoder', False)  # type: bool
 
         if self.pretrained_model_name == 'vgg16':
             model_class = VGG16ModelParams
         elif self.pretrained_model_name == 'resnet50':
             model_class = ResNetModelParams
+        elif self.pretrained_model_name == 'mobilenet_v1':
+            model_class = MobileNetModelParams
         elif self.pretrained_model_name == 'unet':
             model_class = UNetModelParams
         else:
             raise NotImplementedError
 
-        self.pretrained_model_file = kwargs.get('pretrained_model_file', model_class.PRETRAINED_MODEL_FILE)
+        self.depth_multiplier = kwargs.get('depth_multiplier', model_class.DEPTH_MULTIPLIER)
+        default_pretrained_model_file = model_class.PRETRAINED_MODEL_FILE
+        if default_pretrained_model_file is not None:
+            default_pretrained_model_file = default_pretrained_model_file.format(depth_multiplier=self.depth_multiplier)
+        self.pretrained_model_file = kwargs.get('pretrained_model_file', default_pretrained_model_file)
         self.intermediate_conv = kwargs.get('intermediate_conv', model_class.INTERMEDIATE_CONV)
         self.upscale_params = kwargs.get('upscale_params', model_class.UPSCALE_PARAMS)
         self.selected_levels_upscaling = kwargs.get('selected_levels_upscaling', model_class.SELECTED_LAYERS_UPSCALING)
@@ -122,6 +158,16 @@ class ModelParams(BaseParams):
         self.check_params()
 
     def check_params(self):
+        if self.pretrained_model_name == 'mobilenet_v1':
+            # A default checkpoint of another depth multiplier would not restore (e.g. kept from a previous config)
+            default_files = [MobileNetModelParams.PRETRAINED_MODEL_FILE.format(depth_multiplier=m)
+                             for m in [1.0, 0.75, 0.5, 0.25]]
+            assert self.pretrained_model_file not in default_files or self.pretrained_model_file == \
+                MobileNetModelParams.PRETRAINED_MODEL_FILE.format(depth_multiplier=self.depth_multiplier), \
+                'Pretrained weights file {} does not match depth_multiplier={}'.format(self.pretrained_model_file,
+                                                                                      self.depth_multiplier)
+        assert not self.separable_decoder or self.pretrained_model_name in ['resnet50', 'mobilenet_v1'], \
+            'The separable decoder is only implemented for resnet50 and mobilenet_v1'
         # Pretrained model name check
         # assert self.upscale_params is not None and self.selected_levels_upscaling is not None, \
         #     'Model parameters cannot be None'
@@ -154,6 +200,10 @@ class TrainingParams(BaseParams):
         self.data_augmentation_max_scaling = 0.05  # range : [0, 1]
         self.make_patches = True
         self.patch_shape = (300, 300)
+        # 'grid' : all the patches overlapping by half, 'random' : n_patches_per_image random patches,
+        # 'class_balanced' : n_patches_per_image patches centered on the pixels of random labels
+        self.patch_sampling = 'grid'
+        self.n_patches_per_image = 16
         # If input_resized_size == -1, no resizing is done
         self.input_resized_size = int(72e4)  # (600*1200) # type: int
         self.weights_labels = None
@@ -165,23 +215,66 @@ class TrainingParams(BaseParams):
 
     def check_params(self):
         assert self.training_margin*2 < min(self.patch_shape)
+        assert self.patch_sampling in ['grid', 'random', 'class_balanced']
+
+
+def _pack_colors(colors):
+    """
+    Packs RGB values [..., 3] into a single integer key [...] (tf.Tensor or np.ndarray)
+    """
+    if isinstance(colors, np.ndarray):
+        colors = np.clip(np.round(colors), 0, 255).astype(np.int32)
+        return (colors[..., 0] << 16) + (colors[..., 1] << 8) + colors[..., 2]
+    colors = tf.clip_by_value(tf.to_int32(tf.round(tf.to_float(colors))), 0, 255)
+    return colors[..., 0] * 65536 + colors[..., 1] * 256 + colors[..., 2]
+
+
+def colors_to_indexes(label_image: tf.Tensor, colors_values: np.ndarray) -> tf.Tensor:
+    """
+    Maps each pixel of a label image to the index of its color in `colors_values`. Colors are packed into int32 keys
+    which are looked up with a binary search in the sorted keys of `colors_values`, so that the memory used
+    is proportional to the number of pixels. Only the pixels whose color is unknown are assigned to the nearest color.
+
+    :param label_image: RGB label image [..., 3]
+    :param colors_values: colors [C, 3]
+    :return: indexes in `colors_values` [...], int64
+    """
+    with tf.name_scope('ColorsToIndexes'):
+        # Keep the first class of a color if several classes share it
+        sorted_keys, first_indexes = np.unique(_pack_colors(colors_values), return_index=True)
+        # Padding to a power of 2 for a branchless binary search
+        n_steps = int(np.ceil(np.log2(len(sorted_keys) + 1)))
+        n_padding = 2 ** n_steps - len(sorted_keys)
+        sorted_keys = tf.constant(np.concatenate([sorted_keys, np.full(n_padding, np.iinfo(np.int32).max)])
+                                  .astype(np.int32))
+        first_indexes = tf.constant(np.concatenate([first_indexes, np.zeros(n_padding)]).astype(np.int64))
+
+        keys = _pack_colors(label_image)
+        # Position of the first sorted key >= key
+        position = tf.zeros_like(keys)
+        for step in [2 ** i for i in reversed(range(n_steps))]:
+            candidate = position + step
+            position = tf.where(tf.gather(sorted_keys, candidate - 1) < keys, candidate, position)
+        found = tf.equal(tf.gather(sorted_keys, position), keys)
+        indexes = tf.gather(first_indexes, position)
+
+        # Nearest color for the unknown colors
+        unknown_positions = tf.where(tf.logical_not(found))  # [N, rank]
+        unknown_colors = tf.gather_nd(tf.to_float(label_image), unknown_positions)  # [N, 3]
+        distances = tf.reduce_sum(tf.square(unknown_colors[:, None, :] -
+                                            tf.constant(colors_values[None, :, :], tf.float32)), axis=-1)  # [N, C]
+        nearest_indexes = tf.scatter_nd(unknown_positions, tf.argmin(distances, axis=-1),
+                                        tf.shape(indexes, out_type=tf.int64))
+        return tf.where(found, indexes, nearest_indexes)
 
 
 def label_image_to_class(label_image: tf.Tensor, classes_file: str) -> tf.Tensor:
     classes_color_values = get_classes_color_from_file(classes_file)
-    # Convert label_image [H,W,3] to the classes [H,W],int32 according to the classes [C,3]
+    # Convert label_image [H,W,3] to the classes [H,W],int64 according to the classes [C,3]
     with tf.name_scope('LabelAssign'):
-        if len(label_image.get_shape()) == 3:
-            diff = tf.cast(label_image[:, :, None, :], tf.float32) - tf.constant(classes_color_values[None, None, :, :])  # [H,W,C,3]
-        elif len(label_image.get_shape()) == 4:
-            diff = tf.cast(label_image[:, :, :, None, :], tf.float32) - tf.constant(
-                classes_color_values[None, None, None, :, :])  # [B,H,W,C,3]
-        else:
+        if len(label_image.get_shape()) not in [3, 4]:
             raise NotImplementedError('Length is : {}'.format(len(label_image.get_shape())))
-
-        pixel_class_diff = tf.reduce_sum(tf.square(diff), axis=-1)  # [H,W,C] or [B,H,W,C]
-        class_label = tf.argmin(pixel_class_diff, axis=-1)  # [H,W] or [B,H,W]
-        return class_label
+        return colors_to_indexes(label_image, classes_color_values)  # [H,W] or [B,H,W]
 
 
 def class_to_label_image(class_label: tf.Tensor, classes_file: str) -> tf.Tensor:
@@ -191,18 +284,11 @@ def class_to_label_image(class_label: tf.Tensor, classes_file: str) -> tf.Tensor
 
 def multilabel_image_to_class(label_image: tf.Tensor, classes_file: str) -> tf.Tensor:
     classes_color_values, colors_labels = get_classes_color_from_file_multilabel(classes_file)
-    # Convert label_image [H,W,3] to the classes [H,W,C],int32 according to the classes [C,3]
+    # Convert label_image [H,W,3] to the classes [H,W,C],bool according to the classes [C,3]
     with tf.name_scope('LabelAssign'):
-        if len(label_image.get_shape()) == 3:
-            diff = tf.cast(label_image[:, :, None, :], tf.float32) - tf.constant(classes_color_values[None, None, :, :])  # [H,W,C,3]
-        elif len(label_image.get_shape()) == 4:
-            diff = tf.cast(label_image[:, :, :, None, :], tf.float32) - tf.constant(
-                classes_color_values[None, None, None, :, :])  # [B,H,W,C,3]
-        else:
+        if len(label_image.get_shape()) not in [3, 4]:
             raise NotImplementedError('Length is : {}'.format(len(label_image.get_shape())))
-
-        pixel_class_diff = tf.reduce_sum(tf.square(diff), axis=-1)  # [H,W,C] or [B,H,W,C]
-        class_label = tf.argmin(pixel_class_diff, axis=-1)  # [H,W] or [B,H,W]
+        class_label = colors_to_indexes(label_image, classes_color_values)  # [H,W] or [B,H,W]
 
         return tf.gather(colors_labels, class_label) > 0
 
@@ -211,13 +297,16 @@ def multiclass_to_label_image(class_label_tensor: tf.Tensor, classes_file: str)
 
     classes_color_values, colors_labels = get_classes_color_from_file_multilabel(classes_file)
 
+    # Lookup table of the colors indexed by the labels packed as bits
     n_classes = colors_labels.shape[1]
-    c = np.zeros((2,)*n_classes+(3,), np.int32)
+    bits = 2 ** np.arange(n_classes)
+    c = np.zeros((2 ** n_classes, 3), np.int32)
     for c_value, inds in zip(classes_color_values, colors_labels):
-        c[tuple(inds)] = c_value
+        c[np.sum(bits * inds)] = c_value
 
     with tf.name_scope('Label2Img'):
-        return tf.gather_nd(c, tf.cast(class_label_tensor, tf.int32))
+        packed_labels = tf.reduce_sum(tf.cast(class_label_tensor, tf.int32) * tf.constant(bits, tf.int32), axis=-1)
+        return tf.gather(c, packed_labels)
 
 
 def get_classes_color_from_file(classes_file: str) -> np.ndarray:
@@ -5,7 +5,9 @@ import os
 import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
-from doc_seg.loader import LoadedModel
+from dh_segment.loader import LoadedModel
+from dh_segment.streaming import predict_stream, save_probs_npy
+from functools import partial
 from cini_post_processing import cini_post_processing_fn
 from cini_evaluation import cini_evaluate_folder
 
@@ -17,8 +19,8 @@ from glob import glob
 from scipy.misc import imread, imresize, imsave
 import tempfile
 import json
-from doc_seg.post_processing import PAGE
-from doc_seg.utils import hash_dict, dump_json
+from dh_segment.post_processing import PAGE
+from dh_segment.utils import hash_dict, dump_json
 
 
 def predict_on_set(filenames_to_predict, model_dir, output_dir):
@@ -30,11 +32,11 @@ def predict_on_set(filenames_to_predict, model_dir, output_dir):
     :return:
     """
     with tf.Session():
-        m = LoadedModel(model_dir, 'filename')
-        for filename in tqdm(filenames_to_predict, desc='Prediction'):
-            pred = m.predict(filename)['probs'][0]
-            np.save(os.path.join(output_dir, os.path.basename(filename).split('.')[0]),
-                    np.uint8(255 * pred))
+        m = LoadedModel(model_dir, predict_mode='image')
+        # Decoding, prediction and saving of the files are run concurrently
+        for _ in tqdm(predict_stream(m, filenames_to_predict, partial(save_probs_npy, output_dir=output_dir)),
+                      total=len(filenames_to_predict), desc='Prediction'):
+            pass
 
 
 def find_elements(img_filenames, dir_predictions, post_process_params, output_dir, debug=False, mask_dir: str=None):
@@ -4,7 +4,9 @@ __author__ = 'solivr'
 import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
-from doc_seg.loader import LoadedModel
+from dh_segment.loader import LoadedModel
+from dh_segment.streaming import predict_stream, save_probs_npy
+from functools import partial
 import tensorflow as tf
 from glob import glob
 import numpy as np
@@ -25,11 +27,13 @@ PARAMS = {'thresholds': [0.5, 0.5, 0.5], 'min_cc': 50}
 
 def predict_on_set(filenames_to_predict, model_dir, output_dir):
     with tf.Session():
-        m = LoadedModel(model_dir, 'filename')
-        for filename in tqdm(filenames_to_predict, desc='Prediction'):
-            pred = m.predict_with_tiles(filename, tile_size=TILE_SIZE, resized_size=None)['probs'][0]
-            np.save(os.path.join(output_dir, os.path.basename(filename).split('.')[0]),
-                    np.uint8(255 * pred))
+        m = LoadedModel(model_dir, predict_mode='image')
+        # Decoding, prediction by tiles and saving of the files are run concurrently
+        predict_fn = partial(LoadedModel.predict_with_tiles, tile_size=TILE_SIZE, resized_size=None)
+        for _ in tqdm(predict_stream(m, filenames_to_predict, partial(save_probs_npy, output_dir=output_dir),
+                                     predict_fn=predict_fn),
+                      total=len(filenames_to_predict), desc='Prediction'):
+            pass
 
 
 def evaluate_on_set(files_to_evaluate, post_process_params, output_dir, gt_dir, page_masks_dir=None):
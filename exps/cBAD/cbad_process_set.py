@@ -6,6 +6,8 @@ import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir)))
 from dh_segment.loader import LoadedModel
+from dh_segment.streaming import predict_stream, save_probs_npy
+from functools import partial
 from cbad_post_processing import line_extraction_v1
 from cbad_evaluation import cbad_evaluate_folder
 
@@ -30,11 +32,11 @@ def predict_on_set(filenames_to_predict, model_dir, output_dir):
     :return:
     """
     with tf.Session():
-        m = LoadedModel(model_dir, 'filename')
-        for filename in tqdm(filenames_to_predict, desc='Prediction'):
-            pred = m.predict(filename)['probs'][0]
-            np.save(os.path.join(output_dir, os.path.basename(filename).split('.')[0]),
-                    np.uint8(255 * pred))
+        m = LoadedModel(model_dir, predict_mode='image')
+        # Decoding, prediction and saving of the files are run concurrently
+        for _ in tqdm(predict_stream(m, filenames_to_predict, partial(save_probs_npy, output_dir=output_dir)),
+                      total=len(filenames_to_predict), desc='Prediction'):
+            pass
 
 
 def find_lines(img_filenames, dir_predictions, post_process_params, output_dir, debug=False, mask_dir: str=None):
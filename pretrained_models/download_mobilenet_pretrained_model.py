@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import argparse
+import urllib.request
+import tarfile
+import os
+from tqdm import tqdm
+
+
+def progress_hook(t):
+    last_b = [0]
+
+    def update_to(b=1, bsize=1, tsize=None):
+        """
+        b  : int, optional
+            Number of blocks transferred so far [default: 1].
+        bsize  : int, optional
+            Size of each block (in tqdm units) [default: 1].
+        tsize  : int, optional
+            Total size (in tqdm units). If [default: None] remains unchanged.
+        """
+        if tsize is not None:
+            t.total = tsize
+        t.update((b - last_b[0]) * bsize)
+        last_b[0] = b
+
+    return update_to
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--depth_multiplier', type=str, default='1.0', choices=['1.0', '0.75', '0.5', '0.25'],
+                        help='Width multiplier of the model (model_params.depth_multiplier)')
+    args = vars(parser.parse_args())
+
+    model_name = 'mobilenet_v1_{}_224'.format(args.get('depth_multiplier'))
+    tar_filename = '{}.tgz'.format(model_name)
+    with tqdm(unit='B', unit_scale=True, unit_divisor=1024, miniters=1,
+              desc="Downloading pre-trained weights") as t:
+        urllib.request.urlretrieve('http://download.tensorflow.org/models/mobilenet_v1_2018_02_22/{}'.format(
+            tar_filename), tar_filename, reporthook=progress_hook(t))
+    tar = tarfile.open(tar_filename)
+    tar.extractall(members=[m for m in tar.getmembers() if '.ckpt' in m.name])
+    tar.close()
+    print('MobileNet pre-trained weights downloaded! ({}.ckpt)'.format(model_name))
+    os.remove(tar_filename)
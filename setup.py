@@ -5,7 +5,7 @@ setup(name='dh_segment',
       version='0.1',
       url='https://github.com/dhlab-epfl/dhSegment',
       description='Generic framework for historical document processing',
-      packages=find_packages(exclude=['exps*']),
+      packages=find_packages(exclude=['exps*', 'tests*']),
       install_requires=[
           'pillow', 'imageio', 'opencv-python', 'tqdm'
       ],
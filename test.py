@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
-import tensorflow as tf
-from dh_segment.loader import LoadedModel
+from dh_segment.loader import ModelRegistry, predict_with_models, fuse_probs
 from tqdm import tqdm
 from glob import glob
 import numpy as np
+from collections import OrderedDict
 import os
 import cv2
 from imageio import imread, imsave
@@ -32,44 +32,33 @@ if __name__ == '__main__':
     # Store coordinates of page in a .txt file
     txt_coordinates = ''
 
-    with tf.Session():  # Start a tensorflow session
+    # Each model is loaded once, in its own graph and session
+    with ModelRegistry() as registry:
 
+        models = OrderedDict((mn, registry.get(bp + 'model/', mn, predict_mode='image')) for mn in modelnames)
 
-        models = list()
-
-        # # cache the models
-        # for mn in modelnames:
-        #     m = LoadedModel(bp + 'model/', mn, predict_mode='filename')
-        #     models.append(m)
-            
         for filename in tqdm(input_files, desc='Processed files'):
             
-            probList = list()
             basename = os.path.basename(filename).split('.')[0]
 
             if os.path.exists(os.path.join(output_dir, basename + '-probs.png')):
                 print(basename + " skipped...")
 
-            # for m in models:
-            for mn in modelnames:
+            # For each image, predict each pixel's label with all the models (the image is decoded only once)
+            predictions = predict_with_models(models, filename, prediction_key='probs')
 
-                # TODO: I cannot cache models?!
-                # NOTE: here we loose an incredible amount of memory...
-                m = LoadedModel(bp + 'model/', mn, predict_mode='filename')
-                
-                # For each image, predict each pixel's label
-                prediction_outputs = m.predict(filename)
+            for mn, prediction_outputs in predictions.items():
                 probs = prediction_outputs['probs'][0]
-                original_shape = prediction_outputs['original_shape']
                 probs = probs[:, :, 1]  # Take only class '1' (class 0 is the background)
-                probList.append(probs)
 
                 probsN = probs / np.max(probs)  # Normalize to be in [0, 1]
 
-                imsave(os.path.join(output_dir, basename + '-' + m.name + '.png'), convert_image(probsN))
+                imsave(os.path.join(output_dir, basename + '-' + mn + '.png'), convert_image(probsN))
 
-            oImg = np.dstack((probList[0], probList[1], probList[2]))  # stacks 3 h x w arrays -> h x w x 3
+            oImg = fuse_probs(predictions, class_index=1)  # stacks 3 h x w arrays -> h x w x 3
             oImg = oImg / np.max(oImg)
             
             imsave(os.path.join(output_dir, basename + '-probs.png'), convert_image(oImg))
-                       
+
+        for model in models.values():
+            registry.release(model)
@@ -0,0 +1,52 @@
+import os
+import tensorflow as tf
+from dh_segment.input import DataOrder, DataOrderSaverListener
+
+_N_IMAGES = 10
+_FILENAMES = ['image_{:02d}.jpg'.format(i) for i in range(_N_IMAGES)]
+
+
+def _read(data_order: DataOrder, n_elements: int, num_epochs: int=None) -> list:
+    # Filenames given by the order, in a new graph as when the training is restarted
+    with tf.Graph().as_default(), tf.Session() as sess:
+        next_element = data_order.dataset(_FILENAMES, num_epochs=num_epochs).make_one_shot_iterator().get_next()
+        return [sess.run(next_element)[0].decode() for _ in range(n_elements)]
+
+
+def test_epochs_are_permutations_with_different_orders():
+    elements = _read(DataOrder(_N_IMAGES, seed=3), 3 * _N_IMAGES)
+    epochs = [elements[i:i + _N_IMAGES] for i in range(0, len(elements), _N_IMAGES)]
+
+    assert all(sorted(epoch) == _FILENAMES for epoch in epochs)
+    assert epochs[0] != epochs[1] or epochs[1] != epochs[2]
+
+
+def test_same_seed_same_order():
+    assert _read(DataOrder(_N_IMAGES, seed=1), 2 * _N_IMAGES) == _read(DataOrder(_N_IMAGES, seed=1), 2 * _N_IMAGES)
+
+
+def test_resume_after_save(tmpdir):
+    reference = _read(DataOrder(_N_IMAGES, seed=5), 3 * _N_IMAGES)
+
+    # Training stopped in the middle of the second epoch, the state being saved with the checkpoint
+    data_order = DataOrder(_N_IMAGES, seed=5)
+    consumed = _read(data_order, _N_IMAGES + 7)
+    assert consumed == reference[:_N_IMAGES + 7]
+    assert (data_order.epoch, data_order.position) == (1, 7)
+    filename = os.path.join(str(tmpdir), 'data_order.json')
+    DataOrderSaverListener(data_order, filename).after_save(None, 1234)
+
+    # The rest of the epoch and the next epochs are the same as without interruption
+    restored = DataOrder.load(filename)
+    assert restored.state() == data_order.state()
+    assert _read(restored, 2 * _N_IMAGES - 7) == reference[_N_IMAGES + 7:]
+
+
+def test_resume_at_the_end_of_an_epoch():
+    reference = _read(DataOrder(_N_IMAGES, seed=2), 2 * _N_IMAGES)
+
+    data_order = DataOrder(_N_IMAGES, seed=2)
+    _read(data_order, _N_IMAGES)
+    assert (data_order.epoch, data_order.position) == (1, 0)
+    restored = DataOrder(**data_order.state())
+    assert _read(restored, _N_IMAGES, num_epochs=1) == reference[_N_IMAGES:]
@@ -0,0 +1,95 @@
+import os
+import numpy as np
+import tensorflow as tf
+import pytest
+from dh_segment import utils
+
+
+def _previous_colors_to_indexes(label_image: np.ndarray, colors_values: np.ndarray) -> np.ndarray:
+    # Decoding before the packed-key lookup : argmin of the distances to all the colors
+    diff = label_image[..., None, :].astype(np.float32) - colors_values.astype(np.float32)
+    return np.argmin(np.sum(np.square(diff), axis=-1), axis=-1)
+
+
+def _previous_multiclass_to_label_image(class_labels: np.ndarray, classes_color_values: np.ndarray,
+                                        colors_labels: np.ndarray) -> np.ndarray:
+    # Lookup before the bit packing : one dimension of size 2 per class
+    c = np.zeros((2,) * colors_labels.shape[1] + (3,), np.int32)
+    for c_value, inds in zip(classes_color_values, colors_labels):
+        c[tuple(inds)] = c_value
+    return c[tuple(np.moveaxis(class_labels.astype(np.int32), -1, 0))]
+
+
+def _run(tensor):
+    with tf.Session() as sess:
+        return sess.run(tensor)
+
+
+def _random_colors(random_state, n_colors):
+    return random_state.randint(0, 256, [n_colors, 3]).astype(np.float32)
+
+
+@pytest.mark.parametrize('n_classes', [1, 2, 3, 5, 7, 8, 9])
+def test_colors_to_indexes_known_colors(n_classes):
+    random_state = np.random.RandomState(n_classes)
+    colors = _random_colors(random_state, n_classes)
+    label_image = colors[random_state.randint(0, n_classes, [20, 30])]
+
+    indexes = _run(utils.colors_to_indexes(tf.constant(label_image), colors))
+    np.testing.assert_array_equal(indexes, _previous_colors_to_indexes(label_image, colors))
+
+
+@pytest.mark.parametrize('n_classes', [2, 3, 5, 7, 8])
+def test_colors_to_indexes_unknown_colors(n_classes):
+    random_state = np.random.RandomState(n_classes)
+    colors = _random_colors(random_state, n_classes)
+    label_image = colors[random_state.randint(0, n_classes, [20, 30])]
+    # Interpolated colors, as at the borders of resized labels
+    unknown = random_state.rand(20, 30) < 0.3
+    label_image[unknown] = np.round(random_state.randint(0, 256, [np.sum(unknown), 3]))
+
+    indexes = _run(utils.colors_to_indexes(tf.constant(label_image), colors))
+    np.testing.assert_array_equal(indexes, _previous_colors_to_indexes(label_image, colors))
+
+
+def test_colors_to_indexes_shared_and_extreme_colors():
+    # The first class of a shared color wins, as with the argmin
+    colors = np.array([[0, 0, 0], [255, 255, 255], [0, 0, 0], [255, 0, 0], [255, 255, 255]], np.float32)
+    label_image = np.array([[[0, 0, 0], [255, 255, 255], [255, 0, 0], [254, 1, 0]]], np.float32)
+
+    indexes = _run(utils.colors_to_indexes(tf.constant(label_image), colors))
+    np.testing.assert_array_equal(indexes, _previous_colors_to_indexes(label_image, colors))
+
+
+def test_label_image_to_class_batch(tmpdir):
+    random_state = np.random.RandomState(0)
+    colors = _random_colors(random_state, 5)
+    classes_file = os.path.join(str(tmpdir), 'classes.txt')
+    np.savetxt(classes_file, colors)
+    label_images = colors[random_state.randint(0, 5, [2, 10, 12])].astype(np.uint8)
+
+    classes = _run(utils.label_image_to_class(tf.constant(label_images), classes_file))
+    np.testing.assert_array_equal(classes, _previous_colors_to_indexes(label_images, colors))
+    np.testing.assert_array_equal(_run(utils.class_to_label_image(tf.constant(classes), classes_file)),
+                                  label_images)
+
+
+@pytest.mark.parametrize('n_classes', [1, 2, 3, 5])
+def test_multiclass_to_label_image(tmpdir, n_classes):
+    random_state = np.random.RandomState(n_classes)
+    # All the combinations of labels, except the last one which has no color
+    colors_labels = np.array([[(i >> b) & 1 for b in range(n_classes)] for i in range(2 ** n_classes - 1)])
+    colors = _random_colors(random_state, len(colors_labels))
+    classes_file = os.path.join(str(tmpdir), 'classes.txt')
+    np.savetxt(classes_file, np.concatenate([colors, colors_labels], axis=1))
+    class_labels = random_state.randint(0, 2, [10, 12, n_classes])
+
+    classes_color_values, labels = utils.get_classes_color_from_file_multilabel(classes_file)
+    label_image = _run(utils.multiclass_to_label_image(tf.constant(class_labels), classes_file))
+    np.testing.assert_array_equal(label_image,
+                                  _previous_multiclass_to_label_image(class_labels, classes_color_values, labels))
+
+    # And back to the labels, for the combinations which have a color
+    has_color = np.any(np.all(class_labels[:, :, None, :] == colors_labels, axis=-1), axis=-1)
+    decoded = _run(utils.multilabel_image_to_class(tf.constant(label_image), classes_file))
+    np.testing.assert_array_equal(decoded[has_color], class_labels[has_color] > 0)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from dh_segment.loader import _tile_positions_1d, _tile_window_1d, _tile_window_2d
+
+
+def _blend(image: np.ndarray, tile_size: int, min_overlap: float, linear_interpolation: bool=True,
+           window: str='linear') -> (np.ndarray, np.ndarray):
+    # Same accumulation as `LoadedModel.predict_with_tiles`, each tile being predicted as the crop of `image`
+    h, w = image.shape[:2]
+    y_pos = _tile_positions_1d(h, tile_size, min_overlap)
+    x_pos = _tile_positions_1d(w, tile_size, min_overlap)
+    window_2d = _tile_window_2d(y_pos, x_pos, tile_size, linear_interpolation, window)
+    result = np.zeros(image.shape, np.float32)
+    weights = np.zeros([h, w], np.float32)
+    for y in y_pos:
+        for x in x_pos:
+            region = (slice(y, y + tile_size), slice(x, x + tile_size))
+            result[region] += image[region] * window_2d[:, :, None]
+            weights[region] += window_2d
+    return result / weights[:, :, None], weights
+
+
+@pytest.mark.parametrize('window', ['linear', 'cosine'])
+@pytest.mark.parametrize('linear_interpolation', [True, False])
+@pytest.mark.parametrize('shape,tile_size,min_overlap', [((700, 500), 300, 0.2), ((1001, 333), 100, 0.5),
+                                                         ((260, 255), 250, 0.2), ((400, 400), 50, 0.9)])
+def test_constant_prediction_stays_constant(shape, tile_size, min_overlap, linear_interpolation, window):
+    image = np.full(list(shape) + [2], 0.3, np.float32)
+    blended, weights = _blend(image, tile_size, min_overlap, linear_interpolation, window)
+
+    # Every pixel, borders and corners included, is covered with a positive weight
+    assert np.all(weights > 0)
+    np.testing.assert_allclose(blended, 0.3, rtol=1e-5)
+
+
+@pytest.mark.parametrize('window', ['linear', 'cosine'])
+def test_consistent_tiles_are_reconstructed(window):
+    image = np.random.RandomState(0).rand(530, 470, 3).astype(np.float32)
+    blended, _ = _blend(image, 200, 0.3, window=window)
+    np.testing.assert_allclose(blended, image, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('window', ['linear', 'cosine'])
+@pytest.mark.parametrize('size,ramp_size', [(1, 1), (1, 10), (4, 10), (7, 7), (10, 5), (10, 0)])
+def test_window_positive_and_symmetric(size, ramp_size, window):
+    w = _tile_window_1d(size, ramp_size, window)
+    assert w.shape == (size,) and w.dtype == np.float32
+    assert np.all(w > 0) and np.all(w <= 1)
+    np.testing.assert_array_equal(w, w[::-1])
+
+
+def test_tiles_smaller_than_the_ramp():
+    # Overlap larger than half a tile : the ramps never reach 1 but the weights stay positive
+    y_pos = _tile_positions_1d(100, 20, 0.9)
+    assert np.min(np.diff(y_pos)) < 10
+    window_2d = _tile_window_2d(y_pos, y_pos, 20)
+    assert np.all(window_2d > 0) and np.max(window_2d) < 1
+
+
+def test_no_interpolation_averages_overlaps():
+    y_pos = _tile_positions_1d(30, 20, 0.5)
+    np.testing.assert_array_equal(_tile_window_2d(y_pos, y_pos, 20, linear_interpolation=False), 1)
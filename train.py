@@ -3,7 +3,7 @@ import tensorflow as tf
 # Tensorflow logging level
 from logging import WARNING  # import  DEBUG, INFO, ERROR for more/less verbosity
 tf.logging.set_verbosity(WARNING)
-from dh_segment import estimator_fn, input, utils
+from dh_segment import estimator_fn, input, utils, inference_export
 import json
 from glob import glob
 import numpy as np
@@ -26,6 +26,11 @@ def default_config():
     restore_model = False  # Set to true to continue training
     classes_file = None  # txt file with classes values (unused for REGRESSION)
     gpu = ''  # GPU to be used for training
+    cache_dir = None  # Directory to cache the resized training images and labels (no cache if None)
+    export_for_inference = False  # Also export a frozen graph optimised for inference in export_inference/
+    # Aspect ratios (width / height) of the static-shape signatures, each input is fixed to the shape of this ratio
+    # once resized to input_resized_size (see input.static_input_shape). No static-shape signature if None
+    static_aspect_ratios = None
     prediction_type = utils.PredictionType.CLASSIFICATION  # One of CLASSIFICATION, REGRESSION or MULTILABEL
     pretrained_model_name = 'resnet50'
     model_params = utils.ModelParams(pretrained_model_name=pretrained_model_name).to_dict()  # Model parameters
@@ -41,7 +46,7 @@ def default_config():
 
 
 @ex.automain
-def run(train_dir, eval_dir, model_output_dir, gpu, training_params, _config):
+def run(train_dir, eval_dir, model_output_dir, gpu, training_params, _config, _seed):
 
     # Create output directory
     if not os.path.isdir(model_output_dir):
@@ -77,22 +82,43 @@ def run(train_dir, eval_dir, model_output_dir, gpu, training_params, _config):
         eval_images_dir, eval_labels_dir = os.path.join(eval_dir, 'images'), os.path.join(eval_dir, 'labels')
         assert os.path.isdir(eval_images_dir)
 
-    for i in trange(0, training_params.n_epochs, training_params.evaluate_every_epoch, desc='Evaluated epochs'):
+    # Order of the training images, resumed from the last checkpoint if the training is restored
+    data_order_file = os.path.join(model_output_dir, 'data_order.json')
+    if _config.get('restore_model') and os.path.exists(data_order_file):
+        data_order = input.DataOrder.load(data_order_file)
+    else:
+        n_train_images = len(glob(os.path.join(train_images_dir, '**', '*.jpg'), recursive=True) +
+                             glob(os.path.join(train_images_dir, '**', '*.png'), recursive=True))
+        data_order = input.DataOrder(n_train_images, seed=_seed)
+    data_order_saver = input.DataOrderSaverListener(data_order, data_order_file)
+
+    for i in trange(data_order.epoch, training_params.n_epochs, training_params.evaluate_every_epoch,
+                    desc='Evaluated epochs'):
         # Train for one epoch
         estimator.train(input.input_fn(train_images_dir,
                                        input_label_dir=train_labels_dir,
-                                       num_epochs=training_params.evaluate_every_epoch,
+                                       num_epochs=min(training_params.evaluate_every_epoch,
+                                                      training_params.n_epochs - data_order.epoch),
                                        batch_size=training_params.batch_size,
                                        data_augmentation=training_params.data_augmentation,
                                        make_patches=training_params.make_patches,
                                        image_summaries=True,
-                                       params=_config))
+                                       cache_dir=_config.get('cache_dir'),
+                                       data_order=data_order,
+                                       params=_config),
+                        saving_listeners=[data_order_saver])
 
-        # Export model (filename, batch_size = 1) and predictions
+        # Export model (filename, image batches) and predictions
+        static_shapes = [input.static_input_shape(training_params.input_resized_size, r)
+                         for r in _config.get('static_aspect_ratios') or []]
         exported_path = estimator.export_savedmodel(saved_model_dir,
-                                                    input.serving_input_filename(training_params.input_resized_size))
+                                                    input.serving_input_filename(training_params.input_resized_size,
+                                                                                 static_shapes))
         exported_path = exported_path.decode()
         timestamp_exported = os.path.split(exported_path)[-1]
+        if _config.get('export_for_inference'):
+            inference_export.export_for_inference(exported_path, os.path.join(model_output_dir, 'export_inference',
+                                                                              timestamp_exported))
 
         if eval_dir is not None:
             try:  # There should be no evaluation when input_resize_size is too big (e.g -1)